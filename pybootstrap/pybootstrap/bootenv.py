@@ -0,0 +1,438 @@
+"""A module for managing boot environments.
+
+A boot environment (BE) is a pair of datasets `rpool/<os_id>/ROOT/<name>`
+and `bpool/<os_id>/BOOT/<name>`, or only the former on systemd-boot
+installs without a boot pool, whose kernels are on the ESPs. New BEs
+are clones of snapshots of an existing BE, so creating one takes
+constant time regardless of its size. The `/nix` dataset is shared by
+all BEs.
+
+Since `/nix` and its system profile are shared, every BE records the
+store path of its own NixOS system in the `org.pybootstrap:toplevel`
+property of its root dataset, with a GC root keeping it alive. Upgrading
+a BE builds the configuration and records the result; a new BE boots
+the system of the BE it was cloned from.
+
+The generated NixOS configuration mounts `ROOT/default` and
+`BOOT/default`, so the active BE is always named `default`. Activating
+a BE sets the system profile to its system and writes the bootloader
+entries with it, renames the current `default` to
+`default-prev-<timestamp>` and the BE to `default`, and promotes it so
+that the previous BE can be destroyed later. A previous BE keeps its
+system, so activating it rolls back.
+
+Every operation takes an exclusive lock and can be run with `dry_run`,
+which prints the commands instead of running them.
+"""
+import fcntl
+import socket
+import subprocess
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from pybootstrap import trace
+from pybootstrap.nixsettings import get_nix_settings
+
+ACTIVE = "default"
+PREVIOUS_PREFIX = f"{ACTIVE}-prev-"
+SNAPSHOT_PREFIX = "be-"
+RESERVED = ("empty",)
+LOCK_PATH = Path("/run/pybootstrap/bootenv.lock")
+MOUNT_PATH = Path("/run/pybootstrap/be")
+ESP_PATH = Path("/boot/efis")
+SYSTEM_PROFILE = Path("/nix/var/nix/profiles/system")
+GCROOTS_PATH = Path("/nix/var/nix/gcroots/pybootstrap")
+TOPLEVEL_PROPERTY = "org.pybootstrap:toplevel"
+
+
+class BootEnv(NamedTuple):
+    """A boot environment."""
+
+    name: str
+    root: str
+    boot: Optional[str]
+    creation: int
+    origin: str
+    mounted: bool
+
+
+@lru_cache
+def has_bpool(os_id: str) -> bool:
+    """Whether the boot environments have boot datasets on a boot pool."""
+    process = trace.run(
+        f"zfs list -H -o name bpool/{os_id}/BOOT".split(),
+        capture_output=True,
+        check=False,
+    )
+    return process.returncode == 0
+
+
+def get_datasets(os_id: str, name: str) -> Tuple[str, Optional[str]]:
+    """Returns the root and boot datasets of a BE, None without a boot pool."""
+    boot = f"bpool/{os_id}/BOOT/{name}" if has_bpool(os_id=os_id) else None
+    return f"rpool/{os_id}/ROOT/{name}", boot
+
+
+@contextmanager
+def locked() -> Iterator[None]:
+    """Holds the exclusive boot environment lock.
+
+    Raises:
+        RuntimeError: If another operation holds the lock.
+    """
+    LOCK_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(LOCK_PATH, "w", encoding="UTF-8") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError as err:
+            msg = "Another boot environment operation is running."
+            raise RuntimeError(msg) from err
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _run(cmd: List[str], dry_run: bool) -> None:
+    if dry_run:
+        print(" ".join(cmd))
+        return
+    trace.run(cmd, check=True)
+
+
+def list_bootenvs(os_id: str) -> List[BootEnv]:
+    """Returns the boot environments, oldest first."""
+    process = trace.run(
+        f"zfs list -Hp -d 1 -t filesystem -s creation -o name,creation,origin "
+        f"rpool/{os_id}/ROOT".split(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    mounted_root = trace.run(
+        "findmnt -n -o SOURCE /".split(), capture_output=True, text=True, check=False
+    ).stdout.strip()
+
+    bootenvs = []
+    for line in process.stdout.splitlines():
+        dataset, creation, origin = line.split("\t")
+        name = dataset.rpartition("/")[2]
+        if dataset == f"rpool/{os_id}/ROOT" or name in RESERVED:
+            continue
+        root, boot = get_datasets(os_id=os_id, name=name)
+        bootenvs.append(
+            BootEnv(
+                name=name,
+                root=root,
+                boot=boot,
+                creation=int(creation),
+                origin="" if origin == "-" else origin,
+                mounted=root == mounted_root,
+            )
+        )
+    return bootenvs
+
+
+def get_bootenv(os_id: str, name: str) -> BootEnv:
+    """Returns a boot environment by name.
+
+    Raises:
+        ValueError: If the boot environment does not exist.
+    """
+    for bootenv in list_bootenvs(os_id=os_id):
+        if bootenv.name == name:
+            return bootenv
+    raise ValueError(f"Unknown boot environment: {name}.")
+
+
+def get_toplevel(root: str) -> Optional[str]:
+    """Returns the system recorded for a BE root dataset, if any."""
+    value = trace.run(
+        ["zfs", "get", "-H", "-o", "value", TOPLEVEL_PROPERTY, root],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+    return None if value == "-" else value
+
+
+def resolve_toplevel(os_id: str, name: str) -> str:
+    """Returns the system a BE boots.
+
+    The active BE may predate the recorded systems; it boots the current
+    generation of the system profile.
+
+    Raises:
+        ValueError: If no system is recorded for an inactive BE.
+    """
+    root, _ = get_datasets(os_id=os_id, name=name)
+    toplevel = get_toplevel(root=root)
+    if toplevel is not None:
+        return toplevel
+    if name == ACTIVE:
+        return str(SYSTEM_PROFILE.resolve())
+    raise ValueError(f"No system recorded for {name}, upgrade it first.")
+
+
+def set_toplevel(root: str, toplevel: str, dry_run: bool):
+    """Records the system of a BE and keeps it from being collected."""
+    _run(["zfs", "set", f"{TOPLEVEL_PROPERTY}={toplevel}", root], dry_run=dry_run)
+    _run(["mkdir", "-p", str(GCROOTS_PATH)], dry_run=dry_run)
+    gcroot = GCROOTS_PATH / Path(toplevel).name
+    _run(["ln", "-sfn", toplevel, str(gcroot)], dry_run=dry_run)
+
+
+def build_toplevel(flake: Optional[str] = None, dry_run: bool = False) -> str:
+    """Builds the NixOS system of the configuration in `/etc/nixos`.
+
+    Args:
+        flake: A flake URI with an optional `#<host>`, the host name if
+            omitted, like `nixos-rebuild --flake`.
+        dry_run: Print the command instead of running it.
+
+    Returns:
+        The store path of the system.
+    """
+    if flake is None:
+        cmd = ["nix-build", "<nixpkgs/nixos>", "-A", "system", "--no-out-link"]
+        cmd += ["-I", "nixos-config=/etc/nixos/configuration.nix"]
+    else:
+        uri, _, host = flake.partition("#")
+        attr = "config.system.build.toplevel"
+        cmd = ["nix", "--extra-experimental-features", "nix-command flakes"]
+        cmd += ["build", "--no-link", "--print-out-paths"]
+        cmd += [f"{uri}#nixosConfigurations.{host or socket.gethostname()}.{attr}"]
+    cmd += get_nix_settings().to_args()
+
+    if dry_run:
+        print(" ".join(cmd))
+        return "<toplevel>"
+    process = trace.run(cmd, stdout=subprocess.PIPE, text=True, check=True)
+    return process.stdout.strip().splitlines()[-1]
+
+
+def create(os_id: str, name: str, source: str = ACTIVE, dry_run: bool = False):
+    """Creates a boot environment from a snapshot of another one.
+
+    The new boot environment boots the system of its source until it is
+    upgraded.
+
+    Args:
+        os_id: The OS dataset name.
+        name: The name of the new boot environment.
+        source: The boot environment to clone.
+        dry_run: Print the commands instead of running them.
+
+    Raises:
+        ValueError: If the name is taken or the source does not exist.
+    """
+    with locked():
+        names = [bootenv.name for bootenv in list_bootenvs(os_id=os_id)]
+        if name in names or name in RESERVED or name.startswith(PREVIOUS_PREFIX):
+            raise ValueError(f"Boot environment name not available: {name}.")
+        if source not in names:
+            raise ValueError(f"Unknown boot environment: {source}.")
+
+        src_root, src_boot = get_datasets(os_id=os_id, name=source)
+        root, boot = get_datasets(os_id=os_id, name=name)
+        snapshot = f"{SNAPSHOT_PREFIX}{name}"
+        toplevel = resolve_toplevel(os_id=os_id, name=source)
+
+        _run(["zfs", "snapshot", f"{src_root}@{snapshot}"], dry_run=dry_run)
+        clone = ["zfs", "clone", "-o", "canmount=noauto", "-o"]
+        _run([*clone, "mountpoint=/", f"{src_root}@{snapshot}", root], dry_run=dry_run)
+        if boot is not None:
+            _run(["zfs", "snapshot", f"{src_boot}@{snapshot}"], dry_run=dry_run)
+            _run(
+                [*clone, "mountpoint=/boot", f"{src_boot}@{snapshot}", boot],
+                dry_run=dry_run,
+            )
+        set_toplevel(root=root, toplevel=toplevel, dry_run=dry_run)
+
+
+@contextmanager
+def mounted(os_id: str, name: str, dry_run: bool = False) -> Iterator[Path]:
+    """Mounts a boot environment with the shared `/nix` and the ESPs.
+
+    The boot environment is unmounted afterwards. If that fails after an
+    error, the error is raised rather than the failed unmount.
+
+    Yields:
+        The mount point of the boot environment.
+    """
+    root, boot = get_datasets(os_id=os_id, name=name)
+    mount_path = MOUNT_PATH / name
+    if not dry_run:
+        mount_path.mkdir(parents=True, exist_ok=True)
+
+    try:
+        _run(["mount", "-t", "zfs", "-o", "zfsutil", root, str(mount_path)], dry_run)
+        if boot is not None:
+            _run(
+                ["mount", "-t", "zfs", "-o", "zfsutil", boot, str(mount_path / "boot")],
+                dry_run,
+            )
+        _run(["mount", "--bind", "/nix", str(mount_path / "nix")], dry_run)
+        for esp in sorted(ESP_PATH.glob("*")):
+            target = mount_path / esp.relative_to("/")
+            _run(["mount", "--bind", str(esp), str(target)], dry_run)
+        yield mount_path
+    except BaseException:
+        _umount(mount_path=mount_path, dry_run=dry_run, check=False)
+        raise
+    _umount(mount_path=mount_path, dry_run=dry_run, check=True)
+
+
+def _umount(mount_path: Path, dry_run: bool, check: bool) -> None:
+    cmd = ["umount", "-R", str(mount_path)]
+    if dry_run:
+        print(" ".join(cmd))
+        return
+    process = trace.run(cmd, check=check)
+    if process.returncode != 0:
+        print(f"Could not unmount {mount_path}")
+
+
+def upgrade(os_id: str, name: str, flake: Optional[str] = None, dry_run: bool = False):
+    """Builds the current NixOS configuration for a boot environment.
+
+    The configuration in `/etc/nixos` is built with the shared `/nix`,
+    so only the store paths that changed are built or fetched, and the
+    result is recorded as the system of the boot environment. Neither
+    the system profile nor the bootloader is touched until the boot
+    environment is activated.
+
+    Raises:
+        ValueError: If the boot environment is the active one.
+    """
+    if name == ACTIVE:
+        raise ValueError("Create a new boot environment to upgrade into.")
+
+    with locked():
+        bootenv = get_bootenv(os_id=os_id, name=name)
+        toplevel = build_toplevel(flake=flake, dry_run=dry_run)
+        set_toplevel(root=bootenv.root, toplevel=toplevel, dry_run=dry_run)
+
+
+def activate(os_id: str, name: str, dry_run: bool = False):
+    """Makes a boot environment the one booted by default.
+
+    The system profile is set to the system of the boot environment and
+    its bootloader entries are written from inside the boot environment
+    before any dataset is renamed. If writing them fails, the profile is
+    rolled back, so a failure leaves the current default in place. The
+    current default keeps its system for a later rollback.
+
+    Raises:
+        ValueError: If the boot environment does not exist, is active or
+            has no recorded system.
+    """
+    if name == ACTIVE:
+        raise ValueError(f"{name} is already active.")
+
+    with locked():
+        get_bootenv(os_id=os_id, name=name)
+        toplevel = resolve_toplevel(os_id=os_id, name=name)
+        active_root, _ = get_datasets(os_id=os_id, name=ACTIVE)
+        if get_toplevel(root=active_root) is None:
+            active_toplevel = resolve_toplevel(os_id=os_id, name=ACTIVE)
+            set_toplevel(root=active_root, toplevel=active_toplevel, dry_run=dry_run)
+
+        with mounted(os_id=os_id, name=name, dry_run=dry_run) as mount_path:
+            _run(
+                ["nix-env", "-p", str(SYSTEM_PROFILE), "--set", toplevel],
+                dry_run=dry_run,
+            )
+            try:
+                _run(
+                    [
+                        "nixos-enter",
+                        "--root",
+                        str(mount_path),
+                        "--",
+                        f"{toplevel}/bin/switch-to-configuration",
+                        "boot",
+                    ],
+                    dry_run=dry_run,
+                )
+            except BaseException:
+                _run(
+                    ["nix-env", "-p", str(SYSTEM_PROFILE), "--rollback"],
+                    dry_run=dry_run,
+                )
+                raise
+
+        previous = f"{PREVIOUS_PREFIX}{time.strftime('%Y%m%d%H%M%S')}"
+        for current, new, prev in zip(
+            get_datasets(os_id=os_id, name=ACTIVE),
+            get_datasets(os_id=os_id, name=name),
+            get_datasets(os_id=os_id, name=previous),
+        ):
+            if current is None:
+                continue
+            _run(["zfs", "rename", "-u", current, prev], dry_run=dry_run)
+            _run(["zfs", "rename", "-u", new, current], dry_run=dry_run)
+            _run(["zfs", "promote", current], dry_run=dry_run)
+
+
+def destroy(os_id: str, name: str, dry_run: bool = False):
+    """Destroys a boot environment and the snapshots it was cloned from.
+
+    Raises:
+        ValueError: If the boot environment is active or mounted.
+    """
+    with locked():
+        _destroy(
+            bootenv=get_bootenv(os_id=os_id, name=name), os_id=os_id, dry_run=dry_run
+        )
+
+
+def _destroy(bootenv: BootEnv, os_id: str, dry_run: bool):
+    if bootenv.name == ACTIVE or bootenv.mounted:
+        raise ValueError(f"Cannot destroy the active boot environment: {bootenv.name}.")
+
+    toplevel = get_toplevel(root=bootenv.root)
+    for dataset in filter(None, (bootenv.root, bootenv.boot)):
+        origin = trace.run(
+            ["zfs", "get", "-H", "-o", "value", "origin", dataset],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        _run(["zfs", "destroy", dataset], dry_run=dry_run)
+        if f"@{SNAPSHOT_PREFIX}" in origin:
+            _run(["zfs", "destroy", origin], dry_run=dry_run)
+
+    # the system stays alive while another boot environment boots it
+    remaining = [
+        get_toplevel(root=other.root)
+        for other in list_bootenvs(os_id=os_id)
+        if other.name != bootenv.name
+    ]
+    if toplevel is not None and toplevel not in remaining:
+        gcroot = GCROOTS_PATH / Path(toplevel).name
+        _run(["rm", "-f", str(gcroot)], dry_run=dry_run)
+
+
+def prune(os_id: str, keep: int = 3, dry_run: bool = False):
+    """Destroys all but the newest `keep` previous boot environments."""
+    with locked():
+        previous = [
+            bootenv
+            for bootenv in list_bootenvs(os_id=os_id)
+            if bootenv.name.startswith(PREVIOUS_PREFIX) and not bootenv.mounted
+        ]
+        for bootenv in previous[: max(len(previous) - keep, 0)]:
+            _destroy(bootenv=bootenv, os_id=os_id, dry_run=dry_run)
+
+
+def print_bootenvs(os_id: str):
+    """Prints the boot environments, oldest first."""
+    for bootenv in list_bootenvs(os_id=os_id):
+        created = time.strftime("%Y-%m-%d %H:%M", time.localtime(bootenv.creation))
+        flags = "N" if bootenv.mounted else ""
+        flags += "R" if bootenv.name == ACTIVE else ""
+        print(f"{bootenv.name:<32}{flags:>4}  {created}  {bootenv.origin}")
@@ -1,6 +1,15 @@
+"""Command line entry point for bootstrapping NixOS root on ZFS.
+
+Every stage lives behind its own subcommand and only imports the modules
+it needs, so headless subcommands start without loading the interactive
+prompt libraries. Running without a subcommand executes all stages.
+"""
+import argparse
 import os
+import sys
+from pathlib import Path
 
-from pybootstrap import configure, install, partition, prepare
+DEFAULT_PLAN = Path("/tmp/pybootstrap/plan.json")
 
 
 def _verify_root():
@@ -15,13 +24,347 @@ def _verify_root():
         )
 
 
-def main():
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive number.")
+    return number
+
+
+def _load_plan(args: argparse.Namespace):
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap.prepare import load_config
+
+    return load_config(args.plan)
+
+
+def run_all(args: argparse.Namespace):
+    """Runs every stage interactively, saving the plan on the way."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import configure, install, partition, prepare, trace
+
     _verify_root()
     config = prepare.prepare()
+    prepare.save_config(config=config, path=args.plan)
+    trace.set_stage("partition")
     partition.partition(config=config)
+    trace.set_stage("configure")
     configure.configure(config=config)
+    trace.set_stage("install")
     install.install(config=config)
 
 
+def run_plan(args: argparse.Namespace):
+    """Queries the user for the system configuration and saves it."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import prepare
+
+    # the encryption key is kept on a tmpfs owned by root
+    _verify_root()
+    config = prepare.prepare()
+    prepare.save_config(config=config, path=args.plan)
+    print(f"Plan written to {args.plan}")
+
+
+def run_partition(args: argparse.Namespace):
+    """Partitions the disks and creates the pools and datasets."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import partition
+
+    _verify_root()
+    partition.partition(config=_load_plan(args))
+
+
+def run_configure(args: argparse.Namespace):
+    """Generates the NixOS configuration files."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import configure
+
+    _verify_root()
+    configure.configure(config=_load_plan(args))
+
+
+def run_install(args: argparse.Namespace):
+    """Installs NixOS and exports the pools."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import install
+
+    _verify_root()
+    install.install(config=_load_plan(args))
+
+
+def run_verify(args: argparse.Namespace):
+    """Checks the dataset properties and runs the performance smoke test."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import verify
+
+    _verify_root()
+    verify.verify(config=_load_plan(args))
+
+
+def run_snapshot(args: argparse.Namespace):
+    """Snapshots the OS datasets of both pools."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import install
+
+    _verify_root()
+    install.snapshot(config=_load_plan(args), name=args.name)
+
+
+def run_export(args: argparse.Namespace):
+    """Unmounts the ESPs and exports the pools."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import install
+
+    _verify_root()
+    install.export(config=_load_plan(args))
+
+
+def run_measure_import(args: argparse.Namespace):
+    """Times the pool import scan of the exported pools."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import install
+
+    _verify_root()
+    install.measure_pool_import(config=_load_plan(args))
+
+
+def run_advise(args: argparse.Namespace):
+    """Benchmarks compression settings on sampled data."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import compression, prepare
+
+    recommended = compression.advise(
+        path=args.path,
+        recordsize=args.recordsize,
+        sample_size=args.sample_size * 1024**2,
+        min_speed=args.min_speed,
+        jobs=args.jobs,
+    )
+
+    if args.apply:
+        config = _load_plan(args)
+        zfs_config = config.zfs._replace(compression=recommended)
+        prepare.save_config(config=config._replace(zfs=zfs_config), path=args.plan)
+        print(f"Compression {recommended} written to {args.plan}")
+
+
+def run_bootenv(args: argparse.Namespace):
+    """Manages boot environments of an installed system."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import bootenv
+
+    if args.action != "list" and not args.dry_run:
+        _verify_root()
+
+    match args.action:
+        case "list":
+            bootenv.print_bootenvs(os_id=args.os_id)
+        case "create":
+            bootenv.create(
+                os_id=args.os_id,
+                name=args.name,
+                source=args.source,
+                dry_run=args.dry_run,
+            )
+        case "upgrade":
+            bootenv.upgrade(
+                os_id=args.os_id, name=args.name, flake=args.flake, dry_run=args.dry_run
+            )
+        case "activate":
+            bootenv.activate(os_id=args.os_id, name=args.name, dry_run=args.dry_run)
+        case "destroy":
+            bootenv.destroy(os_id=args.os_id, name=args.name, dry_run=args.dry_run)
+        case "prune":
+            bootenv.prune(os_id=args.os_id, keep=args.keep, dry_run=args.dry_run)
+
+
+def run_cache(args: argparse.Namespace):
+    """Copies the closure of this system into a signed binary cache."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import substituters
+
+    _verify_root()
+    substituters.build_cache(
+        cache_dir=args.cache_dir,
+        secret_key=args.key_file,
+        system=args.system,
+        key_name=args.key_name,
+    )
+
+
+def run_simulate(args: argparse.Namespace):
+    """Predicts the wall time of a traced run under other parallelism."""
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import simulate
+
+    simulate.simulate(
+        trace_path=args.trace_file,
+        jobs=args.jobs,
+        disks=args.disks,
+        rules_path=args.deps,
+    )
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Builds the command line parser."""
+    parser = argparse.ArgumentParser(
+        prog="pybootstrap", description="Install NixOS root on ZFS."
+    )
+    parser.add_argument(
+        "--plan",
+        type=Path,
+        default=DEFAULT_PLAN,
+        help=f"Path of the plan file (default: {DEFAULT_PLAN}).",
+    )
+    parser.add_argument(
+        "--trace",
+        type=Path,
+        help="Append the timing of every command run to this trace file.",
+    )
+    parser.set_defaults(func=run_all)
+    subparsers = parser.add_subparsers(title="stages")
+
+    subparser = subparsers.add_parser("plan", help=run_plan.__doc__)
+    subparser.set_defaults(func=run_plan)
+
+    subparser = subparsers.add_parser("advise", help=run_advise.__doc__)
+    subparser.add_argument(
+        "--path", type=Path, default=Path("/nix/store"), help="Tree to sample."
+    )
+    subparser.add_argument(
+        "--recordsize", type=int, default=128 * 1024, help="Block size in bytes."
+    )
+    subparser.add_argument(
+        "--sample-size", type=int, default=256, help="Sample size in MiB."
+    )
+    subparser.add_argument(
+        "--min-speed", type=float, default=150.0, help="Minimum MB/s per core."
+    )
+    subparser.add_argument(
+        "--jobs", type=int, default=1, help="Benchmarks run in parallel."
+    )
+    subparser.add_argument(
+        "--apply", action="store_true", help="Write the result to the plan."
+    )
+    subparser.set_defaults(func=run_advise)
+
+    subparser = subparsers.add_parser("partition", help=run_partition.__doc__)
+    subparser.set_defaults(func=run_partition)
+
+    subparser = subparsers.add_parser("configure", help=run_configure.__doc__)
+    subparser.set_defaults(func=run_configure)
+
+    subparser = subparsers.add_parser("install", help=run_install.__doc__)
+    subparser.set_defaults(func=run_install)
+
+    subparser = subparsers.add_parser("verify", help=run_verify.__doc__)
+    subparser.set_defaults(func=run_verify)
+
+    subparser = subparsers.add_parser("snapshot", help=run_snapshot.__doc__)
+    subparser.add_argument("name", help="Name of the snapshot.")
+    subparser.set_defaults(func=run_snapshot)
+
+    subparser = subparsers.add_parser("export", help=run_export.__doc__)
+    subparser.set_defaults(func=run_export)
+
+    subparser = subparsers.add_parser("measure-import", help=run_measure_import.__doc__)
+    subparser.set_defaults(func=run_measure_import)
+
+    subparser = subparsers.add_parser("be", help=run_bootenv.__doc__)
+    subparser.add_argument(
+        "--os-id", default="nixos", help="Name of the OS dataset (default: nixos)."
+    )
+    subparser.add_argument(
+        "--dry-run", action="store_true", help="Print the commands only."
+    )
+    subparser.set_defaults(func=run_bootenv)
+    actions = subparser.add_subparsers(title="actions", dest="action", required=True)
+
+    actions.add_parser("list", help="List the boot environments.")
+    action = actions.add_parser("create", help="Clone a boot environment.")
+    action.add_argument("name", help="Name of the new boot environment.")
+    action.add_argument(
+        "--source", default="default", help="Boot environment to clone."
+    )
+    action = actions.add_parser(
+        "upgrade", help="Install /etc/nixos into a boot environment."
+    )
+    action.add_argument("name", help="Name of the boot environment.")
+    action.add_argument("--flake", help="Flake URI of the system to install.")
+    action = actions.add_parser("activate", help="Boot a boot environment next.")
+    action.add_argument("name", help="Name of the boot environment.")
+    action = actions.add_parser("destroy", help="Destroy a boot environment.")
+    action.add_argument("name", help="Name of the boot environment.")
+    action = actions.add_parser(
+        "prune", help="Destroy all but the newest previous boot environments."
+    )
+    action.add_argument(
+        "--keep", type=int, default=3, help="Previous boot environments to keep."
+    )
+
+    subparser = subparsers.add_parser("cache", help=run_cache.__doc__)
+    subparser.add_argument("cache_dir", type=Path, help="Directory of the cache.")
+    subparser.add_argument(
+        "--key-file",
+        type=Path,
+        required=True,
+        help="Secret signing key, generated with a .pub next to it if missing.",
+    )
+    subparser.add_argument("--key-name", help="Name of a generated key.")
+    subparser.add_argument(
+        "--system",
+        type=Path,
+        default=Path("/run/current-system"),
+        help="System to copy (default: /run/current-system).",
+    )
+    subparser.set_defaults(func=run_cache)
+
+    subparser = subparsers.add_parser("simulate", help=run_simulate.__doc__)
+    subparser.add_argument("trace_file", type=Path, help="Trace recorded by --trace.")
+    subparser.add_argument(
+        "--jobs",
+        type=_positive_int,
+        nargs="+",
+        default=[1, 2, 4, 8],
+        help="Commands run at once (default: 1 2 4 8).",
+    )
+    subparser.add_argument(
+        "--disks",
+        type=_positive_int,
+        nargs="+",
+        help="Disk counts (default: as recorded).",
+    )
+    subparser.add_argument(
+        "--deps",
+        type=Path,
+        help='JSON list of extra dependencies {"after": regex, "before": regex}.',
+    )
+    subparser.set_defaults(func=run_simulate)
+
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    try:
+        _run(args)
+    except KeyboardInterrupt:
+        sys.exit("Aborted")
+
+
+def _run(args: argparse.Namespace):
+    if args.trace is None:
+        args.func(args)
+        return
+
+    # pylint: disable=import-outside-toplevel
+    from pybootstrap import trace
+
+    with trace.Recorder(args.trace) as recorder:
+        recorder.stage = args.func.__name__.removeprefix("run_")
+        args.func(args)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,149 @@
+"""A module for planning partition sizes across the selected disks.
+
+Every disk gets the same partition sizes so that the vdevs are built
+from equally sized members. The root partition is sized to fit the
+smallest disk, minus a headroom reserved so that a slightly smaller
+replacement drive still fits, and the layout is validated against the
+real disk sizes before any disk is touched.
+"""
+import os
+from pathlib import Path
+from typing import Dict, List, NamedTuple
+
+GIB = 1024**3
+# The first MiB is left for alignment (and the BIOS boot partition of
+# grub), the backup GPT and alignment slack take up to another MiB.
+GPT_OVERHEAD = 2 * 1024**2
+MIN_ROOT_GIB = 8
+TOPOLOGIES = ("", "mirror", "raidz1", "raidz2", "raidz3")
+PARITY = {"raidz1": 1, "raidz2": 2, "raidz3": 3}
+MIN_VDEV_DISKS = {"": 1, "mirror": 2, "raidz1": 2, "raidz2": 3, "raidz3": 4}
+
+
+class DiskLayout(NamedTuple):
+    """The partition sizes of every disk in GiB."""
+
+    esp: int
+    boot: int
+    swap: int
+    root: int
+
+    @property
+    def total(self) -> int:
+        """The space taken by the partitions in bytes."""
+        return (self.esp + self.boot + self.swap + self.root) * GIB + GPT_OVERHEAD
+
+
+def get_disk_sizes(disks: List[str]) -> Dict[str, int]:
+    """Reads the size of each disk from sysfs.
+
+    Args:
+        disks: The disks by id.
+
+    Returns:
+        A mapping of disk to size in bytes.
+    """
+    sizes = {}
+    for disk in disks:
+        kname = Path(os.path.realpath(disk)).name
+        sectors = Path(f"/sys/class/block/{kname}/size").read_text(encoding="UTF-8")
+        sizes[disk] = int(sectors) * 512
+    return sizes
+
+
+def get_root_size(
+    disk_sizes: Dict[str, int], esp: int, boot: int, swap: int, headroom: float
+) -> int:
+    """Returns the largest root partition that fits every disk.
+
+    Args:
+        disk_sizes: A mapping of disk to size in bytes.
+        esp: The ESP size in GiB.
+        boot: The boot pool partition size in GiB.
+        swap: The swap partition size in GiB.
+        headroom: The fraction of the smallest disk left unpartitioned.
+
+    Returns:
+        The root partition size in whole GiB.
+    """
+    smallest = min(disk_sizes.values())
+    fixed = DiskLayout(esp=esp, boot=boot, swap=swap, root=0).total
+    return int((smallest * (1 - headroom) - fixed) // GIB)
+
+
+def get_pool_capacity(
+    num_disks: int, root: int, topology: str, vdev_width: int = 0
+) -> int:
+    """Returns the usable capacity of the root pool in GiB.
+
+    The capacity ignores metadata, padding and the slop space reserved
+    by ZFS, so it is an upper bound.
+
+    Raises:
+        ValueError: If the topology cannot be built from the disks.
+    """
+    width = vdev_width if vdev_width > 0 else num_disks
+    if num_disks % width != 0:
+        raise ValueError(f"{num_disks} disks cannot be split into vdevs of {width}.")
+    if width < MIN_VDEV_DISKS[topology]:
+        name = topology or "single"
+        raise ValueError(
+            f"A {name} vdev needs at least {MIN_VDEV_DISKS[topology]} disks."
+        )
+
+    vdevs = num_disks // width
+    match topology:
+        case "":
+            return num_disks * root
+        case "mirror":
+            return vdevs * root
+        case _:
+            return vdevs * (width - PARITY[topology]) * root
+
+
+def get_topology_capacities(num_disks: int, root: int) -> Dict[str, int]:
+    """Returns the usable capacity of every topology the disks allow."""
+    capacities = {}
+    for topology in TOPOLOGIES:
+        try:
+            capacities[topology] = get_pool_capacity(
+                num_disks=num_disks, root=root, topology=topology
+            )
+        except ValueError:
+            continue
+    return capacities
+
+
+def validate_layout(
+    disk_sizes: Dict[str, int],
+    layout: DiskLayout,
+    topology: str,
+    vdev_width: int = 0,
+) -> None:
+    """Checks that the partitions fit every disk and form the topology.
+
+    Args:
+        disk_sizes: A mapping of disk to size in bytes.
+        layout: The partition sizes; a root of 0 fills each disk.
+        topology: The vdev topology of the root pool.
+        vdev_width: The number of disks per vdev, 0 for a single vdev.
+
+    Raises:
+        ValueError: If the layout cannot be created.
+    """
+    min_layout = layout._replace(root=layout.root or MIN_ROOT_GIB)
+    for disk, size in disk_sizes.items():
+        if min_layout.total > size:
+            raise ValueError(
+                f"The partitions need {min_layout.total / GIB:.1f} GiB, "
+                f"{disk} has {size / GIB:.1f} GiB."
+            )
+    if 0 < layout.root < MIN_ROOT_GIB:
+        raise ValueError(f"The root partition needs at least {MIN_ROOT_GIB} GiB.")
+
+    get_pool_capacity(
+        num_disks=len(disk_sizes),
+        root=layout.root,
+        topology=topology,
+        vdev_width=vdev_width,
+    )
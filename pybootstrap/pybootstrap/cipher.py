@@ -0,0 +1,112 @@
+"""A module for picking the fastest ZFS encryption cipher on this host.
+
+The in-kernel AEAD implementations of AES-GCM and AES-CCM are
+benchmarked through the kernel crypto API (`AF_ALG` sockets). When the
+crypto API is not reachable from user space, the CPU flags are used to
+decide whether GCM's GHASH is hardware accelerated.
+"""
+import os
+import socket
+import time
+from typing import Dict, Optional
+
+BENCH_SECONDS = 0.2
+BENCH_BLOCK_SIZE = 128 * 1024
+AUTH_TAG_SIZE = 16
+CCM_NONCE_SIZE = 12
+GCM_IV_SIZE = 12
+
+
+def get_fastest_cipher(key_bits: int = 256) -> str:
+    """Returns the fastest ZFS `encryption` value for this host.
+
+    Args:
+        key_bits: The AES key length (128, 192 or 256).
+
+    Returns:
+        Either `aes-<key_bits>-gcm` or `aes-<key_bits>-ccm`.
+    """
+    speeds = benchmark_ciphers(key_bits=key_bits)
+    if speeds:
+        mode = max(speeds, key=speeds.get)
+    else:
+        mode = "gcm" if has_accelerated_ghash() else "ccm"
+
+    return f"aes-{key_bits}-{mode}"
+
+
+def benchmark_ciphers(key_bits: int = 256) -> Dict[str, float]:
+    """Measures the in-kernel AES-GCM and AES-CCM encryption throughput.
+
+    Args:
+        key_bits: The AES key length (128, 192 or 256).
+
+    Returns:
+        A mapping of mode to MB/s, empty if `AF_ALG` is unavailable.
+    """
+    # ccm(aes) takes a 16 byte IV whose first byte is L' = 15 - nonce - 1
+    ivs = {
+        "gcm": os.urandom(GCM_IV_SIZE),
+        "ccm": bytes([15 - CCM_NONCE_SIZE - 1]) + os.urandom(15),
+    }
+
+    speeds = {}
+    for mode, iv in ivs.items():
+        key = os.urandom(key_bits // 8)
+        speed = benchmark_aead(name=f"{mode}(aes)", key=key, iv=iv)
+        if speed is None:
+            return {}
+        speeds[mode] = speed
+    return speeds
+
+
+def benchmark_aead(name: str, key: bytes, iv: bytes) -> Optional[float]:
+    """Encrypts zero blocks through an `AF_ALG` AEAD socket.
+
+    Args:
+        name: The kernel crypto API algorithm name.
+        key: The encryption key.
+        iv: The initialization vector.
+
+    Returns:
+        The throughput in MB/s, or None if the algorithm is unavailable.
+    """
+    try:
+        with socket.socket(socket.AF_ALG, socket.SOCK_SEQPACKET, 0) as alg:
+            alg.bind(("aead", name))
+            alg.setsockopt(socket.SOL_ALG, socket.ALG_SET_KEY, key)
+            alg.setsockopt(
+                socket.SOL_ALG, socket.ALG_SET_AEAD_AUTHSIZE, None, AUTH_TAG_SIZE
+            )
+            op, _ = alg.accept()
+            with op:
+                data = bytes(BENCH_BLOCK_SIZE)
+                done = 0
+                start = time.perf_counter()
+                while time.perf_counter() - start < BENCH_SECONDS:
+                    op.sendmsg_afalg(
+                        [data], op=socket.ALG_OP_ENCRYPT, iv=iv, assoclen=0
+                    )
+                    op.recv(BENCH_BLOCK_SIZE + AUTH_TAG_SIZE)
+                    done += BENCH_BLOCK_SIZE
+                elapsed = time.perf_counter() - start
+    except (AttributeError, OSError):
+        return None
+
+    return done / elapsed / 1e6
+
+
+def has_accelerated_ghash() -> bool:
+    """Checks the CPU flags for carry-less multiplication support."""
+    try:
+        with open("/proc/cpuinfo", "r", encoding="UTF-8") as file:
+            flags = set(file.read().split())
+    except OSError:
+        return True
+
+    return bool(flags & {"pclmulqdq", "pmull"})
+
+
+if __name__ == "__main__":
+    print(benchmark_ciphers())
+    print(get_fastest_cipher())
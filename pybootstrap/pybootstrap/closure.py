@@ -0,0 +1,117 @@
+"""A module for evaluating the NixOS system closure ahead of the install.
+
+A minimal configuration with the chosen bootloader and ZFS support is
+instantiated and dry-run realised, which tells how many store paths the
+install is going to build and fetch.
+"""
+import re
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional, Tuple
+
+from pybootstrap import trace
+
+FETCH_REGEX = re.compile(
+    r"these (\d+) paths will be fetched \(([\d.]+) MiB download", re.MULTILINE
+)
+BUILD_REGEX = re.compile(r"these (\d+) derivations will be built", re.MULTILINE)
+
+BOOTLOADER_CONFIGS = {
+    "grub": """
+    boot.loader.grub.enable = true;
+    boot.loader.grub.efiSupport = true;
+    boot.loader.grub.zfsSupport = true;
+    boot.loader.grub.devices = [ "nodev" ];
+    """,
+    "systemd-boot": """
+    boot.loader.systemd-boot.enable = true;
+    """,
+}
+
+
+class ClosureEstimate(NamedTuple):
+    """What realising a system closure is going to cost."""
+
+    drv_path: str
+    builds: int
+    fetches: int
+    download_mib: float
+
+
+def evaluate_closure(
+    bootloader: str, cancelled: Optional[threading.Event] = None
+) -> Optional[ClosureEstimate]:
+    """Instantiates a minimal NixOS-on-ZFS system and dry-runs it.
+
+    Args:
+        bootloader: The name of the bootloader.
+        cancelled: Kills the running nix command when set.
+
+    Returns:
+        The closure estimate, or None if cancelled.
+    """
+    nix_config = "\n".join(
+        [
+            "{ ... }: {",
+            '  boot.supportedFilesystems = [ "zfs" ];',
+            '  networking.hostId = "00000000";',
+            '  fileSystems."/".device = "rpool/nixos/ROOT/default";',
+            '  fileSystems."/".fsType = "zfs";',
+            BOOTLOADER_CONFIGS[bootloader],
+            "}",
+        ]
+    )
+
+    with tempfile.TemporaryDirectory(prefix="pybootstrap-") as tmp_dir:
+        config_path = Path(tmp_dir) / "configuration.nix"
+        config_path.write_text(nix_config, encoding="UTF-8")
+
+        instantiate = _run(
+            "nix-instantiate <nixpkgs/nixos> -A system "
+            f"-I nixos-config={config_path}",
+            cancelled=cancelled,
+        )
+        if instantiate is None:
+            return None
+        drv_path = instantiate[0].strip().splitlines()[-1]
+
+        dry_run = _run(f"nix-store --realise --dry-run {drv_path}", cancelled=cancelled)
+        if dry_run is None:
+            return None
+        dry_run = "".join(dry_run)
+
+    fetch = FETCH_REGEX.search(dry_run)
+    build = BUILD_REGEX.search(dry_run)
+    return ClosureEstimate(
+        drv_path=drv_path,
+        builds=int(build.group(1)) if build else 0,
+        fetches=int(fetch.group(1)) if fetch else 0,
+        download_mib=float(fetch.group(2)) if fetch else 0.0,
+    )
+
+
+def _run(cmd: str, cancelled: Optional[threading.Event]) -> Optional[Tuple[str, str]]:
+    """Runs a command, killing it if `cancelled` gets set.
+
+    Returns:
+        The stdout and stderr, or None if the command was cancelled.
+    """
+    with trace.span(cmd) as result, subprocess.Popen(
+        cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+    ) as process:
+        while True:
+            try:
+                output = process.communicate(timeout=0.2)
+                break
+            except subprocess.TimeoutExpired:
+                if cancelled is not None and cancelled.is_set():
+                    process.kill()
+                    process.communicate()
+                    return None
+        result["returncode"] = process.returncode
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output)
+    return output
@@ -0,0 +1,221 @@
+"""A module for choosing a dataset compression algorithm from real data.
+
+Files are sampled from a directory tree (the live ISO's `/nix/store` by
+default) and concatenated into a corpus. The corpus is benchmarked with
+the `lz4` and `zstd` command line tools, which compress it in
+independent recordsize-sized blocks just like ZFS does. Every benchmark
+runs single threaded and, by default, one at a time, so the reported
+speeds are per core.
+"""
+import os
+import random
+import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+from pybootstrap import trace
+
+SAMPLE_ENTRIES = 64
+ZSTD_LEVELS = range(1, 20)
+ZSTD_FAST_LEVELS = (1, 2, 3, 4, 5, 10, 20, 50, 100, 500, 1000)
+BENCH_REGEX = re.compile(
+    r"(\d+)\s*->\s*(\d+)\s*\(x?([\d.]+)\)\s*,\s*([\d.]+)\s*MB/s\s*,\s*([\d.]+)\s*MB/s"
+)
+
+
+class CompressionResult(NamedTuple):
+    """Benchmark result of a single compression setting."""
+
+    compression: str
+    ratio: float
+    compress_mbps: float
+    decompress_mbps: float
+
+
+def advise(
+    path: Path = Path("/nix/store"),
+    recordsize: int = 128 * 1024,
+    sample_size: int = 256 * 1024**2,
+    min_speed: float = 150.0,
+    jobs: int = 1,
+) -> str:
+    """Samples data, benchmarks it and prints a report.
+
+    Args:
+        path: The directory tree to sample files from.
+        recordsize: The block size to compress independently.
+        sample_size: The total number of bytes to sample.
+        min_speed: The minimum compression speed in MB/s per core.
+        jobs: The number of benchmarks to run in parallel. Parallel
+            benchmarks compete for cores and caches, which lowers the
+            reported speeds.
+
+    Returns:
+        The recommended value for the `compression` property.
+    """
+    if jobs > 1:
+        print(f"Running {jobs} benchmarks in parallel; speeds are understated")
+    with tempfile.TemporaryDirectory(prefix="pybootstrap-") as tmp_dir:
+        corpus = Path(tmp_dir) / "corpus"
+        sampled = sample_files(path=path, corpus=corpus, sample_size=sample_size)
+        print(f"Sampled {sampled / 1024**2:.1f} MiB from {path}")
+        results = benchmark(corpus=corpus, recordsize=recordsize, jobs=jobs)
+
+    if not results:
+        print("Neither the lz4 nor the zstd command line tool is installed")
+    print(tabulate_results(results))
+    recommended = recommend(results=results, min_speed=min_speed)
+    print(f"Recommended compression: {recommended}")
+    return recommended
+
+
+def sample_files(path: Path, corpus: Path, sample_size: int) -> int:
+    """Copies randomly chosen files from a directory tree into a corpus.
+
+    The top level entries are shuffled and walked in parallel until the
+    requested number of bytes has been collected.
+
+    Args:
+        path: The directory tree to sample files from.
+        corpus: The corpus file to write.
+        sample_size: The total number of bytes to sample.
+
+    Returns:
+        The number of bytes written to the corpus.
+    """
+    entries = [Path(path) / entry for entry in os.listdir(path)]
+    random.shuffle(entries)
+    entry_limit = max(sample_size // SAMPLE_ENTRIES, 1)
+
+    def read_entry(entry: Path) -> bytes:
+        chunks = []
+        remaining = entry_limit
+        for file_path in walk_files(entry):
+            try:
+                with open(file_path, "rb") as file:
+                    chunks.append(file.read(remaining))
+            except OSError:
+                continue
+            remaining -= len(chunks[-1])
+            if remaining <= 0:
+                break
+        return b"".join(chunks)
+
+    written = 0
+    workers = os.cpu_count() or 1
+    batch_size = 4 * workers
+    with open(corpus, "wb") as out, ThreadPoolExecutor(workers) as executor:
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start : start + batch_size]
+            for data in executor.map(read_entry, batch):
+                out.write(data[: sample_size - written])
+                written = min(written + len(data), sample_size)
+            if written >= sample_size:
+                break
+    return written
+
+
+def walk_files(path: Path) -> List[Path]:
+    """Lists the regular files below a path without following links."""
+    if path.is_file() and not path.is_symlink():
+        return [path]
+
+    files = []
+    for root, _, names in os.walk(path):
+        for name in names:
+            file_path = Path(root) / name
+            if file_path.is_file() and not file_path.is_symlink():
+                files.append(file_path)
+    return files
+
+
+def get_benchmark_commands(corpus: Path, recordsize: int) -> List[Tuple[str, str]]:
+    """Returns the benchmark command for every compression setting."""
+    commands = []
+    if shutil.which("lz4"):
+        commands.append(("lz4", f"lz4 -q -i1 -B{recordsize} -b1 {corpus}"))
+
+    if not shutil.which("zstd"):
+        return commands
+
+    zstd = f"zstd -q -T1 -i1 -B{recordsize}"
+    for level in ZSTD_FAST_LEVELS:
+        commands.append((f"zstd-fast-{level}", f"{zstd} --fast={level} -b {corpus}"))
+    for level in ZSTD_LEVELS:
+        commands.append((f"zstd-{level}", f"{zstd} -b{level} {corpus}"))
+
+    return commands
+
+
+def benchmark(corpus: Path, recordsize: int, jobs: int = 1) -> List[CompressionResult]:
+    """Benchmarks every compression setting against a corpus.
+
+    Args:
+        corpus: The corpus file to compress.
+        recordsize: The block size to compress independently.
+        jobs: The number of benchmarks to run in parallel.
+
+    Returns:
+        A list of benchmark results.
+    """
+    commands = get_benchmark_commands(corpus=corpus, recordsize=recordsize)
+
+    def run(command: Tuple[str, str]) -> Optional[CompressionResult]:
+        name, cmd = command
+        process = trace.run(cmd.split(), capture_output=True, text=True, check=True)
+        return parse_benchmark(name=name, output=process.stdout + process.stderr)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(run, commands))
+
+    return [result for result in results if result is not None]
+
+
+def parse_benchmark(name: str, output: str) -> Optional[CompressionResult]:
+    """Parses the last result line of an `lz4 -b` or `zstd -b` run."""
+    matches = BENCH_REGEX.findall(output)
+    if not matches:
+        return None
+
+    _, _, ratio, compress_mbps, decompress_mbps = matches[-1]
+    return CompressionResult(
+        compression=name,
+        ratio=float(ratio),
+        compress_mbps=float(compress_mbps),
+        decompress_mbps=float(decompress_mbps),
+    )
+
+
+def recommend(results: List[CompressionResult], min_speed: float) -> str:
+    """Picks the best ratio among the settings that are fast enough.
+
+    Args:
+        results: A list of benchmark results.
+        min_speed: The minimum compression speed in MB/s per core.
+
+    Returns:
+        The recommended value for the `compression` property.
+    """
+    fast_enough = [res for res in results if res.compress_mbps >= min_speed]
+    if not fast_enough:
+        return "lz4"
+    best = max(fast_enough, key=lambda res: (res.ratio, res.compress_mbps))
+    return best.compression
+
+
+def tabulate_results(results: List[CompressionResult]) -> str:
+    """Formats benchmark results as a table sorted by ratio."""
+    header = f"{'compression':>14}{'ratio':>9}{'MB/s/core':>12}{'decomp':>10}"
+    rows = [
+        f"{res.compression:>14}{res.ratio:>9.3f}"
+        f"{res.compress_mbps:>12.1f}{res.decompress_mbps:>10.1f}"
+        for res in sorted(results, key=lambda res: res.ratio)
+    ]
+    return "\n".join([header] + rows)
+
+
+if __name__ == "__main__":
+    advise()
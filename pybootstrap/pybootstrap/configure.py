@@ -1,13 +1,27 @@
 """A module for configure NixOS root on ZFS nix files."""
+import hashlib
 import re
-import subprocess
 from functools import partial
 from pathlib import Path
-from typing import List
-
-import questionary
-
-from pybootstrap.prepare import ZfsSystemConfig
+from typing import List, Tuple
+
+from pybootstrap import keyfile, trace
+from pybootstrap.nixsettings import get_nix_settings
+from pybootstrap.partition import (
+    SCRATCH_MOUNTPOINT,
+    uses_state_key,
+)
+from pybootstrap.prepare import (
+    ZfsSystemConfig,
+    get_pools,
+    has_bpool,
+    has_swap_partition,
+)
+from pybootstrap.substituters import get_nix_config
+
+SCOPED_DEV_NODES = "/dev/disk/zpool"
+# the ESP space planned per generation when the kernels are on the ESP
+ESP_GENERATION_MIB = 128
 
 
 def configure(config: ZfsSystemConfig):
@@ -15,6 +29,7 @@ def configure(config: ZfsSystemConfig):
     generate_system_config()
     update_config_imports(config=config)
     add_experimental_features_to_configuration(config=config)
+    add_nix_settings_to_configuration(config=config)
     enable_network_manager(config=config)
     remove_systemd_boot_refs(config=config)
     update_hardware_config(config=config)
@@ -23,7 +38,7 @@ def configure(config: ZfsSystemConfig):
 
 def generate_system_config():
     """Auto-generates the NixOS system configuration files."""
-    subprocess.run("nixos-generate-config --root /mnt".split(), check=True)
+    trace.run("nixos-generate-config --root /mnt".split(), check=True)
 
 
 def update_config_imports(config: ZfsSystemConfig):
@@ -63,6 +78,24 @@ def add_experimental_features_to_configuration(config: ZfsSystemConfig) -> None:
         file.write(configuration)
 
 
+def add_nix_settings_to_configuration(config: ZfsSystemConfig) -> None:
+    """Add build parallelism sized to the CPU count and memory of the host
+    and trust the keys of the planned binary caches."""
+
+    config_file = config.nixos.path / config.nixos.config
+
+    with open(config_file, "r", encoding="UTF-8") as file:
+        configuration = file.read()
+
+    regex_seq = re.compile(r"(  nix.settings.experimental-features = .*;\n)")
+    lines = [*get_nix_settings().to_nix(), *get_nix_config(config.cache)]
+    settings = "".join(f"  {line}\n" for line in lines)
+    configuration = regex_seq.sub(lambda seq: seq.group(1) + settings, configuration)
+
+    with open(config_file, "w", encoding="UTF-8") as file:
+        file.write(configuration)
+
+
 def enable_network_manager(config: ZfsSystemConfig) -> None:
     """Add nix-command and flakes to nix so NixOS is flake ready."""
 
@@ -109,7 +142,7 @@ def update_hardware_config(config: ZfsSystemConfig):
 
     newlines = list(map(hardware_config_replace, lines))
 
-    if config.part.swap not in ("", "0"):
+    if has_swap_partition(config=config):
         newlines = [line for line in newlines if "swapDevices" not in line]
 
     with open(new_path, "w", encoding="UTF-8") as file:
@@ -152,20 +185,209 @@ def update_zfs_nix_file(config: ZfsSystemConfig):
     )
     newlines = list(map(nix_replace, newlines))
 
-    if config.part.swap in ("", "0"):
-        newlines = [line for line in newlines if "swapDevices" not in line]
-    else:
+    if has_swap_partition(config=config):
         swap_list = [
             f'{{ device = "{disk}-part4"; randomEncryption.enable = true; }}'
             for disk in config.zfs.disks
         ]
         swaps = "\n    " + "\n    ".join(swap_list) + "\n  "
         newlines = [line.replace("SWAP_DEVICES", swaps) for line in newlines]
+    else:
+        newlines = [line for line in newlines if "swapDevices" not in line]
+
+    if config.zfs.scoped_dev_nodes:
+        rules = get_dev_node_rules(config=config)
+        newlines = [line.replace("#DEV_NODE_RULES", rules) for line in newlines]
+    else:
+        newlines = [line for line in newlines if "#DEV_NODE_RULES" not in line]
+
+    if config.data.disks:
+        data_pool = f'boot.zfs.extraPools = [ "{config.data.name}" ];'
+        newlines = [line.replace("#DATA_POOL", data_pool) for line in newlines]
+    else:
+        newlines = [line for line in newlines if "#DATA_POOL" not in line]
+
+    if uses_state_key(config=config):
+        key_file = get_key_file_nix_config()
+        newlines = [line.replace("#KEY_FILE", key_file) for line in newlines]
+    else:
+        newlines = [line for line in newlines if "#KEY_FILE" not in line]
+
+    swap_config = get_swap_nix_config(config=config)
+    if swap_config:
+        newlines = [line.replace("#SWAP_CONFIG", swap_config) for line in newlines]
+    else:
+        newlines = [line for line in newlines if "#SWAP_CONFIG" not in line]
+
+    services = get_services_nix_config(config=config, host_id=host_id)
+    if services:
+        newlines = [line.replace("  #SERVICES\n", services) for line in newlines]
+    else:
+        newlines = [line for line in newlines if "#SERVICES" not in line]
 
     with open(new_path, "w", encoding="UTF-8") as file:
         file.writelines(newlines)
 
 
+def get_services_nix_config(config: ZfsSystemConfig, host_id: str) -> str:
+    """Returns the NixOS configuration of the enabled optional services."""
+    services = []
+    if config.zfs.scratch == "persistent":
+        services.append(
+            "  systemd.services.nix-daemon.environment.TMPDIR = "
+            f'"{SCRATCH_MOUNTPOINT}";\n'
+        )
+    if config.services.arc_warmup:
+        services.append(
+            read_nix_template(name="arc-warmup-service")
+            .replace("ARC_WARMUP_PERCENT", str(config.services.arc_warmup_percent))
+            .replace("ARC_WARMUP_JOBS", str(config.services.arc_warmup_jobs))
+        )
+    if len(config.zfs.disks) > 1:
+        services.append(
+            read_nix_template(name="esp-sync").replace(
+                "PRIMARY_DISK", str(Path(config.zfs.primary_disk).name)
+            )
+        )
+    if config.services.maintenance.enable:
+        services.append(get_maintenance_nix_config(config=config, host_id=host_id))
+    if config.services.metrics:
+        services.append(
+            read_nix_template(name="zfs-metrics")
+            .replace("METRICS_DIR", config.services.metrics_dir)
+            .replace("METRICS_INTERVAL", str(config.services.metrics_interval))
+        )
+    return "".join(services)
+
+
+def get_maintenance_nix_config(config: ZfsSystemConfig, host_id: str) -> str:
+    """Returns the scrub, trim and snapshot settings staggered by host id.
+
+    The monthly scrub gets a day of the month from 1 to 28 and the weekly
+    trim a day of the week, both with a start time in the night window.
+    """
+    maintenance = config.services.maintenance
+
+    def night_time(minute: int) -> str:
+        start = maintenance.night_start * 60 + minute % (maintenance.night_hours * 60)
+        return f"{start // 60 % 24:02d}:{start % 60:02d}:00"
+
+    day, minute = get_stagger(host_id=host_id, salt="scrub", slots=28)
+    scrub_interval = f"*-*-{day + 1:02d} {night_time(minute)}"
+    weekday, minute = get_stagger(host_id=host_id, salt="trim", slots=7)
+    weekdays = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+    trim_interval = f"{weekdays[weekday]} {night_time(minute)}"
+
+    replacements = {
+        "SCRUB_INTERVAL": scrub_interval,
+        "TRIM_INTERVAL": trim_interval,
+        "BUSINESS_START": str(maintenance.business_start),
+        "BUSINESS_END": str(maintenance.business_end),
+        "SCAN_VDEV_LIMIT": str(maintenance.scan_vdev_limit_mib * 1024**2),
+        "SNAPSHOTS_FREQUENT": str(maintenance.snapshots_frequent),
+        "SNAPSHOTS_HOURLY": str(maintenance.snapshots_hourly),
+        "SNAPSHOTS_DAILY": str(maintenance.snapshots_daily),
+        "SNAPSHOTS_WEEKLY": str(maintenance.snapshots_weekly),
+        "SNAPSHOTS_MONTHLY": str(maintenance.snapshots_monthly),
+    }
+    template = read_nix_template(name="zfs-maintenance")
+    for keyword, value in replacements.items():
+        template = template.replace(keyword, value)
+    return template
+
+
+def get_stagger(host_id: str, salt: str, slots: int) -> Tuple[int, int]:
+    """Spreads hosts evenly over slots by hashing their host id.
+
+    Args:
+        host_id: The host id.
+        salt: Distinguishes the schedules of one host.
+        slots: The number of slots, e.g. days.
+
+    Returns:
+        The slot and a minute offset of the host.
+    """
+    digest = hashlib.sha256(f"{salt}:{host_id}".encode()).digest()
+    value = int.from_bytes(digest, "big")
+    slot, rest = value % slots, value // slots
+    return slot, rest % (24 * 60)
+
+
+def read_nix_template(name: str) -> str:
+    """Reads a nix snippet from the files directory."""
+    with open(Path(__file__).parent / "files" / name, "r", encoding="UTF-8") as file:
+        return file.read()
+
+
+def get_dev_node_rules(config: ZfsSystemConfig) -> str:
+    """Returns udev rules that link the pool members into a directory.
+
+    Pools are imported by scanning `boot.zfs.devNodes`. Pointing it at a
+    directory that only holds the pool members avoids probing every
+    other device on the host at boot. Members are matched by the pool
+    GUID blkid reads from their ZFS label, so a disk added by `zpool
+    replace` or `zpool attach` is linked without regenerating the rules.
+    """
+    link_dir = Path(SCOPED_DEV_NODES).relative_to("/dev")
+    rules = []
+    for pool in get_pools(config=config):
+        process = trace.run(
+            f"zpool get -H -o value guid {pool}".split(),
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        pool_guid = process.stdout.strip()
+        rules.append(
+            f'ENV{{ID_FS_TYPE}}=="zfs_member", ENV{{ID_FS_UUID}}=="{pool_guid}", '
+            f'SYMLINK+="{link_dir}/%k"'
+        )
+
+    rules_text = "\n    ".join(rules)
+    rules_file = "$out/99-zpool-members.rules"
+    echo_rules = "\n    ".join(f"echo '{rule}' >> {rules_file}" for rule in rules)
+    return "\n  ".join(
+        [
+            f"services.udev.extraRules = ''\n    {rules_text}\n  '';",
+            f"boot.initrd.services.udev.rules = ''\n    {rules_text}\n  '';",
+            f"boot.initrd.extraUdevRulesCommands = ''\n    {echo_rules}\n  '';",
+        ]
+    )
+
+
+def get_key_file_nix_config() -> str:
+    """Returns the settings that make the key file in the state dataset
+    available to the import of the data pool.
+
+    The state dataset is mounted in the initrd, right after the root
+    pool is unlocked; the key itself never goes into the initrd.
+    """
+    state = keyfile.STATE_KEY_FILE.parents[2]
+    return f'fileSystems."{state}".neededForBoot = true;'
+
+
+def get_swap_nix_config(config: ZfsSystemConfig) -> str:
+    """Returns the zram and swappiness settings for the zfs.nix file."""
+    swap = config.swap
+    settings = []
+
+    if swap.strategy == "zram":
+        settings.extend(
+            [
+                "zramSwap.enable = true;",
+                f'zramSwap.algorithm = "{swap.zram_algorithm}";',
+                f"zramSwap.memoryPercent = {swap.zram_percent};",
+            ]
+        )
+        if swap.writeback_device:
+            settings.append(f'zramSwap.writebackDevice = "{swap.writeback_device}";')
+
+    if swap.strategy != "none" and swap.swappiness is not None:
+        settings.append(f'boot.kernel.sysctl."vm.swappiness" = {swap.swappiness};')
+
+    return "\n  ".join(settings)
+
+
 def update_zfs_nix_bootloader(lines: List[str], config: ZfsSystemConfig) -> List[str]:
     """Replace the bootloader keyword with the bootloader config."""
     match config.bootloader.name:
@@ -180,6 +402,12 @@ def update_zfs_nix_bootloader(lines: List[str], config: ZfsSystemConfig) -> List
 
     with open(config_file_path, "r", encoding="UTF-8") as file:
         bootloader_config = file.read()
+    if not has_bpool(config=config):
+        # keep the kernels and initrds of old generations from filling the ESP
+        limit = max(int(config.part.esp) * 1024 // ESP_GENERATION_MIB, 2)
+        bootloader_config += (
+            f"  boot.loader.systemd-boot.configurationLimit = {limit};\n"
+        )
 
     single_string = "".join(lines)
     new_string = single_string.replace("  #BOOT_LOADER", bootloader_config)
@@ -192,7 +420,10 @@ def zfs_nix_replace(
 ) -> str:
     """Performs the string keyword replacements for the zfs.nix file."""
     line = line.replace("HOST_ID", host_id)
-    line = line.replace("DEV_NODES", str(Path(config.zfs.primary_disk).parent))
+    dev_nodes = str(Path(config.zfs.primary_disk).parent)
+    if config.zfs.scoped_dev_nodes:
+        dev_nodes = SCOPED_DEV_NODES
+    line = line.replace("DEV_NODES", dev_nodes)
     line = line.replace("PRIMARY_DISK", str(Path(config.zfs.primary_disk).name))
 
     disks = [f'"{disk}"' for disk in config.zfs.disks]
@@ -205,13 +436,16 @@ def zfs_nix_replace(
 
 def get_initial_hashed_pw() -> str:
     """Gets an initial password hash."""
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
     while True:
         password = questionary.password(message="Enter an initial root password.").ask()
 
         if password:
             break
 
-    process = subprocess.run(
+    process = trace.run(
         f"mkpasswd -m SHA-512 {password}".split(),
         capture_output=True,
         text=True,
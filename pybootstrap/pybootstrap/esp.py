@@ -0,0 +1,152 @@
+"""A module for creating the EFI system partitions of all disks at once.
+
+Only the ESP of the primary disk is formatted. The FAT metadata of that
+canonical ESP (reserved sectors, FATs and root directory) is then copied
+in the kernel to the first partition of the other disks, in parallel,
+and every clone gets a volume ID of its own so the ESPs stay apart in
+`/dev/disk/by-uuid`. Nothing but the metadata has to be copied since
+the new file system is empty.
+"""
+import errno
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple
+
+from pybootstrap import trace
+
+ESP_ROOT = Path("/mnt/boot/efis")
+FALLBACK_ERRNOS = (errno.EINVAL, errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP)
+
+
+class FatGeometry(NamedTuple):
+    """The layout of a FAT file system read from its boot sector."""
+
+    bytes_per_sector: int
+    sectors_per_cluster: int
+    reserved_sectors: int
+    num_fats: int
+    root_entries: int
+    fat_sectors: int
+    fat32: bool
+    backup_boot_sector: int
+
+    @property
+    def metadata_size(self) -> int:
+        """The bytes up to the end of the root directory."""
+        sectors = self.reserved_sectors + self.num_fats * self.fat_sectors
+        size = sectors * self.bytes_per_sector + self.root_entries * 32
+        if self.fat32:
+            # the root directory is the first cluster of the data region
+            size += self.sectors_per_cluster * self.bytes_per_sector
+        return size
+
+    @property
+    def volume_id_offsets(self) -> List[int]:
+        """The offsets of the volume ID in the boot sector and its backup."""
+        if not self.fat32:
+            return [0x27]
+        offsets = [0x43]
+        if self.backup_boot_sector:
+            offsets.append(self.backup_boot_sector * self.bytes_per_sector + 0x43)
+        return offsets
+
+
+def read_geometry(boot_sector: bytes) -> FatGeometry:
+    """Parses the BIOS parameter block of a FAT boot sector.
+
+    Raises:
+        ValueError: If the sector is not a FAT boot sector.
+    """
+    if boot_sector[510:512] != b"\x55\xaa":
+        raise ValueError("Not a FAT boot sector.")
+
+    def read(offset: int, length: int) -> int:
+        return int.from_bytes(boot_sector[offset : offset + length], "little")
+
+    fat16_sectors = read(0x16, 2)
+    fat32 = fat16_sectors == 0
+    return FatGeometry(
+        bytes_per_sector=read(0x0B, 2),
+        sectors_per_cluster=read(0x0D, 1),
+        reserved_sectors=read(0x0E, 2),
+        num_fats=read(0x10, 1),
+        root_entries=read(0x11, 2),
+        fat_sectors=read(0x24, 4) if fat32 else fat16_sectors,
+        fat32=fat32,
+        backup_boot_sector=read(0x32, 2) if fat32 else 0,
+    )
+
+
+def create_esps(disks: List[str]) -> None:
+    """Formats the ESP of the first disk and clones it to the others.
+
+    Args:
+        disks: A list of disks by id, the primary disk first.
+    """
+    canonical = f"{disks[0]}-part1"
+    trace.run(f"mkfs.vfat -n EFI {canonical}".split(), check=True)
+
+    clones = [f"{disk}-part1" for disk in disks[1:]]
+    with ThreadPoolExecutor(max_workers=max(len(clones), 1)) as executor:
+        list(executor.map(lambda clone: clone_esp(canonical, clone), clones))
+    if clones:
+        trace.run("udevadm settle".split(), check=True)
+
+
+def clone_esp(source: str, target: str) -> None:
+    """Copies the FAT metadata of an ESP and gives it a new volume ID.
+
+    Raises:
+        ValueError: If the target partition is smaller than the source.
+    """
+    with open(source, "rb") as src, open(target, "r+b") as dst:
+        geometry = read_geometry(os.pread(src.fileno(), 512, 0))
+        if _size(dst.fileno()) < _size(src.fileno()):
+            raise ValueError(f"{target} is smaller than {source}.")
+
+        copy_range(src.fileno(), dst.fileno(), geometry.metadata_size)
+        volume_id = os.urandom(4)
+        for offset in geometry.volume_id_offsets:
+            os.pwrite(dst.fileno(), volume_id, offset)
+        os.fsync(dst.fileno())
+
+
+def copy_range(src_fd: int, dst_fd: int, length: int) -> None:
+    """Copies the first bytes of a file within the kernel.
+
+    `copy_file_range` is tried first; block devices usually reject it,
+    in which case `sendfile` does the copy.
+    """
+    offset = 0
+    try:
+        while offset < length:
+            copied = os.copy_file_range(
+                src_fd, dst_fd, length - offset, offset_src=offset, offset_dst=offset
+            )
+            if copied == 0:
+                break
+            offset += copied
+        return
+    except OSError as err:
+        if err.errno not in FALLBACK_ERRNOS:
+            raise
+
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while offset < length:
+        copied = os.sendfile(dst_fd, src_fd, offset, length - offset)
+        if copied == 0:
+            break
+        offset += copied
+
+
+def mount_esps(disks: List[str]) -> None:
+    """Mounts the ESP of every disk below /mnt/boot/efis."""
+    for disk in disks:
+        mountpoint = ESP_ROOT / f"{Path(disk).stem}-part1"
+        trace.run(f"mkdir -p {mountpoint}".split(), check=True)
+        trace.run(f"mount -t vfat {disk}-part1 {mountpoint}".split(), check=True)
+
+
+def _size(fd: int) -> int:
+    return os.lseek(fd, 0, os.SEEK_END)
@@ -1,13 +1,19 @@
 {
   config,
+  lib,
   pkgs,
   ...
 }: {
   boot.supportedFilesystems = ["zfs"];
   networking.hostId = "HOST_ID";
   boot.zfs.devNodes = "DEV_NODES";
+  #DEV_NODE_RULES
+  #DATA_POOL
+  #KEY_FILE
   boot.kernelPackages = config.boot.zfs.package.latestCompatibleLinuxPackages;
   swapDevices = [SWAP_DEVICES];
+  #SWAP_CONFIG
+  #SERVICES
   systemd.services.zfs-mount.enable = false;
   environment.etc."machine-id".source = "/state/etc/machine-id";
   environment.etc."zfs/zpool.cache".source = "/state/etc/zfs/zpool.cache";
@@ -1,29 +1,162 @@
 """A module for installing NixOS root on ZFS."""
-import subprocess
-from glob import glob
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Optional
 
-from pybootstrap.prepare import ZfsSystemConfig
+from pybootstrap import keyfile, progress, sampler, substituters, trace, verify
+from pybootstrap.nixsettings import get_nix_settings
+from pybootstrap.partition import SCRATCH_MOUNTPOINT
+from pybootstrap.prepare import (
+    ZfsSystemConfig,
+    get_pool_members,
+    get_pools,
+    has_bpool,
+)
+
+CACHEFILE = Path("/tmp/pybootstrap/zpool.cache")
+TARGET_CACHEFILE = Path("/mnt/state/etc/zfs/zpool.cache")
+LOG_DIR = Path("/mnt/state/pybootstrap")
 
 
 def install(config: ZfsSystemConfig):
-    rpool_id = f"rpool"
-    bpool_id = f"bpool"
+    """Installs NixOS into the mounted pools, verifies, snapshots and
+    exports them."""
+    snapshot(config=config, name="install_start")
 
-    rpool_nix = f"{rpool_id}/{config.zfs.os_id}"
-    bpool_nix = f"{bpool_id}/{config.zfs.os_id}"
+    nixos_install = "nixos-install -v --show-trace --no-root-passwd --root /mnt"
+    nixos_install = [
+        *nixos_install.split(),
+        *get_nix_settings().to_args(),
+        *substituters.get_install_args(config.cache),
+    ]
+    env = None
+    scratch_dir = mount_scratch(config=config)
+    if scratch_dir is not None:
+        # the builds follow TMPDIR; build-dir is unknown to older Nix
+        env = dict(os.environ, TMPDIR=str(scratch_dir))
+    with sampler.Sampler(pools=get_pools(config), log_dir=LOG_DIR) as pool_sampler:
+        result = progress.run(
+            nixos_install, log_path=LOG_DIR / "nixos-install.log.gz", env=env
+        )
+    print(f"nixos-install finished: {result}")
+    sampler.print_summary(pool_sampler.summary)
 
-    subprocess.run(f"zfs snapshot -r {rpool_nix}@install_start".split(), check=True)
-    subprocess.run(f"zfs snapshot -r {bpool_nix}@install_start".split(), check=True)
+    destroy_scratch(config=config)
+    verify.verify(config=config)
+    write_cachefile(config=config)
+    snapshot(config=config, name="install")
+    export(config=config)
+    measure_pool_import(config=config)
 
-    nixos_install = "nixos-install -v --show-trace --no-root-passwd --root /mnt"
-    subprocess.run(nixos_install.split(), check=True)
 
-    subprocess.run(f"zfs snapshot -r {rpool_nix}@install".split(), check=True)
-    subprocess.run(f"zfs snapshot -r {bpool_nix}@install".split(), check=True)
+def snapshot(config: ZfsSystemConfig, name: str):
+    """Recursively snapshots the OS datasets of the boot and root pools
+    and the `/nix` datasets next to them."""
+    rpool_nix = f"rpool/{config.zfs.os_id}"
+    rpool_local = f"rpool/local/{config.zfs.os_id}"
+    bpool_nix = f"bpool/{config.zfs.os_id}"
+
+    trace.run(
+        f"zfs snapshot -r {rpool_nix}@{name} {rpool_local}@{name}".split(), check=True
+    )
+    if has_bpool(config=config):
+        trace.run(f"zfs snapshot -r {bpool_nix}@{name}".split(), check=True)
+
+    # the scratch dataset is never worth keeping
+    if config.zfs.scratch != "none":
+        trace.run(
+            f"zfs destroy {rpool_nix}/scratch@{name}".split(),
+            capture_output=True,
+            check=False,
+        )
+
+
+def mount_scratch(config: ZfsSystemConfig) -> Optional[Path]:
+    """Mounts the scratch dataset for the builds of the install.
+
+    Returns:
+        The directory to build in, or None without a scratch dataset.
+    """
+    if config.zfs.scratch == "none":
+        return None
+    if config.zfs.scratch == "install":
+        dataset = f"rpool/{config.zfs.os_id}/scratch"
+        trace.run(f"zfs mount {dataset}".split(), check=True)
+    return Path("/mnt") / SCRATCH_MOUNTPOINT.relative_to("/")
+
+
+def destroy_scratch(config: ZfsSystemConfig):
+    """Destroys an install-only scratch dataset and its snapshots."""
+    if config.zfs.scratch != "install":
+        return
+    dataset = f"rpool/{config.zfs.os_id}/scratch"
+    trace.run(f"zfs destroy -r {dataset}".split(), check=True)
+
+
+def write_cachefile(config: ZfsSystemConfig):
+    """Writes the pool configuration cache into the target system.
+
+    The pools are created with an altroot, which disables the cachefile.
+    Pointing the cachefile at a temporary location makes ZFS write the
+    current configuration, which is then copied to the location linked
+    to `/etc/zfs/zpool.cache` by zfs.nix. The temporary file is emptied
+    when the pools are exported, the copies are not.
+
+    NixOS imports the pools in stage 1 by scanning `boot.zfs.devNodes`
+    and ignores the cachefile; only imports after stage 1 use it.
+    """
+    CACHEFILE.parent.mkdir(parents=True, exist_ok=True)
+    for pool in get_pools(config=config):
+        trace.run(f"zpool set cachefile={CACHEFILE} {pool}".split(), check=True)
+
+    TARGET_CACHEFILE.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copyfile(CACHEFILE, TARGET_CACHEFILE)
+    shutil.copyfile(CACHEFILE, CACHEFILE.with_suffix(".cache.install"))
+
+
+def export(config: ZfsSystemConfig):
+    """Unmounts the ESPs, exports the pools and removes the temporary key
+    file."""
+    trace.run("umount /mnt/boot/efis/*", shell=True, check=True)
+
+    # the other pools are mounted below the root dataset
+    for pool in sorted(get_pools(config=config), key=lambda pool: pool == "rpool"):
+        trace.run(f"zpool export {pool}".split(), check=True)
+    keyfile.remove_key()
+
+
+def measure_pool_import(config: ZfsSystemConfig) -> Dict[str, float]:
+    """Times the device scan of an import for each lookup strategy.
+
+    `zpool import` without a pool name only scans for importable pools,
+    which is the part of a boot-time import that grows with the number
+    of devices. Stage 1 of NixOS always scans `boot.zfs.devNodes`, so the
+    cachefile timing only applies to imports after it. The pools must be
+    exported.
+
+    Returns:
+        A mapping of strategy to scan time in seconds.
+    """
+    strategies = {"by-id scan": f"-d {Path(config.zfs.primary_disk).parent}"}
+
+    cachefile = CACHEFILE.with_suffix(".cache.install")
+    if cachefile.exists():
+        strategies["cachefile"] = f"-c {cachefile}"
+
+    timings = {}
+    with tempfile.TemporaryDirectory(prefix="pybootstrap-") as scoped_dir:
+        for member in get_pool_members(config=config):
+            os.symlink(member, Path(scoped_dir) / Path(member).name)
+        strategies["scoped scan"] = f"-d {scoped_dir}"
 
-    # efis = ' '.join(glob.glob('/mnt/boot/efis/*'))
-    # subprocess.run(f'umount {efis}'.split(), check=True)
-    subprocess.run("umount /mnt/boot/efis/*", shell=True, check=True)
+        for name, flags in strategies.items():
+            start = time.perf_counter()
+            trace.run(f"zpool import {flags}".split(), capture_output=True, check=False)
+            timings[name] = time.perf_counter() - start
 
-    subprocess.run(f"zpool export {bpool_id}".split(), check=True)
-    subprocess.run(f"zpool export {rpool_id}".split(), check=True)
+    for name, seconds in timings.items():
+        print(f"Pool import ({name}): {seconds * 1000:.0f} ms")
+    return timings
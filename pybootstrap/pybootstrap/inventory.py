@@ -0,0 +1,269 @@
+"""A module for selecting disks out of large inventories.
+
+Enclosures with dozens of disks are hard to handle in a single checkbox
+list. The inventory indexes the block devices so they can be narrowed
+down with filter expressions, selected by model and assigned to vdevs
+in enclosure slot order.
+
+Filter expressions are whitespace separated terms that must all match:
+
+    model=ST16000*  size>=10T  size<16T  tran=sas  rota=1  slot=0-23
+
+`model`, `id`, `path` and `tran` take shell-style patterns, `size`
+takes a byte count with an optional K/M/G/T/P suffix (powers of 1024),
+`rota` takes 0/1 and `slot` takes a slot number, a range like `0-23` or
+a pattern matched against `<enclosure>:<slot>`.
+"""
+import os
+import re
+from collections import defaultdict
+from fnmatch import fnmatch
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+ENCLOSURE_PATH = Path("/sys/class/enclosure")
+SIZE_SUFFIXES = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+SIZE_SUFFIXES["P"] = 1024**5
+PAGE_SIZE = 20
+TERM_REGEX = re.compile(r"^(\w+)(>=|<=|!=|=|>|<)(.+)$")
+OPERATORS: Dict[str, Callable[[int, int], bool]] = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+}
+
+
+class BlockDevice(NamedTuple):
+    """Information about a block device."""
+
+    name: str
+    kname: str
+    path: str
+    model: str
+    serial: str
+    size: int
+    type: str
+    tran: Optional[str] = None
+    rota: bool = False
+    id: str = ""
+    slot: str = ""
+
+
+DERIVED_FIELDS = ("id", "slot")
+
+
+class Inventory:
+    """Block devices indexed by model, transport and enclosure slot."""
+
+    def __init__(self, blk_devs: Iterable[BlockDevice]):
+        self.devices = sorted(blk_devs, key=slot_sort_key)
+        self.by_id = {dev.id: dev for dev in self.devices}
+        self.by_model: Dict[str, List[BlockDevice]] = defaultdict(list)
+        self.by_tran: Dict[str, List[BlockDevice]] = defaultdict(list)
+        for dev in self.devices:
+            self.by_model[dev.model].append(dev)
+            self.by_tran[dev.tran or ""].append(dev)
+        self._indexes = {"model": self.by_model, "tran": self.by_tran}
+        self._rows: Dict[str, str] = {}
+        self._row_format = ""
+
+    def __len__(self) -> int:
+        return len(self.devices)
+
+    def filter(self, expression: str) -> List[BlockDevice]:
+        """Returns the devices matching every term of an expression.
+
+        `model=` and `tran=` terms naming an exact value are looked up in
+        the indexes instead of testing every candidate.
+
+        Raises:
+            ValueError: If the expression cannot be parsed.
+        """
+        candidates = self.devices
+        for term in expression.split():
+            match = TERM_REGEX.match(term)
+            if match is None:
+                raise ValueError(f"Invalid filter term: {term}.")
+            key, operator, value = match.groups()
+            index = self._indexes.get(key)
+            if operator == "=" and index is not None and value in index:
+                if candidates is self.devices:
+                    candidates = list(index[value])
+                else:
+                    kept = set(candidates)
+                    candidates = [dev for dev in index[value] if dev in kept]
+                continue
+            predicate = get_predicate(key=key, operator=operator, value=value)
+            candidates = [dev for dev in candidates if predicate(dev)]
+        return candidates
+
+    def groups(self) -> Dict[str, List[BlockDevice]]:
+        """Returns the devices grouped by model."""
+        return dict(self.by_model)
+
+    def rows(self, blk_devs: Sequence[BlockDevice], keys: Sequence[str]) -> List[str]:
+        """Returns table rows for some of the devices.
+
+        The column widths are computed once over the whole inventory and
+        every row is formatted only the first time it is shown, so
+        filtered views and pages are redrawn without re-tabulating.
+        """
+        if not self._row_format:
+            cells = [[format_cell(dev, key) for key in keys] for dev in self.devices]
+            widths = [len(max(col, key=len)) + 3 for col in zip(*cells, keys)]
+            self._row_format = "".join(f"{{:>{width}}}" for width in widths)
+
+        rows = []
+        for dev in blk_devs:
+            if dev.id not in self._rows:
+                cells = [format_cell(dev, key) for key in keys]
+                self._rows[dev.id] = self._row_format.format(*cells)
+            rows.append(self._rows[dev.id])
+        return rows
+
+
+def paginate(items: Sequence, page_size: int = PAGE_SIZE) -> List[Sequence]:
+    """Splits a sequence into pages of at most `page_size` items."""
+    starts = range(0, len(items), page_size)
+    return [items[start : start + page_size] for start in starts]
+
+
+def format_cell(dev: BlockDevice, key: str) -> str:
+    """Formats a block device attribute as a table cell."""
+    value = getattr(dev, key)
+    if key == "size":
+        return format_size(value)
+    if key == "rota":
+        return "hdd" if value else "ssd"
+    return "" if value is None else str(value)
+
+
+def get_predicate(key: str, operator: str, value: str) -> Callable[[BlockDevice], bool]:
+    """Builds a predicate for a single filter term.
+
+    Raises:
+        ValueError: If the key or operator is not supported.
+    """
+    match key:
+        case "size":
+            size = parse_size(value)
+            compare = OPERATORS[operator]
+            return lambda dev: compare(dev.size, size)
+        case "rota":
+            rota = value.lower() in ("1", "yes", "true")
+            return _negate(lambda dev: dev.rota == rota, operator)
+        case "slot":
+            return _negate(lambda dev: slot_matches(dev.slot, value), operator)
+        case "model" | "id" | "path" | "tran" | "serial":
+            return _negate(
+                lambda dev: fnmatch(getattr(dev, key) or "", value), operator
+            )
+        case _:
+            raise ValueError(f"Unknown filter key: {key}.")
+
+
+def _negate(
+    predicate: Callable[[BlockDevice], bool], operator: str
+) -> Callable[[BlockDevice], bool]:
+    match operator:
+        case "=":
+            return predicate
+        case "!=":
+            return lambda dev: not predicate(dev)
+        case _:
+            raise ValueError(f"Operator {operator} only works with size.")
+
+
+def parse_size(value: str) -> int:
+    """Parses a size like `10T` or `512G` into bytes."""
+    match = re.match(r"^([\d.]+)\s*([KMGTP]?)i?B?$", value.upper())
+    if match is None:
+        raise ValueError(f"Invalid size: {value}.")
+    number, suffix = match.groups()
+    return int(float(number) * SIZE_SUFFIXES[suffix])
+
+
+def format_size(size: int) -> str:
+    """Formats a byte count with a binary suffix."""
+    for suffix in ("P", "T", "G", "M", "K"):
+        if size >= SIZE_SUFFIXES[suffix]:
+            return f"{size / SIZE_SUFFIXES[suffix]:.1f}{suffix}"
+    return str(size)
+
+
+def slot_number(slot: str) -> Optional[int]:
+    """Returns the numeric part of an `<enclosure>:<slot>` string."""
+    digits = re.findall(r"\d+", slot.rpartition(":")[2])
+    return int(digits[-1]) if digits else None
+
+
+def slot_matches(slot: str, value: str) -> bool:
+    """Matches a slot against a number, a range or a pattern."""
+    number = slot_number(slot)
+    range_match = re.match(r"^(\d+)-(\d+)$", value)
+    if range_match is not None:
+        low, high = map(int, range_match.groups())
+        return number is not None and low <= number <= high
+    if value.isdigit():
+        return number == int(value)
+    return fnmatch(slot, value)
+
+
+def slot_sort_key(dev: BlockDevice):
+    """Sorts devices by enclosure and slot, then by id."""
+    enclosure = dev.slot.rpartition(":")[0]
+    number = slot_number(dev.slot)
+    return (dev.slot == "", enclosure, -1 if number is None else number, dev.id)
+
+
+def get_enclosure_slots() -> Dict[str, str]:
+    """Maps kernel device names to their `<enclosure>:<slot>` location.
+
+    Reads the SES enclosure devices in sysfs, where every slot directory
+    links the block device it holds.
+    """
+    slots = {}
+    if not ENCLOSURE_PATH.exists():
+        return slots
+
+    for enclosure in ENCLOSURE_PATH.iterdir():
+        for slot_dir in enclosure.iterdir():
+            block_dir = slot_dir / "device" / "block"
+            if not block_dir.is_dir():
+                continue
+            slot = slot_dir.name
+            slot_file = slot_dir / "slot"
+            if slot_file.exists():
+                slot = slot_file.read_text(encoding="UTF-8").strip()
+            for kname in os.listdir(block_dir):
+                slots[kname] = f"{enclosure.name}:{slot}"
+    return slots
+
+
+def add_slot_to_block_devices(blk_devs: List[BlockDevice]) -> List[BlockDevice]:
+    """Adds the enclosure slot to every block device that has one."""
+    slots = get_enclosure_slots()
+    return [dev._replace(slot=slots.get(dev.kname, "")) for dev in blk_devs]
+
+
+def assign_vdevs(disks: Sequence[str], width: int) -> List[List[str]]:
+    """Splits disks into vdev groups in the order they are given.
+
+    Args:
+        disks: The disks by id, in enclosure slot order.
+        width: The number of disks per vdev, 0 for a single vdev.
+
+    Returns:
+        A list of vdev groups.
+
+    Raises:
+        ValueError: If the disks cannot be split evenly.
+    """
+    if width <= 0:
+        return [list(disks)]
+    if len(disks) % width != 0:
+        raise ValueError(f"{len(disks)} disks cannot be split into vdevs of {width}.")
+    return [list(disks[start : start + width]) for start in range(0, len(disks), width)]
@@ -0,0 +1,161 @@
+"""A module for handing the encryption key to ZFS without a prompt.
+
+The key is collected or generated once while preparing and written to a
+file on a tmpfs, never to the plan. The encryption roots are created
+with a `file://` keylocation pointing at it, so creating the datasets
+does not block on the terminal, and the keylocation is switched to the
+planned one afterwards.
+
+The key of the root pool never goes into the installed system: the
+initrd lives on unencrypted disks. Pools imported once the root pool is
+unlocked read a copy of the key from its encrypted `/state` dataset
+instead of asking for it again.
+"""
+import os
+from pathlib import Path
+
+KEY_DIR = Path("/run/pybootstrap")
+KEY_FILE = KEY_DIR / "rpool.key"
+STATE_KEY_FILE = Path("/state/etc/cryptkey.d/data.key")
+TARGET = Path("/mnt")
+KEY_BYTES = 32
+MIN_PASSPHRASE = 8
+MAX_PASSPHRASE = 512
+MEMORY_FILESYSTEMS = ("tmpfs", "ramfs")
+
+
+def get_keylocation() -> str:
+    """Returns the keylocation of the temporary key file."""
+    return f"file://{KEY_FILE}"
+
+
+def get_state_keylocation() -> str:
+    """Returns the keylocation of the key file in the state dataset."""
+    return f"file://{STATE_KEY_FILE}"
+
+
+def validate_keylocation(keylocation: str) -> None:
+    """Checks the keylocation of the root pool at boot.
+
+    Raises:
+        ValueError: If the key would be read from the target disks or
+            from the temporary key file.
+    """
+    if keylocation == "prompt" or keylocation.startswith(("https://", "http://")):
+        return
+    if not keylocation.startswith("file:///"):
+        raise ValueError("The keylocation must be a file:// or https:// URI.")
+    path = Path(keylocation.removeprefix("file://")).resolve()
+    if path.is_relative_to(KEY_DIR) or path.is_relative_to(TARGET):
+        raise ValueError(f"{path} is not available at boot.")
+
+
+def install_key(mnt: Path) -> None:
+    """Copies the temporary key file into the state dataset of the target.
+
+    Args:
+        mnt: The mount point of the target.
+    """
+    target = mnt / STATE_KEY_FILE.relative_to("/")
+    target.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "wb") as file:
+        file.write(KEY_FILE.read_bytes())
+
+
+def generate_key(keyformat: str) -> bytes:
+    """Generates a random key.
+
+    Raises:
+        ValueError: If the key format cannot be generated.
+    """
+    match keyformat:
+        case "raw":
+            return os.urandom(KEY_BYTES)
+        case "hex":
+            return os.urandom(KEY_BYTES).hex().encode()
+        case _:
+            raise ValueError(f"Cannot generate a {keyformat} key.")
+
+
+def validate_key(key: bytes, keyformat: str) -> None:
+    """Checks a key against the requirements of its format.
+
+    Raises:
+        ValueError: If ZFS would reject the key.
+    """
+    match keyformat:
+        case "passphrase":
+            if not MIN_PASSPHRASE <= len(key) <= MAX_PASSPHRASE:
+                raise ValueError(
+                    f"A passphrase must be {MIN_PASSPHRASE} to {MAX_PASSPHRASE} "
+                    "bytes long."
+                )
+        case "raw":
+            if len(key) != KEY_BYTES:
+                raise ValueError(f"A raw key must be {KEY_BYTES} bytes long.")
+        case "hex":
+            try:
+                raw = bytes.fromhex(key.decode())
+            except ValueError as err:
+                raise ValueError("A hex key must only hold hex digits.") from err
+            if len(raw) != KEY_BYTES:
+                raise ValueError(f"A hex key must be {KEY_BYTES * 2} digits long.")
+        case _:
+            raise ValueError(f"Unknown keyformat: {keyformat}.")
+
+
+def is_memory_backed(path: Path) -> bool:
+    """Whether a directory is on a file system that never hits a disk."""
+    mount_type = ""
+    longest = -1
+    with open("/proc/mounts", "r", encoding="UTF-8") as file:
+        for line in file:
+            _, mount_point, fs_type, *_ = line.split()
+            mount_point = mount_point.replace("\\040", " ")
+            if path.is_relative_to(mount_point) and len(mount_point) > longest:
+                mount_type, longest = fs_type, len(mount_point)
+    return mount_type in MEMORY_FILESYSTEMS
+
+
+def write_key(key: bytes, keyformat: str) -> None:
+    """Writes a key to the temporary key file, readable only by root.
+
+    Raises:
+        ValueError: If the key is invalid or the key directory is not on
+            a tmpfs.
+    """
+    validate_key(key=key, keyformat=keyformat)
+    KEY_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+    if not is_memory_backed(KEY_DIR):
+        raise ValueError(f"{KEY_DIR} is not on a tmpfs, refusing to write the key.")
+
+    remove_key()
+    fd = os.open(KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as file:
+        file.write(key)
+
+
+def check_key() -> None:
+    """Checks that the temporary key file exists.
+
+    Raises:
+        FileNotFoundError: If the key file is missing, e.g. after a
+            reboot since the plan was made.
+    """
+    if not KEY_FILE.exists():
+        raise FileNotFoundError(
+            f"{KEY_FILE} is missing, run `sudo pybootstrap plan` again to enter "
+            "the key."
+        )
+
+
+def remove_key() -> None:
+    """Overwrites and removes the temporary key file."""
+    if not KEY_FILE.exists():
+        return
+    with open(KEY_FILE, "r+b") as file:
+        file.write(bytes(KEY_FILE.stat().st_size))
+        file.flush()
+        os.fsync(file.fileno())
+    KEY_FILE.unlink()
@@ -0,0 +1,84 @@
+"""A module for sizing Nix build parallelism to the host.
+
+Nix runs up to `max-jobs` derivations at once, each allowed to use up to
+`cores` cores, so a host can end up with `max-jobs * cores` compiler
+processes. The product is bounded by the CPU count and by the memory
+left after a reserve for the system, assuming every build process may
+need `GIB_PER_BUILD_CORE`. Substitution is bound by the network rather
+than the CPU, so it scales more aggressively.
+"""
+import math
+import os
+from typing import List, NamedTuple
+
+from pybootstrap.prepare import get_system_memory
+
+RESERVED_GIB = 1
+GIB_PER_BUILD_CORE = 1.5
+MIN_SUBSTITUTION_JOBS = 16
+MAX_SUBSTITUTION_JOBS = 128
+MAX_HTTP_CONNECTIONS = 256
+
+
+class NixSettings(NamedTuple):
+    """Nix build and download parallelism."""
+
+    max_jobs: int
+    cores: int
+    max_substitution_jobs: int
+    http_connections: int
+
+    def to_nix(self) -> List[str]:
+        """Returns the settings as NixOS configuration lines."""
+        return [
+            f"nix.settings.max-jobs = {self.max_jobs};",
+            f"nix.settings.cores = {self.cores};",
+            f"nix.settings.max-substitution-jobs = {self.max_substitution_jobs};",
+            f"nix.settings.http-connections = {self.http_connections};",
+        ]
+
+    def to_args(self) -> List[str]:
+        """Returns the matching `nixos-install` options."""
+        return [
+            *["--max-jobs", str(self.max_jobs), "--cores", str(self.cores)],
+            *["--option", "max-substitution-jobs", str(self.max_substitution_jobs)],
+            *["--option", "http-connections", str(self.http_connections)],
+        ]
+
+
+def get_nix_settings() -> NixSettings:
+    """Computes the Nix settings for this host."""
+    return compute_nix_settings(
+        cpus=os.cpu_count() or 1, mem_gib=get_system_memory(size="GiB")
+    )
+
+
+def compute_nix_settings(cpus: int, mem_gib: int) -> NixSettings:
+    """Computes the Nix settings for a CPU count and memory size.
+
+    The build processes are split evenly between concurrent derivations
+    and cores per derivation, e.g. 64 cores with enough memory give
+    8 jobs of 8 cores.
+
+    Args:
+        cpus: The number of logical CPUs.
+        mem_gib: The total memory in GiB.
+
+    Returns:
+        The Nix settings.
+    """
+    by_memory = int((mem_gib - RESERVED_GIB) / GIB_PER_BUILD_CORE)
+    processes = max(1, min(cpus, by_memory))
+
+    max_jobs = math.ceil(math.sqrt(processes))
+    cores = max(1, processes // max_jobs)
+
+    substitution_jobs = min(max(cpus * 2, MIN_SUBSTITUTION_JOBS), MAX_SUBSTITUTION_JOBS)
+    http_connections = min(substitution_jobs * 2, MAX_HTTP_CONNECTIONS)
+
+    return NixSettings(
+        max_jobs=max_jobs,
+        cores=cores,
+        max_substitution_jobs=substitution_jobs,
+        http_connections=http_connections,
+    )
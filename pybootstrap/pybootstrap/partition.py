@@ -1,12 +1,26 @@
 """A module for partitioning for zpool and zfs dataset creation."""
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 from pathlib import Path
-from typing import List, NamedTuple
-
-import questionary
-
-from pybootstrap.prepare import ZfsSystemConfig
-from pybootstrap.zfs import ZDataset, ZfsProps, ZPool, ZPoolProps
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+from pybootstrap import capacity, esp, keyfile, trace, wipe
+from pybootstrap.prepare import (
+    ZfsSystemConfig,
+    get_wipe,
+    has_bpool,
+    has_swap_partition,
+)
+from pybootstrap.zfs import (
+    VOLUME_PROFILES,
+    ZDataset,
+    ZfsProps,
+    ZPool,
+    ZPoolProps,
+    ZVolume,
+)
+
+SCRATCH_MOUNTPOINT = Path("/nix/scratch")
 
 
 class SGDisk(NamedTuple):
@@ -28,27 +42,74 @@ class SGDisk(NamedTuple):
 
 
 def partition(config: ZfsSystemConfig):
+    validate_layout(config=config)
+    if config.zfs.encryption_roots:
+        keyfile.check_key()
     wipe_disks(config=config)
     sgdisk(config=config)
     zfs_create(config=config)
 
 
-def wipe_disks(config: ZfsSystemConfig) -> None:
-    response = questionary.confirm(
-        message="Wipe solid-state drives (recommended)?", auto_enter=False
+def validate_layout(config: ZfsSystemConfig) -> None:
+    """Checks the partition sizes against the disks before touching them.
+
+    Raises:
+        ValueError: If the partitions do not fit every disk or cannot
+            form the pool topology.
+    """
+    swap = int(config.part.swap) if has_swap_partition(config=config) else 0
+    layout = capacity.DiskLayout(
+        esp=int(config.part.esp),
+        boot=int(config.part.boot),
+        swap=swap,
+        root=int(config.part.root or 0),
     )
-    if response:
-        for disk in config.zfs.disks:
-            subprocess.run(f"blkdiscard -f {disk}".split(), check=True)
+    capacity.validate_layout(
+        disk_sizes=capacity.get_disk_sizes(disks=config.zfs.disks),
+        layout=layout,
+        topology=config.zfs.topology,
+        vdev_width=config.zfs.vdev_width,
+    )
+    pools = ["rpool", config.data.name] if config.data.disks else ["rpool"]
+    for volume in config.volumes:
+        if volume.pool not in pools:
+            raise ValueError(f"Volume {volume.name} is on unknown pool {volume.pool}.")
+    for pool in pools:
+        get_volume_layout(pool=pool, config=config)
+    if config.data.disks:
+        capacity.get_pool_capacity(
+            num_disks=len(config.data.disks),
+            root=1,
+            topology=config.data.topology,
+            vdev_width=config.data.vdev_width,
+        )
+
+
+def wipe_disks(config: ZfsSystemConfig) -> None:
+    """Wipes the disks unless the plan says no."""
+    disks = [*config.zfs.disks, *config.data.disks]
+    match config.part.wipe:
+        case "ask":
+            if not get_wipe():
+                disks = []
+        case "yes":
+            pass
+        case "no":
+            disks = []
+        case _:
+            raise ValueError(f"Unknown wipe state: {config.part.wipe}")
+
+    if disks:
+        wipe.wipe_disks(disks=disks)
 
 
 def sgdisk(config: ZfsSystemConfig) -> None:
     """Partitions the disks for a given bootloader."""
     commands = get_sgdisk_commands(config=config)
     for cmd_str in commands:
-        subprocess.run(cmd_str.split(), check=True)
-    subprocess.run("sync", check=True)
-    subprocess.run("sleep 3".split(), check=True)
+        trace.run(cmd_str.split(), check=True)
+    trace.run("sync", check=True)
+    trace.run("sleep 3".split(), check=True)
 
 
 def get_sgdisk_commands(config: ZfsSystemConfig) -> List[str]:
@@ -81,16 +142,17 @@ def get_sgdisk_grub_commands(config: ZfsSystemConfig) -> List[str]:
     boot_part = SGDisk(partnum=2, start=0, end=int(config.part.boot), hexcode="BE00")
     commands.append(boot_part)
 
-    if config.part.swap not in ("", 0):
+    if has_swap_partition(config=config):
         swap_part = SGDisk(
             partnum=4, start=0, end=int(config.part.swap), hexcode="8200"
         )
         commands.append(swap_part)
 
-    if config.part.root in (0, ""):
+    if config.part.root in (0, "", "0"):
         root_part = SGDisk(partnum=3, start=0, end=0, hexcode="BF00")
     else:
-        root_part = SGDisk(partnum=3, start=0, end=config.part.root, hexcode="BF00")
+        root = int(config.part.root)
+        root_part = SGDisk(partnum=3, start=0, end=root, hexcode="BF00")
     commands.append(root_part)
 
     legacy_part = SGDisk(
@@ -111,26 +173,369 @@ def get_sgdisk_systemd_boot_commands(config: ZfsSystemConfig) -> List[str]:
     esp_part = SGDisk(partnum=1, start=0, end=int(config.part.esp), hexcode="EF00")
     commands.append(esp_part)
 
-    boot_part = SGDisk(partnum=2, start=0, end=int(config.part.boot), hexcode="BE00")
-    commands.append(boot_part)
+    # without a boot pool the kernels are on the ESP
+    if has_bpool(config=config):
+        boot_part = SGDisk(
+            partnum=2, start=0, end=int(config.part.boot), hexcode="BE00"
+        )
+        commands.append(boot_part)
 
-    if config.part.swap not in ("", 0):
+    if has_swap_partition(config=config):
         swap_part = SGDisk(
             partnum=4, start=0, end=int(config.part.swap), hexcode="8200"
         )
         commands.append(swap_part)
 
-    if config.part.root in (0, ""):
+    if config.part.root in (0, "", "0"):
         root_part = SGDisk(partnum=3, start=0, end=0, hexcode="BF00")
     else:
-        root_part = SGDisk(partnum=3, start=0, end=config.part.root, hexcode="BF00")
+        root = int(config.part.root)
+        root_part = SGDisk(partnum=3, start=0, end=root, hexcode="BF00")
     commands.append(root_part)
 
     return commands
 
 
-def zfs_create(config: ZfsSystemConfig):
-    # Create the boot pool
+class DatasetSpec(NamedTuple):
+    """A dataset of a pool layout.
+
+    The path is relative to the OS dataset (e.g. `rpool/nixos`), so an
+    empty path refers to the OS dataset itself.
+    """
+
+    path: str
+    zfsprops: ZfsProps
+    mount: bool = False
+
+
+def get_rpool_layout(config: ZfsSystemConfig) -> List[DatasetSpec]:
+    """Returns the root pool datasets in creation order.
+
+    Datasets listed in `config.zfs.encryption_roots` are created as
+    encryption roots; everything below them inherits their key. `/nix`
+    is not part of the layout but of `get_local_layout`, so the OS
+    dataset can be the single encryption root.
+
+    Raises:
+        ValueError: If an encryption root is not part of the layout.
+    """
+    container_props = ZfsProps(prefix="o", canmount="off", mountpoint="none")
+    layout = [
+        DatasetSpec(path="", zfsprops=container_props),
+        # ROOT datasets
+        DatasetSpec(path="ROOT", zfsprops=container_props),
+        DatasetSpec(
+            path="ROOT/default",
+            zfsprops=ZfsProps(prefix="o", canmount="noauto", mountpoint=Path("/")),
+            mount=True,
+        ),
+        # DATA datasets
+        DatasetSpec(path="DATA", zfsprops=container_props),
+        # user/shared/persistent datasets
+        DatasetSpec(
+            path="DATA/default",
+            zfsprops=ZfsProps(prefix="o", canmount="off", mountpoint=Path("/")),
+        ),
+    ]
+
+    # containers
+    for shared_con in ("usr", "var", "var/lib"):
+        layout.append(
+            DatasetSpec(
+                path=f"DATA/default/{shared_con}",
+                zfsprops=ZfsProps(prefix="o", canmount="off"),
+            )
+        )
+
+    # mounted directories, plus a state dataset for saving mutable data
+    # in case an immutable file system is used
+    shared_dirs = ("home", "root", "srv", "usr/local", "var/log", "var/spool", "state")
+    for shared in shared_dirs:
+        layout.append(
+            DatasetSpec(
+                path=f"DATA/default/{shared}",
+                zfsprops=ZfsProps(prefix="o", canmount="on"),
+            )
+        )
+
+    # A throwaway dataset for build directories; nothing in it is worth
+    # a sync write or a snapshot
+    if config.zfs.scratch != "none":
+        persistent = config.zfs.scratch == "persistent"
+        layout.append(
+            DatasetSpec(
+                path="scratch",
+                zfsprops=ZfsProps(
+                    prefix="o",
+                    atime="off",
+                    auto_snapshot="false",
+                    canmount="on" if persistent else "noauto",
+                    compression="lz4",
+                    mountpoint=SCRATCH_MOUNTPOINT,
+                    relatime="off",
+                    sync="disabled",
+                ),
+                mount=persistent,
+            )
+        )
+
+    # A container for the volumes of the root pool
+    if get_volume_layout(pool="rpool", config=config):
+        layout.append(
+            DatasetSpec(
+                path=get_volume_parent(pool="rpool", config=config),
+                zfsprops=ZfsProps(prefix="o", canmount="off"),
+            )
+        )
+
+    # An `empty` dataset to use as an original snapshot for an immutable
+    # file system.
+    layout.append(
+        DatasetSpec(
+            path="ROOT/empty",
+            zfsprops=ZfsProps(prefix="o", canmount="noauto", mountpoint=Path("/")),
+        )
+    )
+
+    return apply_encryption_roots(layout=layout, config=config)
+
+
+def get_local_layout(config: ZfsSystemConfig) -> List[DatasetSpec]:
+    """Returns the unencrypted root pool datasets in creation order.
+
+    `/nix` only holds world-readable store paths, so it lives next to
+    the OS dataset rather than below it and never pays for encryption.
+    Unlike the other layouts, the paths are relative to the pool.
+    """
+    local = f"local/{config.zfs.os_id}"
+    return [
+        DatasetSpec(
+            path="local",
+            zfsprops=ZfsProps(prefix="o", canmount="off", mountpoint="none"),
+        ),
+        DatasetSpec(
+            path=local,
+            zfsprops=ZfsProps(prefix="o", canmount="off", mountpoint=Path("/")),
+        ),
+        DatasetSpec(
+            path=f"{local}/nix",
+            zfsprops=ZfsProps(prefix="o", canmount="on", mountpoint=Path("/nix")),
+        ),
+    ]
+
+
+def get_bpool_layout(config: ZfsSystemConfig) -> List[DatasetSpec]:
+    """Returns the boot pool datasets in creation order."""
+    # pylint: disable=unused-argument
+    container_props = ZfsProps(prefix="o", canmount="off", mountpoint="none")
+    return [
+        DatasetSpec(path="", zfsprops=container_props),
+        DatasetSpec(path="BOOT", zfsprops=container_props),
+        DatasetSpec(
+            path="BOOT/default",
+            zfsprops=ZfsProps(prefix="o", canmount="noauto", mountpoint=Path("/boot")),
+            mount=True,
+        ),
+    ]
+
+
+def get_dpool_layout(config: ZfsSystemConfig) -> List[DatasetSpec]:
+    """Returns the data pool datasets in creation order.
+
+    Unlike the system pools, the datasets are not nested in an OS
+    dataset: the data outlives reinstalls.
+    """
+    layout = [
+        DatasetSpec(
+            path="DATA",
+            zfsprops=ZfsProps(
+                prefix="o", canmount="on", mountpoint=Path(config.data.mountpoint)
+            ),
+        )
+    ]
+    for name in config.data.datasets:
+        layout.append(
+            DatasetSpec(
+                path=f"DATA/{name}", zfsprops=ZfsProps(prefix="o", canmount="on")
+            )
+        )
+    if get_volume_layout(pool=config.data.name, config=config):
+        layout.append(
+            DatasetSpec(
+                path=get_volume_parent(pool=config.data.name, config=config),
+                zfsprops=ZfsProps(prefix="o", canmount="off"),
+            )
+        )
+    roots = get_encryption_roots(pool=config.data.name, config=config)
+    return apply_encryption_roots(layout=layout, config=config, roots=roots)
+
+
+class VolumeSpec(NamedTuple):
+    """A volume of a pool layout.
+
+    Like the dataset paths, the path is relative to the dataset root of
+    the pool.
+    """
+
+    path: str
+    zvolume: ZVolume
+
+
+def get_volume_parent(pool: str, config: ZfsSystemConfig) -> str:
+    """Returns the dataset holding the volumes of a pool.
+
+    The volumes are placed below an encryption root of the layout.
+    """
+    if pool == config.data.name:
+        return "DATA/volumes"
+    return "DATA/default/volumes"
+
+
+def get_volume_layout(pool: str, config: ZfsSystemConfig) -> List[VolumeSpec]:
+    """Returns the volumes of a pool in creation order.
+
+    Raises:
+        ValueError: If a volume has an unknown profile or size.
+    """
+    parent = get_volume_parent(pool=pool, config=config)
+    layout = []
+    for volume in config.volumes:
+        if volume.pool != pool:
+            continue
+        if volume.profile not in VOLUME_PROFILES:
+            raise ValueError(f"Unknown volume profile: {volume.profile}.")
+        zvolume = ZVolume(
+            zvolprops=VOLUME_PROFILES[volume.profile],
+            volsize=volume.size,
+            sparse=volume.sparse,
+        )
+        layout.append(VolumeSpec(path=f"{parent}/{volume.name}", zvolume=zvolume))
+    return layout
+
+
+def create_volumes(pool: str, config: ZfsSystemConfig):
+    """Creates the volumes of a pool."""
+    os_path = get_dataset_root(pool=pool, config=config)
+    for spec in get_volume_layout(pool=pool, config=config):
+        cmd = spec.zvolume.create(volume=os_path / spec.path)
+        trace.run(cmd.split(), check=True)
+
+
+def get_encryption_roots(pool: str, config: ZfsSystemConfig) -> List[str]:
+    """Returns the encryption roots of a pool relative to its dataset root."""
+    if pool == "rpool":
+        return list(config.zfs.encryption_roots)
+    if pool == config.data.name and config.data.encryption:
+        return ["DATA"] if config.zfs.encryption_roots else []
+    return []
+
+
+def get_keylocation(pool: str, config: ZfsSystemConfig) -> str:
+    """Returns the keylocation of the encryption roots of a pool.
+
+    The data pool is imported once the root pool is unlocked, so it
+    reads the key from the state dataset instead of asking for it again,
+    as long as that dataset is encrypted.
+    """
+    state = "DATA/default/state"
+    state_encrypted = any(
+        root == "" or state == root or state.startswith(f"{root}/")
+        for root in config.zfs.encryption_roots
+    )
+    if pool == config.data.name and state_encrypted:
+        return keyfile.get_state_keylocation()
+    return config.zfs.keylocation
+
+
+def uses_state_key(config: ZfsSystemConfig) -> bool:
+    """Whether the data pool reads its key from the state dataset."""
+    pool = config.data.name
+    return (
+        bool(config.data.disks)
+        and bool(get_encryption_roots(pool=pool, config=config))
+        and get_keylocation(pool=pool, config=config) == keyfile.get_state_keylocation()
+    )
+
+
+def get_dataset_root(pool: str, config: ZfsSystemConfig) -> Path:
+    """Returns the dataset the layout of a pool is created in."""
+    if pool == config.data.name:
+        return Path(pool)
+    return Path(pool) / config.zfs.os_id
+
+
+def apply_encryption_roots(
+    layout: List[DatasetSpec],
+    config: ZfsSystemConfig,
+    roots: Optional[Sequence[str]] = None,
+) -> List[DatasetSpec]:
+    """Turns datasets of a layout into encryption roots.
+
+    Args:
+        layout: The datasets of a pool.
+        config: The system configuration.
+        roots: The dataset paths to encrypt, `config.zfs.encryption_roots`
+            if None.
+    """
+    if roots is None:
+        roots = config.zfs.encryption_roots
+    paths = [spec.path for spec in layout]
+    for root in roots:
+        if root not in paths:
+            raise ValueError(f"Unknown encryption root: {root}.")
+
+    return [
+        spec._replace(
+            zfsprops=replace(
+                spec.zfsprops,
+                encryption=config.zfs.encryption,
+                keyformat=config.zfs.keyformat,
+                keylocation=keyfile.get_keylocation(),
+            )
+        )
+        if spec.path in roots
+        else spec
+        for spec in layout
+    ]
+
+
+def create_datasets(
+    pool: str,
+    layout: List[DatasetSpec],
+    config: ZfsSystemConfig,
+    root: Optional[Path] = None,
+):
+    """Creates (and optionally mounts) the datasets of a pool layout.
+
+    Args:
+        pool: The pool of the layout.
+        layout: The datasets to create.
+        config: The system configuration.
+        root: The dataset the paths are relative to, the dataset root of
+            the pool if None.
+    """
+    os_path = get_dataset_root(pool=pool, config=config) if root is None else root
+    for spec in layout:
+        path = os_path / spec.path
+        dataset = ZDataset(zfsprops=spec.zfsprops)
+        trace.run(dataset.create(filesystem=path).split(), check=True)
+        if spec.mount:
+            trace.run(f"zfs mount {path}".split(), check=True)
+
+
+def set_keylocation(pool: str, config: ZfsSystemConfig):
+    """Points the encryption roots from the temporary key file to the
+    planned keylocation."""
+    os_path = get_dataset_root(pool=pool, config=config)
+    keylocation = get_keylocation(pool=pool, config=config)
+    for root in get_encryption_roots(pool=pool, config=config):
+        trace.run(
+            f"zfs set keylocation={keylocation} {os_path / root}".split(), check=True
+        )
+
+
+def get_bpool_props(config: ZfsSystemConfig) -> Tuple[ZPoolProps, ZfsProps]:
+    """Returns the pool and root dataset properties of the boot pool."""
     bpool_zpoolprops = ZPoolProps(
         altroot=Path("/mnt"),
         ashift=13,
@@ -149,184 +554,151 @@ def zfs_create(config: ZfsSystemConfig):
         xattr="sa",
         mountpoint=Path("/boot"),
     )
+    return bpool_zpoolprops, bpool_zfsprops
 
-    bpool_name = "bpool"
-    bpool_parts = [f"{disk}-part2" for disk in config.zfs.disks]
-    bpool_vdev_type = ""
-    if len(config.zfs.disks) > 1:
-        bpool_vdev_type = "mirror"
-
-    bpool = ZPool(zpoolprops=bpool_zpoolprops, zfsprops=bpool_zfsprops)
-    bpool_create = bpool.create(
-        name=bpool_name, disks=bpool_parts, vdev_type=bpool_vdev_type
-    )
-    subprocess.run(bpool_create.split(), check=True)
 
-    # Create the root pool
+def get_rpool_props(config: ZfsSystemConfig) -> Tuple[ZPoolProps, ZfsProps]:
+    """Returns the pool and root dataset properties of the root pool.
+
+    Encryption is set per dataset in the layout.
+    """
     rpool_zpoolprops = ZPoolProps(
         altroot=Path("/mnt"), ashift=13, autotrim="on", compatibility="off"
     )
-
     rpool_zfsprops = ZfsProps(
         prefix="O",
         atime="on",
         acltype="posixacl",
         canmount="off",
-        compression="zstd",
+        compression=config.zfs.compression,
         dnodesize="auto",
-        encryption="aes-256-gcm",
-        keylocation="prompt",
-        keyformat="passphrase",
         normalization="formD",
         relatime="on",
         xattr="sa",
         mountpoint=Path("/"),
     )
+    return rpool_zpoolprops, rpool_zfsprops
 
-    rpool_name = "rpool"
-    rpool_parts = [f"{disk}-part3" for disk in config.zfs.disks]
-    rpool_vdev_type = config.zfs.topology
 
-    rpool = ZPool(zpoolprops=rpool_zpoolprops, zfsprops=rpool_zfsprops)
-    rpool_create = rpool.create(
-        name=rpool_name, disks=rpool_parts, vdev_type=rpool_vdev_type
-    )
-    subprocess.run(rpool_create.split(), check=True)
+def get_dpool_props(config: ZfsSystemConfig) -> Tuple[ZPoolProps, ZfsProps]:
+    """Returns the pool and root dataset properties of the data pool.
 
-    # Create OS dataset
-    root_os_zfsprops = ZfsProps(
-        prefix="o",
+    Bulk data is mostly large files that are rarely read again soon, so
+    records are large and access times are not tracked.
+    """
+    dpool_zpoolprops = ZPoolProps(
+        altroot=Path("/mnt"), ashift=12, autotrim="on", compatibility="off"
+    )
+    dpool_zfsprops = ZfsProps(
+        prefix="O",
+        atime="off",
+        acltype="posixacl",
         canmount="off",
-        encryption="off",
+        compression=config.data.compression,
+        dnodesize="auto",
+        normalization="formD",
+        recordsize=config.data.recordsize,
+        relatime="off",
+        xattr="sa",
         mountpoint="none",
     )
-    root_os_path = Path(rpool_name) / config.zfs.os_id
-    root_os_dataset = ZDataset(zfsprops=root_os_zfsprops)
-    subprocess.run(root_os_dataset.create(filesystem=root_os_path).split(), check=True)
-
-    # Common
-    container_props = ZfsProps(prefix="o", canmount="off", mountpoint="none")
+    return dpool_zpoolprops, dpool_zfsprops
 
-    # Create ROOT datasets
-    root_zfsprops = container_props
-    root_path = root_os_path / "ROOT"
-    root_dataset = ZDataset(zfsprops=root_zfsprops)
-    subprocess.run(root_dataset.create(filesystem=root_path).split(), check=True)
-
-    rdefault_zfsprops = ZfsProps(prefix="o", canmount="noauto", mountpoint=Path("/"))
-    rdefault_path = root_path / "default"
-    rdefault_dataset = ZDataset(zfsprops=rdefault_zfsprops)
-    subprocess.run(
-        rdefault_dataset.create(filesystem=rdefault_path).split(), check=True
-    )
 
-    subprocess.run(f"zfs mount {rdefault_path}".split(), check=True)
+def zfs_create(config: ZfsSystemConfig):
+    pool_creates = []
 
-    # Create BOOT datasets
-    boot_os_zfsprops = container_props
-    boot_os_path = Path(bpool_name) / config.zfs.os_id
-    boot_os_dataset = ZDataset(zfsprops=boot_os_zfsprops)
-    subprocess.run(boot_os_dataset.create(filesystem=boot_os_path).split(), check=True)
+    # Create the boot pool
+    bpool_name = "bpool"
+    if has_bpool(config=config):
+        bpool_zpoolprops, bpool_zfsprops = get_bpool_props(config=config)
+        bpool_parts = [f"{disk}-part2" for disk in config.zfs.disks]
+        bpool_vdev_type = ""
+        if len(config.zfs.disks) > 1:
+            bpool_vdev_type = "mirror"
+
+        bpool = ZPool(zpoolprops=bpool_zpoolprops, zfsprops=bpool_zfsprops)
+        pool_creates.append(
+            bpool.create(name=bpool_name, disks=bpool_parts, vdev_type=bpool_vdev_type)
+        )
 
-    boot_zfsprops = container_props
-    boot_path = boot_os_path / "BOOT"
-    boot_dataset = ZDataset(zfsprops=boot_zfsprops)
-    subprocess.run(boot_dataset.create(filesystem=boot_path).split(), check=True)
+    # Create the root pool; encryption is set per dataset in the layout
+    rpool_zpoolprops, rpool_zfsprops = get_rpool_props(config=config)
+    rpool_name = "rpool"
+    rpool_parts = [f"{disk}-part3" for disk in config.zfs.disks]
+    rpool_vdev_type = config.zfs.topology
 
-    bdefault_zfsprops = ZfsProps(
-        prefix="o", canmount="noauto", mountpoint=Path("/boot")
+    rpool = ZPool(zpoolprops=rpool_zpoolprops, zfsprops=rpool_zfsprops)
+    rpool_create = rpool.create(
+        name=rpool_name,
+        disks=rpool_parts,
+        vdev_type=rpool_vdev_type,
+        vdev_width=config.zfs.vdev_width,
     )
-    bdefault_path = boot_path / "default"
-    bdefault_dataset = ZDataset(zfsprops=bdefault_zfsprops)
-    subprocess.run(bdefault_dataset.create(bdefault_path).split(), check=True)
-
-    subprocess.run(f"zfs mount {bdefault_path}".split(), check=True)
-
-    # Create DATA datasets
-    data_zfsprops = container_props
-    data_path = root_os_path / "DATA"
-    data_dataset = ZDataset(zfsprops=data_zfsprops)
-    subprocess.run(data_dataset.create(filesystem=data_path).split(), check=True)
-
-    # Create datasets for mounting nix specific paths
-    dlocal_zfsprops = ZfsProps(prefix="o", canmount="off", mountpoint=Path("/"))
-    dlocal_path = data_path / "local"
-    dlocal_dataset = ZDataset(zfsprops=dlocal_zfsprops)
-    subprocess.run(dlocal_dataset.create(filesystem=dlocal_path).split(), check=True)
-
-    for nixdir in ("nix",):
-        nixdir_zfsprops = ZfsProps(
-            prefix="o", canmount="on", mountpoint=Path("/") / nixdir
-        )
-        nixdir_path = dlocal_path / nixdir
-        nixdir_dataset = ZDataset(zfsprops=nixdir_zfsprops)
-        subprocess.run(
-            nixdir_dataset.create(filesystem=nixdir_path).split(), check=True
+    pool_creates.append(rpool_create)
+
+    # Create the data pool from whole disks
+    if config.data.disks:
+        dpool_zpoolprops, dpool_zfsprops = get_dpool_props(config=config)
+        dpool = ZPool(zpoolprops=dpool_zpoolprops, zfsprops=dpool_zfsprops)
+        pool_creates.append(
+            dpool.create(
+                name=config.data.name,
+                disks=config.data.disks,
+                vdev_type=config.data.topology,
+                vdev_width=config.data.vdev_width,
+            )
         )
 
-    # Create user/shared/persistent datasets
-    data_default_props = ZfsProps(prefix="o", mountpoint=Path("/"), canmount="off")
-    data_default_path = data_path / "default"
-    data_default_dataset = ZDataset(zfsprops=data_default_props)
-    subprocess.run(
-        data_default_dataset.create(filesystem=data_default_path).split(), check=True
-    )
-
-    # containers
-    for shared_con in ("usr", "var", "var/lib"):
-        shared_con_props = ZfsProps(prefix="o", canmount="off")
-        shared_con_path = data_default_path / shared_con
-        shared_con_dataset = ZDataset(zfsprops=shared_con_props)
-        subprocess.run(
-            shared_con_dataset.create(filesystem=shared_con_path).split(), check=True
+    # The pools share no disks, so they are created in parallel
+    with ThreadPoolExecutor(max_workers=len(pool_creates)) as executor:
+        list(
+            executor.map(
+                lambda create: trace.run(create.split(), check=True),
+                pool_creates,
+            )
         )
 
-    # mounted directories
-    for shared in ("home", "root", "srv", "usr/local", "var/log", "var/spool"):
-        shared_props = ZfsProps(prefix="o", canmount="on")
-        shared_path = data_default_path / shared
-        shared_dataset = ZDataset(zfsprops=shared_props)
-        subprocess.run(
-            shared_dataset.create(filesystem=shared_path).split(), check=True
-        )
+    # Create the datasets; the root dataset is mounted before /boot and
+    # the data pool
+    create_datasets(pool=rpool_name, layout=get_rpool_layout(config), config=config)
+    create_datasets(
+        pool=rpool_name,
+        layout=get_local_layout(config),
+        config=config,
+        root=Path(rpool_name),
+    )
+    if has_bpool(config=config):
+        create_datasets(pool=bpool_name, layout=get_bpool_layout(config), config=config)
+    set_keylocation(pool=rpool_name, config=config)
+    create_volumes(pool=rpool_name, config=config)
+    if config.data.disks:
+        dpool_name = config.data.name
+        create_datasets(pool=dpool_name, layout=get_dpool_layout(config), config=config)
+        set_keylocation(pool=dpool_name, config=config)
+        create_volumes(pool=dpool_name, config=config)
 
     # chmod root
-    subprocess.run("chmod 750 /mnt/root".split(), check=True)
-
-    # Create a state dataset for saving mutable data in case an
-    # immutable file system is used
-    state_props = ZfsProps(prefix="o", canmount="on")
-    state_path = data_default_path / "state"
-    state_dataset = ZDataset(zfsprops=state_props)
-    subprocess.run(state_dataset.create(filesystem=state_path).split(), check=True)
+    trace.run("chmod 750 /mnt/root".split(), check=True)
 
     mnt_state = Path("/mnt/state")
     mnt = Path("/mnt")
     for state in ("etc/nixos", "etc/cryptkey.d"):
-        subprocess.run(
-            f"mkdir -p {mnt_state / state} {mnt / state}".split(), check=True
-        )
-        subprocess.run(
+        trace.run(f"mkdir -p {mnt_state / state} {mnt / state}".split(), check=True)
+        trace.run(
             f"mount -o bind {mnt_state / state} {mnt / state}".split(), check=True
         )
 
-    # Create an `empty` dataset to use as an original snapshot for an
-    # immutable file system.
-    empty_props = ZfsProps(prefix="o", canmount="noauto", mountpoint=Path("/"))
-    empty_path = root_path / "empty"
-    empty_dataset = ZDataset(zfsprops=empty_props)
-    subprocess.run(empty_dataset.create(filesystem=empty_path).split(), check=True)
-    subprocess.run(f"zfs snapshot {empty_path}@start".split(), check=True)
-
-    # Format and mount ESP
-    for disk in config.zfs.disks:
-        subprocess.run(f"mkfs.vfat -n EFI {disk}-part1".split(), check=True)
-        disk_id = Path(disk).stem
-        subprocess.run(f"mkdir -p /mnt/boot/efis/{disk_id}-part1".split(), check=True)
-        subprocess.run(
-            f"mount -t vfat {disk}-part1 /mnt/boot/efis/{disk_id}-part1".split(),
-            check=True,
-        )
+    # the data pool is unlocked with a copy of the key in the state dataset
+    if uses_state_key(config=config):
+        keyfile.install_key(mnt=mnt)
+
+    empty_path = Path(rpool_name) / config.zfs.os_id / "ROOT" / "empty"
+    trace.run(f"zfs snapshot {empty_path}@start".split(), check=True)
+
+    # Format the primary ESP, clone it to the other disks and mount them all
+    esp.create_esps(disks=config.zfs.disks)
+    esp.mount_esps(disks=config.zfs.disks)
 
 
 if __name__ == "__main__":
@@ -2,14 +2,28 @@
 import glob
 import json
 import math
+import mmap
 import os
 import string
-import subprocess
+import threading
 from pathlib import Path
-from time import sleep
-from typing import List, NamedTuple, Optional, Sequence
-
-import questionary
+from time import perf_counter, sleep
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Sequence,
+    Tuple,
+    get_args,
+    get_origin,
+    get_type_hints,
+)
+
+from pybootstrap import capacity, cipher, closure, inventory, keyfile, trace
+from pybootstrap.inventory import BlockDevice, Inventory
+from pybootstrap.speculate import Speculation
 
 
 class ZfsConfig(NamedTuple):
@@ -20,6 +34,15 @@ class ZfsConfig(NamedTuple):
     primary_disk: str
     topology: str
     compatability: str = ""
+    compression: str = "zstd"
+    encryption: str = "aes-256-gcm"
+    # the OS dataset, so the key is asked for once at boot
+    encryption_roots: Tuple[str, ...] = ("",)
+    scoped_dev_nodes: bool = True
+    vdev_width: int = 0
+    keyformat: str = "passphrase"
+    keylocation: str = "prompt"
+    scratch: str = "none"
 
 
 class PartitionConfig(NamedTuple):
@@ -29,6 +52,7 @@ class PartitionConfig(NamedTuple):
     boot: str
     swap: str
     root: str
+    wipe: str = "ask"
 
 
 class NixOSConfig(NamedTuple):
@@ -42,9 +66,139 @@ class NixOSConfig(NamedTuple):
 
 
 class Bootloader(NamedTuple):
-    """Information about the bootloader."""
+    """Information about the bootloader.
+
+    systemd-boot reads the kernels and initrds from the ESP, so its
+    installs can go without a boot pool (`bpool` False); the ESPs are
+    then sized for the kernels and kept in sync. GRUB always boots from
+    the boot pool.
+    """
+
+    name: str
+    bpool: bool = True
+
+
+class SwapConfig(NamedTuple):
+    """Information about the swap strategy.
+
+    The strategy is one of 'none', 'partition' (an encrypted swap
+    partition on every disk) or 'zram' (compressed swap in memory).
+    """
+
+    strategy: str = "partition"
+    zram_percent: int = 50
+    zram_algorithm: str = "zstd"
+    swappiness: Optional[int] = None
+    writeback_device: str = ""
+
+
+class MaintenanceConfig(NamedTuple):
+    """Information about scrubs, trims and automatic snapshots.
+
+    Scrubs run monthly and trims weekly, starting within the `night_hours`
+    after `night_start`; the host id picks the day and time, so the hosts
+    of a fleet do not scan their disks at once. From `business_start` to
+    `business_end` on weekdays, running scans are throttled to
+    `scan_vdev_limit_mib` in flight per vdev. Automatic snapshots keep
+    the given number of snapshots per period.
+    """
+
+    enable: bool = False
+    night_start: int = 0
+    night_hours: int = 6
+    business_start: int = 8
+    business_end: int = 18
+    scan_vdev_limit_mib: int = 4
+    snapshots_frequent: int = 4
+    snapshots_hourly: int = 24
+    snapshots_daily: int = 7
+    snapshots_weekly: int = 4
+    snapshots_monthly: int = 12
+
+
+class ServicesConfig(NamedTuple):
+    """Information about the optional services added to zfs.nix.
+
+    The ARC warm-up service prefetches the system closure into the ARC
+    after boot, reading up to `arc_warmup_percent` of the ARC maximum
+    with `arc_warmup_jobs` parallel readers.
+
+    The metrics exporter writes the ARC, dbuf, txg and pool I/O kstats
+    to `metrics_dir` every `metrics_interval` seconds, for the textfile
+    collector of the Prometheus node exporter.
+    """
+
+    arc_warmup: bool = False
+    arc_warmup_percent: int = 50
+    arc_warmup_jobs: int = 4
+    maintenance: MaintenanceConfig = MaintenanceConfig()
+    metrics: bool = False
+    metrics_interval: int = 15
+    metrics_dir: str = "/var/lib/prometheus-node-exporter-text-files"
+
+
+class CacheConfig(NamedTuple):
+    """Information about the local binary caches to install from.
+
+    The `substituters` are directories or store URLs asked before the
+    upstream cache, which is left out when `offline`. Their paths must be
+    signed by one of the `trusted_public_keys`.
+    """
+
+    substituters: Tuple[str, ...] = ()
+    trusted_public_keys: Tuple[str, ...] = ()
+    offline: bool = False
+
+
+class DataPoolConfig(NamedTuple):
+    """Information about an optional pool for bulk data.
+
+    The pool is built from whole disks other than the system disks, so
+    OS and Nix I/O never compete with data I/O. Its `datasets` are
+    mounted below `mountpoint`, encrypted with the key of the root pool
+    if `encryption` is set.
+    """
+
+    name: str = "dpool"
+    disks: Tuple[str, ...] = ()
+    topology: str = "raidz2"
+    vdev_width: int = 0
+    compression: str = "zstd"
+    recordsize: int = 1024**2
+    mountpoint: str = "/data"
+    datasets: Tuple[str, ...] = ()
+    encryption: bool = True
+
+
+class VolumeConfig(NamedTuple):
+    """A ZFS volume to create, e.g. for a VM disk or a database.
+
+    The `profile` names one of `zfs.VOLUME_PROFILES`, which sets the
+    volblocksize and caching for the workload. The volume is created on
+    `pool`, the root pool or the data pool.
+    """
 
     name: str
+    size: str
+    profile: str = "vm"
+    pool: str = "rpool"
+    sparse: bool = True
+
+
+class VerifyConfig(NamedTuple):
+    """Information about the checks run before the pools are exported.
+
+    The smoke test writes `size_mib` per job with `jobs` parallel jobs on
+    the key datasets; the install fails below `min_write_mbps` or
+    `min_read_mbps`, or above `max_fsync_p99_ms`.
+    """
+
+    enable: bool = True
+    size_mib: int = 64
+    jobs: int = 4
+    min_write_mbps: float = 50.0
+    min_read_mbps: float = 100.0
+    max_fsync_p99_ms: float = 100.0
 
 
 class ZfsSystemConfig(NamedTuple):
@@ -54,19 +208,46 @@ class ZfsSystemConfig(NamedTuple):
     part: PartitionConfig
     nixos: NixOSConfig
     bootloader: Bootloader
+    swap: SwapConfig = SwapConfig()
+    services: ServicesConfig = ServicesConfig()
+    cache: CacheConfig = CacheConfig()
+    verify: VerifyConfig = VerifyConfig()
+    data: DataPoolConfig = DataPoolConfig()
+    volumes: Tuple[VolumeConfig, ...] = ()
 
 
-class BlockDevice(NamedTuple):
-    """Information about a block device."""
+def has_swap_partition(config: ZfsSystemConfig) -> bool:
+    """Whether a swap partition is created on every disk."""
+    return config.swap.strategy == "partition" and config.part.swap not in ("", "0")
+
+
+def has_bpool(config: ZfsSystemConfig) -> bool:
+    """Whether the kernels are on a boot pool rather than on the ESPs."""
+    return bootloader_has_bpool(bootloader=config.bootloader)
+
+
+def bootloader_has_bpool(bootloader: Bootloader) -> bool:
+    """Whether a bootloader reads the kernels from a boot pool."""
+    return bootloader.bpool or bootloader.name != "systemd-boot"
 
-    name: str
-    kname: str
-    path: str
-    model: str
-    serial: str
-    size: str
-    type: str
-    id: str = ""
+
+def get_pools(config: ZfsSystemConfig) -> List[str]:
+    """Returns the names of the pools the system is installed on."""
+    pools = ["bpool", "rpool"] if has_bpool(config=config) else ["rpool"]
+    if config.data.disks:
+        pools.append(config.data.name)
+    return pools
+
+
+def get_pool_members(config: ZfsSystemConfig) -> List[str]:
+    """Returns the by-id paths of every partition that is a pool vdev.
+
+    Whole disks of the data pool are partitioned by ZFS, which puts the
+    vdev in the first partition.
+    """
+    nums = (2, 3) if has_bpool(config=config) else (3,)
+    members = [f"{disk}-part{num}" for disk in config.zfs.disks for num in nums]
+    return members + [f"{disk}-part1" for disk in config.data.disks]
 
 
 class DiskById(NamedTuple):
@@ -80,33 +261,107 @@ def prepare() -> ZfsSystemConfig:
     """Queries the user for ZFS topology, disk selection, and
     partitioning information.
 
+    Device probing and the cipher benchmark run in the background from
+    the start. Once the disks are confirmed, their throughput probe and
+    the evaluation of the system closure are started while the remaining
+    questions are answered. Nothing is written to the disks: the wipe is
+    left to `partition`.
+
     Returns:
         A system configuration object.
     """
-    disks = get_disks()
+    speculation = Speculation()
+    try:
+        return _prepare(speculation=speculation)
+    finally:
+        speculation.shutdown()
+
+
+def _prepare(speculation: Speculation) -> ZfsSystemConfig:
+    speculation.start("block_devices", get_block_devices)
+    speculation.start("disks_by_id", get_disks_by_id)
+    speculation.start("cipher", cipher.get_fastest_cipher)
+
+    disks = get_disks(speculation=speculation)
     primary_disk = disks[0]
+    speculation.start(
+        "throughput",
+        get_read_throughput,
+        disks,
+        key=tuple(disks),
+        cancellable=True,
+    )
+    speculation.start(
+        "closure",
+        closure.evaluate_closure,
+        "systemd-boot",
+        key="systemd-boot",
+        cancellable=True,
+    )
+
+    wipe_disks = get_wipe()
+
     bootloader_config = get_boot_loader()
+    speculation.start(
+        "closure",
+        closure.evaluate_closure,
+        bootloader_config.name,
+        key=bootloader_config.name,
+        cancellable=True,
+    )
 
     compatability = "off"
     if bootloader_config.name == "grub":
         compatability = "grub2"
 
+    if speculation.ready("throughput"):
+        print_read_throughput(speculation.result("throughput"))
+
+    disk_sizes = capacity.get_disk_sizes(disks=disks)
+    bpool = bootloader_has_bpool(bootloader=bootloader_config)
+    print_topology_capacities(disk_sizes=disk_sizes, bpool=bpool)
+
+    topology = get_topology()
+    keyformat, keylocation = get_encryption_key()
     zfs_config = ZfsConfig(
         os_id="nixos",
         disks=disks,
         primary_disk=primary_disk,
-        topology=get_topology(),
+        topology=topology,
         compatability=compatability,
+        vdev_width=get_vdev_width(disks=disks, topology=topology),
+        encryption=speculation.result("cipher", cipher.get_fastest_cipher),
+        keyformat=keyformat,
+        keylocation=keylocation,
+        scratch=get_scratch(),
     )
+    data_config = get_data_pool_config(speculation=speculation, system_disks=disks)
 
     sys_mem_gb = get_system_memory(size="GiB")
+    swap_config = get_swap_config(sys_mem_gb=sys_mem_gb)
+    layout = get_disk_layout(
+        disk_sizes=disk_sizes,
+        zfs_config=zfs_config,
+        swap=sys_mem_gb if swap_config.strategy == "partition" else None,
+        bpool=bpool,
+    )
+
+    wipe_state = "yes" if wipe_disks else "no"
+
     part_config = PartitionConfig(
-        esp=get_partition_size(name="ESP", value=2),
-        boot=get_partition_size(name="BOOT", value=4),
-        swap=get_partition_size(name="SWAP", value=sys_mem_gb),
-        root=get_partition_size(name="ROOT"),
+        esp=str(layout.esp),
+        boot=str(layout.boot),
+        swap=str(layout.swap),
+        root=str(layout.root),
+        wipe=wipe_state,
     )
 
+    services_config = get_services_config()
+    cache_config = get_cache_config()
+
+    if speculation.ready("closure"):
+        print_closure_estimate(speculation.result("closure"))
+
     nixos_config = NixOSConfig(
         config="configuration.nix",
         hw_old="hardware-configuration.nix",
@@ -120,20 +375,39 @@ def prepare() -> ZfsSystemConfig:
         part=part_config,
         nixos=nixos_config,
         bootloader=bootloader_config,
+        swap=swap_config,
+        services=services_config,
+        cache=cache_config,
+        data=data_config,
     )
     return sys_config
 
 
-def get_disks() -> List[str]:
+def get_disks(
+    speculation: Optional[Speculation] = None, exclude: Sequence[str] = ()
+) -> List[str]:
     """Creates a valid list of disks for the user to select and returns
     a list of the selected disks.
 
+    Args:
+        speculation: Background tasks that may already have probed the
+            block devices.
+        exclude: Disks by id that cannot be selected.
+
     Returns:
         A list of disks by id.
     """
-    blk_devs = get_block_devices()
-    disks_by_id = get_disks_by_id()
+    if speculation is None:
+        speculation = Speculation()
+        try:
+            return get_disks(speculation=speculation, exclude=exclude)
+        finally:
+            speculation.shutdown()
+
+    blk_devs = speculation.result("block_devices", get_block_devices)
+    disks_by_id = speculation.result("disks_by_id", get_disks_by_id)
     blk_devs = add_id_to_block_devices(blk_devs, disks_by_id)
+    blk_devs = [dev for dev in blk_devs if dev.id not in exclude]
     selection = ask_for_disk_selection(blk_devs)
     return selection
 
@@ -141,16 +415,30 @@ def get_disks() -> List[str]:
 def ask_for_disk_selection(blk_devs: List[BlockDevice]) -> List[str]:
     """Queries the user for a selection of disks to add to the zpool.
 
+    Up to `inventory.PAGE_SIZE` disks are shown in a single checkbox.
+    Larger inventories are selected through filter expressions, model
+    groups and paged checkboxes.
+
     Returns:
-        A list of disks by id.
+        A list of disks by id, in enclosure slot order.
     """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    inv = Inventory(blk_devs)
     keys = ("id", "path", "size")
-    formatted_blk_devs = tabulate_block_devices(blk_devs=blk_devs, keys=keys)
+    if len(inv) > inventory.PAGE_SIZE:
+        keys = ("id", "model", "size", "tran", "rota", "slot")
 
     while True:
-        response = questionary.checkbox(
-            message="Select disks to add to the pool", choices=formatted_blk_devs
-        ).ask()
+        if len(inv) > inventory.PAGE_SIZE:
+            response = ask_for_inventory_selection(inv=inv, keys=keys)
+        else:
+            rows = inv.rows(inv.devices, keys=keys)
+            response = questionary.checkbox(
+                message="Select disks to add to the pool", choices=rows
+            ).ask()
+            response = [row.split()[0] for row in response]
 
         if len(response) == 0:
             no_disk_color = "\033[0;31m"
@@ -158,7 +446,7 @@ def ask_for_disk_selection(blk_devs: List[BlockDevice]) -> List[str]:
             sleep(1)
             continue
 
-        selection = [resp.split()[0] for resp in response]
+        selection = [dev.id for dev in inv.devices if dev.id in set(response)]
 
         sel_color = "\033[1;2;36m"
         print(sel_color + "Selected disks:\n" + "\n".join(selection))
@@ -174,6 +462,80 @@ def ask_for_disk_selection(blk_devs: List[BlockDevice]) -> List[str]:
     return selection
 
 
+def ask_for_inventory_selection(inv: Inventory, keys: Sequence[str]) -> List[str]:
+    """Queries the user for disks out of a large inventory.
+
+    Args:
+        inv: The indexed block devices.
+        keys: The block device attributes shown in the table.
+
+    Returns:
+        A list of selected disks by id.
+
+    Raises:
+        KeyboardInterrupt: If a prompt is cancelled; `unsafe_ask` raises
+            instead of returning None.
+    """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    selected = set()
+    view = inv.devices
+    while True:
+        pages = inventory.paginate(view)
+        action = questionary.select(
+            message=f"{len(selected)} of {len(inv)} disks selected, "
+            f"{len(view)} in view",
+            choices=[
+                "Filter disks",
+                "Select disks in view",
+                "Select a model group",
+                *(f"Browse page {num + 1}/{len(pages)}" for num in range(len(pages))),
+                "Clear selection",
+                "Done",
+            ],
+        ).unsafe_ask()
+
+        match action.split()[0]:
+            case "Filter":
+                expression = questionary.text(
+                    message="Filter (e.g. model=ST16000* size>=10T tran=sas "
+                    "rota=1 slot=0-23), empty for all:"
+                ).unsafe_ask()
+                try:
+                    view = inv.filter(expression)
+                except ValueError as err:
+                    print(f"\033[0;31m{err}")
+            case "Select":
+                if action == "Select a model group":
+                    groups = inv.groups()
+                    model = questionary.select(
+                        message="Select a model group",
+                        choices=[
+                            questionary.Choice(f"{model} ({len(devs)})", value=model)
+                            for model, devs in groups.items()
+                        ],
+                    ).unsafe_ask()
+                    selected.update(dev.id for dev in groups[model])
+                else:
+                    selected.update(dev.id for dev in view)
+            case "Browse":
+                page = pages[int(action.split()[2].split("/")[0]) - 1]
+                choices = [
+                    questionary.Choice(row, value=dev.id, checked=dev.id in selected)
+                    for dev, row in zip(page, inv.rows(page, keys=keys))
+                ]
+                response = questionary.checkbox(
+                    message="Select disks to add to the pool", choices=choices
+                ).unsafe_ask()
+                selected.difference_update(dev.id for dev in page)
+                selected.update(response)
+            case "Clear":
+                selected.clear()
+            case "Done":
+                return list(selected)
+
+
 def tabulate_block_devices(
     blk_devs: List[BlockDevice], keys: Sequence[str]
 ) -> List[str]:
@@ -186,7 +548,7 @@ def tabulate_block_devices(
     Returns:
         The formatted list of strings representing the block devices.
     """
-    dev_list = [[getattr(dev, key) for key in keys] for dev in blk_devs]
+    dev_list = [[inventory.format_cell(dev, key) for key in keys] for dev in blk_devs]
     min_col_widths = [len(max(col, key=len)) + 3 for col in zip(*dev_list)]
     row_format = "".join([f"{{:>{width}}}" for width in min_col_widths])
     return [row_format.format(*row) for row in dev_list]
@@ -195,25 +557,35 @@ def tabulate_block_devices(
 def get_block_devices() -> List[BlockDevice]:
     """Creates a list of block devices that are disk types.
 
+    Sizes are in bytes and devices in an enclosure get their slot.
+
     Returns:
         A list of block devices.
     """
     # pylint: disable=no-member
     # pylint: disable=protected-access
     blk_fields = BlockDevice._fields
-    non_blk_fields = BlockDevice._field_defaults.keys()
-    lsblk_cols = ",".join((key for key in blk_fields if key not in non_blk_fields))
+    lsblk_cols = ",".join(
+        (key for key in blk_fields if key not in inventory.DERIVED_FIELDS)
+    )
 
-    process = subprocess.run(
-        f"lsblk -d --json -o {lsblk_cols}".split(),
+    process = trace.run(
+        f"lsblk -b -d --json -o {lsblk_cols}".split(),
         capture_output=True,
         text=True,
         check=False,
     )
     block_devices = json.loads(process.stdout)["blockdevices"]
-    block_devices = [BlockDevice(**dev) for dev in block_devices]
+    block_devices = [
+        BlockDevice(**dev)._replace(
+            model=(dev["model"] or "").strip(),
+            size=int(dev["size"] or 0),
+            rota=dev["rota"] in (True, "1", 1),
+        )
+        for dev in block_devices
+    ]
     disks_only = list(filter(lambda dev: dev.type == "disk", block_devices))
-    return disks_only
+    return inventory.add_slot_to_block_devices(disks_only)
 
 
 def get_disks_by_id() -> List[DiskById]:
@@ -246,12 +618,16 @@ def add_id_to_block_devices(
     Returns:
         A new list of block devices.
     """
+    ids_by_path: Dict[str, List[str]] = {}
+    for disk in sorted(disks_by_id):
+        ids_by_path.setdefault(disk.path, []).append(disk.id)
+
     new_blk_devs = []
     for dev in blk_devs:
-        for disk in disks_by_id:
-            if dev.path == disk.path and dev.serial in disk.id:
-                new_blk_devs.append(dev._replace(id=disk.id))
-                continue
+        for disk_id in ids_by_path.get(dev.path, []):
+            if dev.serial in disk_id:
+                new_blk_devs.append(dev._replace(id=disk_id))
+                break
     return new_blk_devs
 
 
@@ -261,6 +637,9 @@ def get_topology() -> str:
     Returns:
         The zpool topology.
     """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
     response = questionary.select(
         message="Select a vdev topology.",
         choices=["single", "mirror", "raidz1", "raidz2", "raidz3"],
@@ -271,6 +650,187 @@ def get_topology() -> str:
     return response
 
 
+def get_vdev_width(disks: List[str], topology: str) -> int:
+    """Queries the user for the number of disks per vdev.
+
+    Redundant topologies over many disks are split into several vdevs,
+    assigned in the order the disks were selected.
+
+    Returns:
+        The number of disks per vdev, 0 for a single vdev.
+    """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    if not topology or len(disks) <= inventory.PAGE_SIZE // 2:
+        return 0
+
+    while True:
+        response = questionary.text(
+            message=f"Disks per {topology} vdev (0 for a single vdev) [0]:",
+            default="0",
+        ).ask()
+        try:
+            vdevs = inventory.assign_vdevs(disks=disks, width=int(response))
+        except ValueError as err:
+            print(f"\033[0;31m{err}")
+            continue
+
+        for num, vdev in enumerate(vdevs):
+            print(f"{topology}-{num}: " + " ".join(Path(d).name for d in vdev))
+        return int(response)
+
+
+def get_data_pool_config(
+    speculation: Speculation, system_disks: Sequence[str]
+) -> DataPoolConfig:
+    """Queries the user for an optional whole-disk data pool.
+
+    Returns:
+        Information about the data pool, without disks if declined.
+    """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    create = questionary.confirm(
+        message="Create a separate data pool on other disks?", default=False
+    ).ask()
+    if not create:
+        return DataPoolConfig()
+
+    disks = get_disks(speculation=speculation, exclude=system_disks)
+    disk_sizes = capacity.get_disk_sizes(disks=disks)
+    size = min(disk_sizes.values()) // capacity.GIB
+    capacities = capacity.get_topology_capacities(num_disks=len(disks), root=size)
+    for topology, pool_size in capacities.items():
+        print(f"{topology or 'single':>10}: {pool_size} GiB")
+
+    while True:
+        topology = get_topology()
+        vdev_width = get_vdev_width(disks=disks, topology=topology)
+        try:
+            capacity.get_pool_capacity(
+                num_disks=len(disks),
+                root=size,
+                topology=topology,
+                vdev_width=vdev_width,
+            )
+        except ValueError as err:
+            print(f"\033[0;31m{err}")
+            continue
+        break
+
+    datasets = questionary.text(
+        message=f"Datasets below {DataPoolConfig().mountpoint} (space separated)",
+        default="",
+    ).unsafe_ask()
+
+    return DataPoolConfig(
+        disks=tuple(disks),
+        topology=topology,
+        vdev_width=vdev_width,
+        datasets=tuple(datasets.split()),
+    )
+
+
+def get_scratch() -> str:
+    """Queries the user for the use of a scratch dataset for builds.
+
+    Returns:
+        'none', 'install' (destroyed after the install) or 'persistent'
+        (kept as the nix-daemon build directory).
+    """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    return questionary.select(
+        message="Build on a scratch dataset instead of the RAM-backed /tmp?",
+        choices=[
+            questionary.Choice("During the install only", value="install"),
+            questionary.Choice("On the installed system too", value="persistent"),
+            questionary.Choice("No", value="none"),
+        ],
+        default="install",
+    ).ask()
+
+
+def get_encryption_key() -> Tuple[str, str]:
+    """Queries the user for the encryption key of the encryption roots.
+
+    By default the OS dataset of the root pool is the only encryption
+    root, so the key is asked for once at boot; `/nix` is kept out of it
+    and stays unencrypted.
+
+    A passphrase is entered twice, a raw or hex key is read from an
+    existing key file or generated. The key is written to a file on a
+    tmpfs, so the datasets can be created without prompting; the plan
+    only records the key format and the keylocation used afterwards.
+    Raw and hex keys cannot be typed at the boot prompt, so their
+    keylocation at boot is asked for: a file on removable media or a
+    URL, never a file on the disks being encrypted.
+
+    Returns:
+        The keyformat and the keylocation to set once created.
+    """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    print("The key is asked for once at boot; /nix is not encrypted.")
+    keyformat = questionary.select(
+        message="Select the encryption key format.",
+        choices=["passphrase", "hex", "raw"],
+        default="passphrase",
+    ).unsafe_ask()
+
+    while True:
+        keylocation = "prompt"
+        if keyformat == "passphrase":
+            key = questionary.password(
+                message="Enter the encryption passphrase."
+            ).unsafe_ask()
+            repeat = questionary.password(message="Repeat the passphrase.").unsafe_ask()
+            if key != repeat:
+                print("\033[0;31mThe passphrases do not match.")
+                continue
+            key = key.encode()
+        else:
+            path = questionary.text(
+                message=f"Path of an existing {keyformat} key file "
+                "(leave empty to generate one):",
+                default="",
+            ).unsafe_ask()
+            if path:
+                try:
+                    key = Path(path).read_bytes()
+                except OSError as err:
+                    print(f"\033[0;31m{err}")
+                    continue
+                key = key.strip() if keyformat == "hex" else key
+            else:
+                key = keyfile.generate_key(keyformat=keyformat)
+                if keyformat == "hex":
+                    print(f"Generated key, keep a copy: {key.decode()}")
+                else:
+                    print(f"Generated key, keep a copy (`xxd -r -p`): {key.hex()}")
+
+            print(
+                "The key must be reachable from the initrd, e.g. on removable "
+                "media or over the network."
+            )
+            keylocation = questionary.text(
+                message="Keylocation of the key at boot (file:// or https://):",
+                default=f"file://{Path(path).resolve()}" if path else "",
+            ).unsafe_ask()
+
+        try:
+            keyfile.validate_keylocation(keylocation=keylocation)
+            keyfile.write_key(key=key, keyformat=keyformat)
+        except ValueError as err:
+            print(f"\033[0;31m{err}")
+            continue
+        return keyformat, keylocation
+
+
 def get_partition_size(name: str, value: Optional[int] = None) -> str:
     """Queries the user for a partition size.
 
@@ -281,12 +841,310 @@ def get_partition_size(name: str, value: Optional[int] = None) -> str:
     Returns:
         The user specified value of the partition size.
     """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
     _value = "" if value is None else value
     input_str = f"Set {name} partition size in GiB [{_value}]:"
     response = questionary.text(message=input_str, default=str(_value)).ask()
     return response
 
 
+def get_disk_layout(
+    disk_sizes: Dict[str, int],
+    zfs_config: ZfsConfig,
+    swap: Optional[int],
+    bpool: bool = True,
+) -> capacity.DiskLayout:
+    """Queries the user for partition sizes that fit every disk.
+
+    The root partition defaults to the largest size that fits the
+    smallest disk after the headroom, so all pool members are equal.
+
+    Args:
+        disk_sizes: A mapping of disk to size in bytes.
+        zfs_config: The pool topology and disks.
+        swap: The default swap partition size in GiB, None for no swap
+            partition.
+        bpool: Whether to create a boot pool partition. Without one, the
+            ESP holds the kernels and defaults to a larger size.
+
+    Returns:
+        The validated partition sizes in GiB.
+    """
+    while True:
+        try:
+            esp = int(get_partition_size(name="ESP", value=2 if bpool else 4))
+            boot = 0
+            if bpool:
+                boot = int(get_partition_size(name="BOOT", value=4))
+            swap_size = 0
+            if swap is not None:
+                swap_size = int(get_partition_size(name="SWAP", value=swap))
+            headroom = get_headroom()
+            root = capacity.get_root_size(
+                disk_sizes=disk_sizes,
+                esp=esp,
+                boot=boot,
+                swap=swap_size,
+                headroom=headroom,
+            )
+            root = int(get_partition_size(name="ROOT", value=root))
+
+            layout = capacity.DiskLayout(esp=esp, boot=boot, swap=swap_size, root=root)
+            capacity.validate_layout(
+                disk_sizes=disk_sizes,
+                layout=layout,
+                topology=zfs_config.topology,
+                vdev_width=zfs_config.vdev_width,
+            )
+        except ValueError as err:
+            print(f"\033[0;31m{err}")
+            continue
+
+        pool_capacity = capacity.get_pool_capacity(
+            num_disks=len(disk_sizes),
+            root=root,
+            topology=zfs_config.topology,
+            vdev_width=zfs_config.vdev_width,
+        )
+        print(f"Usable root pool capacity: {pool_capacity} GiB")
+        return layout
+
+
+def get_headroom() -> float:
+    """Queries the user for the share of each disk to leave unpartitioned.
+
+    Returns:
+        The headroom as a fraction.
+    """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    response = questionary.text(
+        message="Reserve % of the smallest disk for drive replacement [1]:",
+        default="1",
+    ).ask()
+    return float(response) / 100
+
+
+def print_topology_capacities(disk_sizes: Dict[str, int], bpool: bool = True) -> None:
+    """Prints the usable root pool capacity of every topology.
+
+    The ESP and boot pool partitions take the default sizes of
+    `get_disk_layout`.
+    """
+    root = capacity.get_root_size(
+        disk_sizes=disk_sizes,
+        esp=2 if bpool else 4,
+        boot=4 if bpool else 0,
+        swap=0,
+        headroom=0.01,
+    )
+    smallest = min(disk_sizes.values()) / capacity.GIB
+    largest = max(disk_sizes.values()) / capacity.GIB
+    print(
+        f"{len(disk_sizes)} disks from {smallest:.1f} to {largest:.1f} GiB, "
+        f"{root} GiB root partitions:"
+    )
+    capacities = capacity.get_topology_capacities(num_disks=len(disk_sizes), root=root)
+    for topology, size in capacities.items():
+        print(f"{topology or 'single':>10}: {size} GiB")
+
+
+def get_wipe() -> bool:
+    """Queries the user whether the selected disks should be wiped."""
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    return questionary.confirm(
+        message="Wipe the selected disks (recommended)?", auto_enter=False
+    ).ask()
+
+
+def get_swap_config(sys_mem_gb: int) -> SwapConfig:
+    """Queries the user for a swap strategy.
+
+    The zram size and compression algorithm are computed from the system
+    memory and CPU count.
+
+    Args:
+        sys_mem_gb: The total system memory in GiB.
+
+    Returns:
+        Information about the swap strategy.
+    """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    strategy = questionary.select(
+        message="Select a swap strategy.",
+        choices=["partition", "zram", "none"],
+        default="partition",
+    ).ask()
+
+    if strategy != "zram":
+        return SwapConfig(strategy=strategy)
+
+    zram_percent = get_zram_percent(sys_mem_gb=sys_mem_gb)
+    zram_algorithm = "zstd" if (os.cpu_count() or 1) >= 4 else "lz4"
+
+    swappiness = questionary.text(
+        message="Set vm.swappiness [180]:",
+        default="180",
+        validate=lambda val: val.isdigit() and 0 <= int(val) <= 200,
+    ).ask()
+    writeback_device = questionary.text(
+        message="Set a zram writeback device (leave empty for none):", default=""
+    ).ask()
+
+    return SwapConfig(
+        strategy=strategy,
+        zram_percent=zram_percent,
+        zram_algorithm=zram_algorithm,
+        swappiness=int(swappiness),
+        writeback_device=writeback_device,
+    )
+
+
+def get_services_config() -> ServicesConfig:
+    """Queries the user for the optional services to enable.
+
+    Returns:
+        Information about the optional services.
+    """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    services = questionary.checkbox(
+        message="Select optional services",
+        choices=[
+            questionary.Choice(
+                "ARC warm-up (prefetch the system closure after boot)",
+                value="arc_warmup",
+            ),
+            questionary.Choice(
+                "Scrub, trim and auto-snapshots (staggered by host id)",
+                value="maintenance",
+                checked=True,
+            ),
+            questionary.Choice(
+                "ZFS metrics (Prometheus textfile exporter)",
+                value="metrics",
+            ),
+        ],
+    ).ask()
+
+    return ServicesConfig(
+        arc_warmup="arc_warmup" in services,
+        arc_warmup_jobs=min(max(os.cpu_count() or 1, 2), 8),
+        maintenance=MaintenanceConfig(enable="maintenance" in services),
+        metrics="metrics" in services,
+    )
+
+
+def get_cache_config() -> CacheConfig:
+    """Queries the user for local binary caches to install from.
+
+    Returns:
+        Information about the local binary caches.
+    """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
+    from pybootstrap.substituters import is_binary_cache
+
+    substituters = questionary.text(
+        message="Local binary caches to try first (space separated, empty for none)",
+        validate=lambda val: all(is_binary_cache(cache) for cache in val.split())
+        or "Not a binary cache (no nix-cache-info).",
+    ).ask()
+    if not substituters.split():
+        return CacheConfig()
+
+    keys = questionary.text(
+        message="Public keys the caches are signed with (space separated)",
+        validate=lambda val: all(":" in key for key in val.split())
+        or "Expected name:key.",
+    ).ask()
+    offline = questionary.confirm(
+        message="Install without the upstream cache (offline)?", default=False
+    ).ask()
+
+    return CacheConfig(
+        substituters=tuple(substituters.split()),
+        trusted_public_keys=tuple(keys.split()),
+        offline=offline,
+    )
+
+
+def get_zram_percent(sys_mem_gb: int) -> int:
+    """Returns the zram size as a percentage of the system memory.
+
+    Small machines get zram as large as their memory, large machines
+    only need a fraction of it.
+    """
+    if sys_mem_gb <= 4:
+        return 100
+    if sys_mem_gb <= 16:
+        return 50
+    return 25
+
+
+def get_read_throughput(
+    disks: List[str],
+    size: int = 256 * 1024**2,
+    block_size: int = 1024**2,
+    cancelled: Optional[threading.Event] = None,
+) -> Optional[Dict[str, float]]:
+    """Measures the sequential direct read throughput of each disk.
+
+    Args:
+        disks: A list of disks by id.
+        size: The number of bytes to read from the start of each disk.
+        block_size: The size of each read.
+        cancelled: Stops the probe between two reads when set.
+
+    Returns:
+        A mapping of disk to MB/s, or None if cancelled.
+    """
+    throughput = {}
+    for disk in disks:
+        buffer = mmap.mmap(-1, block_size)
+        fd = os.open(disk, os.O_RDONLY | os.O_DIRECT)
+        try:
+            done = 0
+            start = perf_counter()
+            while done < size:
+                if cancelled is not None and cancelled.is_set():
+                    return None
+                read = os.readv(fd, [buffer])
+                if read <= 0:
+                    break
+                done += read
+            throughput[disk] = done / (perf_counter() - start) / 1e6
+        finally:
+            os.close(fd)
+            buffer.close()
+    return throughput
+
+
+def print_read_throughput(throughput: Dict[str, float]) -> None:
+    """Prints the measured read throughput of each disk."""
+    for disk, speed in throughput.items():
+        print(f"{Path(disk).name}: {speed:.0f} MB/s sequential read")
+
+
+def print_closure_estimate(estimate: Optional[closure.ClosureEstimate]) -> None:
+    """Prints how much the install is expected to build and fetch."""
+    if estimate is None:
+        return
+    print(
+        f"The system closure needs {estimate.builds} builds and "
+        f"{estimate.fetches} downloads ({estimate.download_mib:.1f} MiB)."
+    )
+
+
 def get_system_memory(size: str = "GiB") -> int:
     """Gets the total system memory in *iB (e.g. GiB) rounded up.
 
@@ -324,11 +1182,88 @@ def get_boot_loader() -> Bootloader:
     Returns:
         Information about the bootloader.
     """
+    # pylint: disable=import-outside-toplevel
+    import questionary
+
     message = "Select a bootloader."
     response = questionary.select(
         message=message, choices=["systemd-boot", "grub"], default="systemd-boot"
     ).ask()
-    return Bootloader(name=response)
+    if response != "systemd-boot":
+        return Bootloader(name=response)
+
+    bpool = questionary.confirm(
+        message="Keep the kernels on a separate boot pool instead of the ESPs?",
+        default=False,
+    ).ask()
+    return Bootloader(name=response, bpool=bpool)
+
+
+def save_config(config: ZfsSystemConfig, path: Path) -> None:
+    """Writes a system configuration to a JSON plan file.
+
+    Args:
+        config: The system configuration to save.
+        path: The path of the plan file.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="UTF-8") as file:
+        json.dump(_to_plain(config), file, indent=2)
+        file.write("\n")
+
+
+def load_config(path: Path) -> ZfsSystemConfig:
+    """Reads a system configuration from a JSON plan file.
+
+    Args:
+        path: The path of the plan file.
+
+    Returns:
+        A system configuration object.
+    """
+    with open(path, "r", encoding="UTF-8") as file:
+        data = json.load(file)
+    return _from_plain(ZfsSystemConfig, data)
+
+
+def _to_plain(value: Any) -> Any:
+    """Converts nested named tuples into JSON serializable values."""
+    if hasattr(value, "_asdict"):
+        return {key: _to_plain(val) for key, val in value._asdict().items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(val) for val in value]
+    if isinstance(value, Path):
+        return str(value)
+    return value
+
+
+def _from_plain(hint: Any, value: Any) -> Any:
+    """Rebuilds a value of type `hint` from its JSON representation."""
+    if value is None:
+        return None
+
+    if isinstance(hint, type) and issubclass(hint, tuple) and hasattr(hint, "_fields"):
+        hints = get_type_hints(hint)
+        kwargs = {
+            key: _from_plain(hints[key], val)
+            for key, val in value.items()
+            if key in hint._fields
+        }
+        return hint(**kwargs)
+
+    if get_origin(hint) in (list, List):
+        (item_hint,) = get_args(hint) or (Any,)
+        return [_from_plain(item_hint, val) for val in value]
+
+    if get_origin(hint) in (tuple, Tuple):
+        item_hint, *_ = get_args(hint) or (Any,)
+        return tuple(_from_plain(item_hint, val) for val in value)
+
+    if hint is Path:
+        return Path(value)
+
+    return value
 
 
 if __name__ == "__main__":
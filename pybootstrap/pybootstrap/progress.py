@@ -0,0 +1,180 @@
+"""A module for running long Nix commands with a progress line.
+
+The command runs as an asyncio subprocess whose stdout and stderr are
+read line by line as they arrive. Every line is written to a gzip
+compressed log, only the last lines are kept in memory for the error
+report, and Nix's plan and progress messages are turned into a status
+line with an ETA.
+"""
+import asyncio
+import gzip
+import re
+import subprocess
+import sys
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, List, Optional
+
+from pybootstrap import trace
+from pybootstrap.closure import BUILD_REGEX, FETCH_REGEX
+
+RING_LINES = 200
+LINE_LIMIT = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+REFRESH_SECONDS = 0.5
+FETCH_ONE_REGEX = re.compile(r"this path will be fetched \(([\d.]+) MiB download")
+BUILD_ONE_REGEX = re.compile(r"this derivation will be built")
+FETCHING_REGEX = re.compile(r"^copying path '.*' (from|to) ")
+BUILDING_REGEX = re.compile(r"^building '.*\.drv'")
+
+
+class Progress:
+    """Nix progress parsed from the output of a command."""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.builds = 0
+        self.fetches = 0
+        self.download_mib = 0.0
+        self.built = 0
+        self.fetched = 0
+
+    def parse(self, line: str) -> None:
+        """Updates the progress with a line of Nix output."""
+        if match := FETCH_REGEX.search(line):
+            self.fetches += int(match.group(1))
+            self.download_mib += float(match.group(2))
+        elif match := FETCH_ONE_REGEX.search(line):
+            self.fetches += 1
+            self.download_mib += float(match.group(1))
+        elif match := BUILD_REGEX.search(line):
+            self.builds += int(match.group(1))
+        elif BUILD_ONE_REGEX.search(line):
+            self.builds += 1
+        elif FETCHING_REGEX.search(line):
+            self.fetched += 1
+        elif BUILDING_REGEX.search(line):
+            self.built += 1
+
+    @property
+    def fraction(self) -> Optional[float]:
+        """The share of paths fetched or built, None before Nix planned."""
+        total = self.builds + self.fetches
+        if total == 0:
+            return None
+        return min((self.built + self.fetched) / total, 1.0)
+
+    @property
+    def downloaded_mib(self) -> float:
+        """The download estimated from the share of paths fetched."""
+        if self.fetches == 0:
+            return 0.0
+        return self.download_mib * min(self.fetched / self.fetches, 1.0)
+
+    def eta(self) -> Optional[float]:
+        """The seconds left at the rate paths were completed so far."""
+        fraction = self.fraction
+        if not fraction:
+            return None
+        elapsed = time.monotonic() - self.start
+        return elapsed / fraction - elapsed
+
+    def __str__(self) -> str:
+        elapsed = time.monotonic() - self.start
+        status = [f"{_duration(elapsed)}"]
+        if self.fetches:
+            status.append(
+                f"fetched {self.fetched}/{self.fetches} "
+                f"({self.downloaded_mib:.0f}/{self.download_mib:.0f} MiB)"
+            )
+        if self.builds:
+            status.append(f"built {self.built}/{self.builds}")
+        if self.fraction is not None:
+            status.append(f"{self.fraction:.0%}")
+        eta = self.eta()
+        if eta is not None:
+            status.append(f"ETA {_duration(eta)}")
+        return ", ".join(status)
+
+
+def _duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+def run(
+    cmd: List[str], log_path: Path, env: Optional[Dict[str, str]] = None
+) -> Progress:
+    """Runs a command with a progress line and a compressed log.
+
+    Args:
+        cmd: The command and its arguments.
+        log_path: The gzip compressed log of stdout and stderr.
+        env: The environment of the command.
+
+    Returns:
+        The final progress.
+
+    Raises:
+        subprocess.CalledProcessError: If the command fails. The last
+            lines of its output are printed before.
+    """
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    progress = Progress()
+    tail: Deque[str] = deque(maxlen=RING_LINES)
+    with trace.span(" ".join(cmd)) as result:
+        with gzip.open(log_path, "wt", encoding="UTF-8") as log:
+            returncode = asyncio.run(_run(cmd, env, log, progress, tail))
+        result["returncode"] = returncode
+
+    if sys.stderr.isatty():
+        sys.stderr.write("\n")
+    if returncode != 0:
+        print("".join(tail), end="", file=sys.stderr)
+        print(f"Full log: {log_path}", file=sys.stderr)
+        raise subprocess.CalledProcessError(returncode, cmd)
+    return progress
+
+
+async def _run(cmd, env, log, progress: Progress, tail: Deque[str]) -> int:
+    # pylint: disable=too-many-arguments
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        env=env,
+    )
+    shown = [0.0]
+
+    def handle(raw: bytes):
+        line = raw.decode(errors="replace")
+        log.write(line)
+        tail.append(line[:LINE_LIMIT])
+        progress.parse(line)
+        now = time.monotonic()
+        if now - shown[0] >= REFRESH_SECONDS:
+            shown[0] = now
+            _show(progress)
+
+    async def read(stream: asyncio.StreamReader):
+        # split lines by hand so that overlong lines are logged in full
+        buffered = b""
+        while chunk := await stream.read(CHUNK_SIZE):
+            *lines, buffered = (buffered + chunk).split(b"\n")
+            for raw in lines:
+                handle(raw + b"\n")
+            if len(buffered) > LINE_LIMIT:
+                handle(buffered)
+                buffered = b""
+        if buffered:
+            handle(buffered)
+
+    await asyncio.gather(read(process.stdout), read(process.stderr))
+    return await process.wait()
+
+
+def _show(progress: Progress) -> None:
+    if sys.stderr.isatty():
+        sys.stderr.write(f"\r\033[K{progress}")
+        sys.stderr.flush()
@@ -0,0 +1,259 @@
+"""A module for recording pool and host load while a command runs.
+
+`zpool iostat -Hpv <pools> <interval>` is streamed from a background
+thread. Every interval is stored together with the CPU times from
+`/proc/stat`, the available memory from `/proc/meminfo` and the busy
+time of each leaf device from sysfs, in two gzip compressed CSV files:
+
+- `iostat.csv.gz`: time, device, read/write operations and bytes per
+  second, utilization of leaf devices.
+- `host.csv.gz`: time, CPU busy and iowait shares, used memory.
+
+A JSON summary with the peak and mean write throughput of every vdev,
+the time each leaf device spent saturated and the CPU and memory peaks
+is written next to them when the sampler stops.
+"""
+import csv
+import gzip
+import json
+import os
+import subprocess
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence
+
+SATURATION = 0.95
+IOSTAT_FIELDS = ("read_ops", "write_ops", "read_bytes", "write_bytes")
+
+
+class HostSample(NamedTuple):
+    """CPU and memory counters of the host."""
+
+    busy: int
+    iowait: int
+    total: int
+    mem_used_mib: int
+
+
+class _DeviceStats:
+    """Running summary of one vdev or leaf device."""
+
+    def __init__(self):
+        self.samples = 0
+        self.write_sum = 0
+        self.write_peak = 0
+        self.saturated = 0.0
+
+    def add(self, write_bytes: int, util: Optional[float], interval: float):
+        self.samples += 1
+        self.write_sum += write_bytes
+        self.write_peak = max(self.write_peak, write_bytes)
+        if util is not None and util >= SATURATION:
+            self.saturated += interval
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "peak_write_mbps": round(self.write_peak / 1e6, 1),
+            "mean_write_mbps": round(self.write_sum / max(self.samples, 1) / 1e6, 1),
+            "saturated_seconds": round(self.saturated, 1),
+        }
+
+
+class Sampler:
+    """Samples the pools and the host until stopped.
+
+    Use as a context manager around the command to observe.
+    """
+
+    def __init__(self, pools: Sequence[str], log_dir: Path, interval: int = 1):
+        self.pools = list(pools)
+        self.log_dir = log_dir
+        self.interval = interval
+        self._process: Optional[subprocess.Popen] = None
+        self._thread: Optional[threading.Thread] = None
+        self._devices: Dict[str, _DeviceStats] = {}
+        self._stat_paths: Dict[str, Optional[Path]] = {}
+        self._cpu_busy_peak = 0.0
+        self._cpu_busy_sum = 0.0
+        self._cpu_iowait_sum = 0.0
+        self._mem_peak = 0
+        self._intervals = 0
+        self.summary: Dict[str, object] = {}
+
+    def __enter__(self) -> "Sampler":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Starts streaming `zpool iostat` in a background thread."""
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        self._process = subprocess.Popen(
+            ["zpool", "iostat", "-Hpv", *self.pools, str(self.interval)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        )
+        self._thread = threading.Thread(target=self._record, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Dict[str, object]:
+        """Stops sampling and writes the summary.
+
+        Returns:
+            The summary.
+        """
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+        if self._thread is not None:
+            self._thread.join()
+
+        self.summary = summary = {
+            "intervals": self._intervals,
+            "interval_seconds": self.interval,
+            "cpu_busy_mean": round(self._cpu_busy_sum / max(self._intervals, 1), 3),
+            "cpu_busy_peak": round(self._cpu_busy_peak, 3),
+            "cpu_iowait_mean": round(self._cpu_iowait_sum / max(self._intervals, 1), 3),
+            "mem_used_peak_mib": self._mem_peak,
+            "devices": {name: stats.summary() for name, stats in self._devices.items()},
+        }
+        with open(self.log_dir / "iostat-summary.json", "w", encoding="UTF-8") as file:
+            json.dump(summary, file, indent=2)
+        return summary
+
+    def _record(self):
+        iostat_file = gzip.open(self.log_dir / "iostat.csv.gz", "wt", newline="")
+        host_file = gzip.open(self.log_dir / "host.csv.gz", "wt", newline="")
+        with iostat_file, host_file:
+            iostat_csv = csv.writer(iostat_file)
+            iostat_csv.writerow(("time", "device", *IOSTAT_FIELDS, "util"))
+            host_csv = csv.writer(host_file)
+            host_csv.writerow(("time", "cpu_busy", "cpu_iowait", "mem_used_mib"))
+
+            start = time.monotonic()
+            host, ticks = read_host(), {}
+            rows: List[List[str]] = []
+            pool = ""
+            since_import = True
+            for line in self._process.stdout:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 7:
+                    continue
+                if fields[0] == self.pools[0] and rows:
+                    now = time.monotonic() - start
+                    new_host = read_host()
+                    new_ticks = self._read_ticks(name for name, *_ in rows)
+                    # the first interval holds the averages since import
+                    if not since_import:
+                        self._intervals += 1
+                        self._add_rows(now, rows, ticks, new_ticks, iostat_csv)
+                        self._add_host(now, host, new_host, host_csv)
+                    since_import = False
+                    host, ticks, rows = new_host, new_ticks, []
+                if fields[0] in self.pools:
+                    pool = fields[0]
+                name = pool if fields[0] == pool else f"{pool}/{fields[0]}"
+                rows.append([name, *fields[3:7]])
+
+    def _add_rows(self, now: float, rows, ticks, new_ticks, writer):
+        # pylint: disable=too-many-arguments
+        elapsed_ms = self.interval * 1000
+        for name, *values in rows:
+            try:
+                read_ops, write_ops, read_bytes, write_bytes = map(int, values)
+            except ValueError:
+                # section headers such as `logs` or `cache` have no values
+                continue
+            util = None
+            if name in ticks and name in new_ticks:
+                util = min((new_ticks[name] - ticks[name]) / elapsed_ms, 1.0)
+            self._devices.setdefault(name, _DeviceStats()).add(
+                write_bytes=write_bytes, util=util, interval=self.interval
+            )
+            writer.writerow(
+                (
+                    f"{now:.1f}",
+                    name,
+                    read_ops,
+                    write_ops,
+                    read_bytes,
+                    write_bytes,
+                    "" if util is None else f"{util:.2f}",
+                )
+            )
+
+    def _add_host(self, now: float, host: HostSample, new_host: HostSample, writer):
+        total = max(new_host.total - host.total, 1)
+        busy = (new_host.busy - host.busy) / total
+        iowait = (new_host.iowait - host.iowait) / total
+        self._cpu_busy_sum += busy
+        self._cpu_iowait_sum += iowait
+        self._cpu_busy_peak = max(self._cpu_busy_peak, busy)
+        self._mem_peak = max(self._mem_peak, new_host.mem_used_mib)
+        writer.writerow(
+            (f"{now:.1f}", f"{busy:.3f}", f"{iowait:.3f}", new_host.mem_used_mib)
+        )
+
+    def _read_ticks(self, names: Iterable[str]) -> Dict[str, int]:
+        """Reads the busy milliseconds of the leaf devices."""
+        ticks = {}
+        for name in names:
+            if name not in self._stat_paths:
+                self._stat_paths[name] = get_stat_path(name.rpartition("/")[2])
+            path = self._stat_paths[name]
+            if path is not None:
+                ticks[name] = int(path.read_text(encoding="UTF-8").split()[9])
+        return ticks
+
+
+def get_stat_path(device: str) -> Optional[Path]:
+    """Returns the sysfs stat file of a device named by its by-id link."""
+    link = Path("/dev/disk/by-id") / device
+    if not link.exists():
+        return None
+    kname = Path(os.path.realpath(link)).name
+    path = Path(f"/sys/class/block/{kname}/stat")
+    return path if path.exists() else None
+
+
+def read_host() -> HostSample:
+    """Reads the CPU time counters and the used memory."""
+    with open("/proc/stat", "r", encoding="UTF-8") as file:
+        cpu = [int(value) for value in file.readline().split()[1:]]
+    idle, iowait = cpu[3], cpu[4]
+    # guest time is already accounted in user and nice
+    total = sum(cpu[:8])
+
+    meminfo = {}
+    with open("/proc/meminfo", "r", encoding="UTF-8") as file:
+        for line in file:
+            key, value, *_ = line.split()
+            meminfo[key.rstrip(":")] = int(value)
+    mem_used = meminfo["MemTotal"] - meminfo.get("MemAvailable", meminfo["MemFree"])
+
+    return HostSample(
+        busy=total - idle - iowait,
+        iowait=iowait,
+        total=total,
+        mem_used_mib=mem_used // 1024,
+    )
+
+
+def print_summary(summary: Dict[str, object]):
+    """Prints the pool throughput and host load of a sampled command."""
+    print(
+        f"CPU busy {summary['cpu_busy_mean']:.0%} mean, "
+        f"{summary['cpu_busy_peak']:.0%} peak, "
+        f"iowait {summary['cpu_iowait_mean']:.0%}, "
+        f"memory {summary['mem_used_peak_mib']} MiB peak"
+    )
+    for name, stats in summary["devices"].items():
+        print(
+            f"{name}: write {stats['mean_write_mbps']} MB/s mean, "
+            f"{stats['peak_write_mbps']} MB/s peak, "
+            f"saturated {stats['saturated_seconds']} s"
+        )
@@ -0,0 +1,257 @@
+"""A module for predicting the wall time of a traced run offline.
+
+The steps of a trace recorded by `pybootstrap.trace` are turned into a
+dependency graph and replayed with a list scheduler under different
+concurrency limits and disk counts, without running any command.
+
+Dependencies are inferred from the disks a command names:
+
+- A command naming a single disk only waits for the previous command on
+  the same disk and for the last barrier.
+- Any other command (naming no disk or several, like `zpool create`) is
+  a barrier that waits for everything before it.
+- Stages run one after the other.
+
+Extra dependencies can be given as rules `{"after": regex, "before":
+regex}`: commands matching `before` wait for all earlier commands
+matching `after`. For other disk counts, the single-disk commands of the
+recorded disks are replicated round-robin with their recorded timings.
+"""
+import heapq
+import json
+import re
+from pathlib import Path
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Tuple
+
+from pybootstrap.trace import TraceStep, load_trace
+
+DISK_REGEX = re.compile(r"/dev/disk/by-id/([^\s/]+?)(?:-part\d+)?(?=[\s/]|$)")
+
+
+class Task(NamedTuple):
+    """A step of the dependency graph."""
+
+    id: int
+    stage: str
+    cmd: str
+    duration: float
+    disks: FrozenSet[str]
+    deps: FrozenSet[int] = frozenset()
+
+
+class Rule(NamedTuple):
+    """Commands matching `before` wait for earlier ones matching `after`."""
+
+    after: re.Pattern
+    before: re.Pattern
+
+
+class Prediction(NamedTuple):
+    """The predicted wall time of a run."""
+
+    disks: int
+    jobs: int
+    wall_time: float
+
+
+def get_disks(steps: Sequence[TraceStep]) -> List[str]:
+    """Returns the disks by id named in a trace, in order of appearance."""
+    disks: Dict[str, None] = {}
+    for step in steps:
+        for disk in DISK_REGEX.findall(step.cmd):
+            disks.setdefault(disk, None)
+    return list(disks)
+
+
+def get_tasks(steps: Sequence[TraceStep]) -> List[Task]:
+    """Turns the steps of a trace into tasks labelled with their disks."""
+    disks = get_disks(steps)
+    tasks = []
+    for num, step in enumerate(sorted(steps, key=lambda step: step.start)):
+        named = frozenset(disk for disk in disks if disk in step.cmd)
+        tasks.append(
+            Task(
+                id=num,
+                stage=step.stage,
+                cmd=step.cmd,
+                duration=step.duration,
+                disks=named,
+            )
+        )
+    return tasks
+
+
+def scale_disks(tasks: Sequence[Task], disks: int) -> List[Task]:
+    """Replicates or drops the single-disk tasks for another disk count.
+
+    Args:
+        tasks: The tasks of the recorded disks.
+        disks: The number of disks to predict for.
+
+    Returns:
+        The tasks for `disks` disks, renumbered.
+    """
+    recorded = sorted({disk for task in tasks for disk in task.disks})
+    if not recorded or disks == len(recorded):
+        return list(tasks)
+
+    scaled = []
+    for task in tasks:
+        if len(task.disks) != 1:
+            copies = [task.disks]
+        else:
+            index = recorded.index(next(iter(task.disks)))
+            copies = [
+                frozenset({f"disk{num}"})
+                for num in range(disks)
+                if num % len(recorded) == index
+            ]
+        for copy in copies:
+            scaled.append(task._replace(id=len(scaled), disks=copy))
+    return scaled
+
+
+def add_dependencies(tasks: Sequence[Task], rules: Sequence[Rule] = ()) -> List[Task]:
+    """Infers the dependencies of tasks in recorded order."""
+    base: Tuple[int, ...] = ()
+    since: List[int] = []
+    last_on_disk: Dict[str, int] = {}
+    stage: Optional[str] = None
+
+    result = []
+    for task in tasks:
+        if stage is not None and task.stage != stage:
+            base, since, last_on_disk = tuple(since) or base, [], {}
+        stage = task.stage
+
+        if len(task.disks) == 1:
+            disk = next(iter(task.disks))
+            deps = set(base)
+            if disk in last_on_disk:
+                deps.add(last_on_disk[disk])
+            last_on_disk[disk] = task.id
+            since.append(task.id)
+        else:
+            deps = set(base) | set(since)
+            base, since, last_on_disk = (task.id,), [], {}
+
+        for rule in rules:
+            if rule.before.search(task.cmd):
+                deps.update(
+                    earlier.id for earlier in result if rule.after.search(earlier.cmd)
+                )
+        result.append(task._replace(deps=frozenset(deps)))
+    return result
+
+
+def schedule(tasks: Sequence[Task], jobs: int) -> float:
+    """Replays the tasks with at most `jobs` running at once.
+
+    Ready tasks start in recorded order.
+
+    Returns:
+        The predicted wall time in seconds.
+
+    Raises:
+        ValueError: If `jobs` is less than one.
+    """
+    if jobs < 1:
+        raise ValueError(f"At least one job must run at once, not {jobs}.")
+    waiting = {task.id: len(task.deps) for task in tasks}
+    dependents: Dict[int, List[int]] = {task.id: [] for task in tasks}
+    for task in tasks:
+        for dep in task.deps:
+            dependents[dep].append(task.id)
+
+    durations = {task.id: task.duration for task in tasks}
+    ready = [task_id for task_id, count in waiting.items() if count == 0]
+    heapq.heapify(ready)
+    running: List[Tuple[float, int]] = []
+    now = 0.0
+    while ready or running:
+        while ready and len(running) < jobs:
+            task_id = heapq.heappop(ready)
+            heapq.heappush(running, (now + durations[task_id], task_id))
+        now, task_id = heapq.heappop(running)
+        for dependent in dependents[task_id]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                heapq.heappush(ready, dependent)
+    return now
+
+
+def critical_path(tasks: Sequence[Task]) -> List[Task]:
+    """Returns the longest chain of dependent tasks."""
+    finish: Dict[int, float] = {}
+    previous: Dict[int, Optional[int]] = {}
+    for task in tasks:
+        dep = max(task.deps, key=lambda dep: finish[dep], default=None)
+        finish[task.id] = task.duration + (finish[dep] if dep is not None else 0.0)
+        previous[task.id] = dep
+
+    if not finish:
+        return []
+    path = []
+    task_id: Optional[int] = max(finish, key=finish.get)
+    while task_id is not None:
+        path.append(tasks[task_id])
+        task_id = previous[task_id]
+    return path[::-1]
+
+
+def load_rules(path: Path) -> List[Rule]:
+    """Reads dependency rules from a JSON list of `after`/`before` pairs."""
+    with open(path, "r", encoding="UTF-8") as file:
+        return [
+            Rule(after=re.compile(rule["after"]), before=re.compile(rule["before"]))
+            for rule in json.load(file)
+        ]
+
+
+def simulate(
+    trace_path: Path,
+    jobs: Sequence[int],
+    disks: Optional[Sequence[int]] = None,
+    rules_path: Optional[Path] = None,
+) -> List[Prediction]:
+    """Predicts and prints the wall time of a traced run.
+
+    Args:
+        trace_path: The recorded trace.
+        jobs: The concurrency limits to predict for.
+        disks: The disk counts to predict for, the recorded one if None.
+        rules_path: Extra dependency rules.
+
+    Returns:
+        A prediction per disk count and concurrency limit.
+
+    Raises:
+        ValueError: If the trace holds no commands.
+    """
+    steps = load_trace(trace_path)
+    if not steps:
+        raise ValueError(f"{trace_path} holds no recorded commands.")
+    rules = load_rules(rules_path) if rules_path is not None else []
+    tasks = get_tasks(steps)
+    recorded_disks = len(get_disks(steps))
+    wall_time = max(step.end for step in steps) - min(step.start for step in steps)
+    print(
+        f"Recorded: {len(steps)} commands on {recorded_disks} disks, "
+        f"{wall_time:.1f} s wall, {sum(task.duration for task in tasks):.1f} s busy"
+    )
+
+    predictions = []
+    for disk_count in disks or [recorded_disks]:
+        graph = add_dependencies(scale_disks(tasks, disks=disk_count), rules=rules)
+        path = critical_path(graph)
+        path_time = sum(task.duration for task in path)
+        print(f"\n{disk_count} disks:")
+        for job_count in jobs:
+            predicted = schedule(graph, jobs=job_count)
+            predictions.append(Prediction(disk_count, job_count, predicted))
+            print(f"{job_count:>6} jobs: {predicted:8.1f} s")
+        print(f"Critical path: {path_time:.1f} s")
+
+        for task in path:
+            print(f"{task.duration:8.1f} s  {task.stage:<10} {task.cmd[:60]}")
+    return predictions
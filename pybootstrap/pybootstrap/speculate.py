@@ -0,0 +1,91 @@
+"""A module for running work in the background while prompts are shown.
+
+Every task is started under a name together with a key describing the
+answers it depends on. Starting a task again with a different key
+discards the previous run, so work based on answers that later change
+is never used.
+"""
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, NamedTuple, Optional
+
+
+class _Task(NamedTuple):
+    key: Hashable
+    future: Future
+    cancelled: threading.Event
+
+
+class Speculation:
+    """Runs named, keyed tasks in a thread pool."""
+
+    def __init__(self, max_workers: int = 4):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._tasks: Dict[str, _Task] = {}
+
+    def start(
+        self,
+        name: str,
+        fn: Callable[..., Any],
+        *args,
+        key: Hashable = None,
+        cancellable: bool = False,
+        **kwargs,
+    ) -> None:
+        """Starts a task unless it is already running with the same key.
+
+        Args:
+            name: The name of the task.
+            fn: The function to run.
+            *args: Positional arguments for `fn`.
+            key: The answers the task depends on.
+            cancellable: Whether to pass a `cancelled` event to `fn`
+                that is set when the task is discarded.
+            **kwargs: Keyword arguments for `fn`.
+        """
+        task = self._tasks.get(name)
+        if task is not None:
+            if task.key == key:
+                return
+            self.discard(name)
+
+        cancelled = threading.Event()
+        if cancellable:
+            kwargs["cancelled"] = cancelled
+        future = self._executor.submit(fn, *args, **kwargs)
+        self._tasks[name] = _Task(key=key, future=future, cancelled=cancelled)
+
+    def ready(self, name: str) -> bool:
+        """Whether a task has finished."""
+        task = self._tasks.get(name)
+        return task is not None and task.future.done()
+
+    def result(self, name: str, fallback: Optional[Callable[[], Any]] = None) -> Any:
+        """Waits for a task and returns its result.
+
+        Args:
+            name: The name of the task.
+            fallback: Computes the result in the foreground if the task
+                was never started, was discarded or failed.
+        """
+        task = self._tasks.get(name)
+        if task is not None:
+            try:
+                return task.future.result()
+            except Exception:  # pylint: disable=broad-except
+                pass
+        return fallback() if fallback is not None else None
+
+    def discard(self, name: str) -> None:
+        """Cancels a task and forgets its result."""
+        task = self._tasks.pop(name, None)
+        if task is not None:
+            task.cancelled.set()
+            task.future.cancel()
+
+    def shutdown(self) -> None:
+        """Discards all unfinished tasks and stops the thread pool."""
+        for name in list(self._tasks):
+            if not self._tasks[name].future.done():
+                self.discard(name)
+        self._executor.shutdown(wait=False, cancel_futures=True)
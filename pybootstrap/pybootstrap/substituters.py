@@ -0,0 +1,147 @@
+"""A module for installing from local binary caches.
+
+A binary cache on removable media or in a local directory is listed as a
+`file://` substituter ahead of the upstream cache, with a lower priority
+value so Nix asks it first. Paths from it are checked against the
+planned public keys like any other substituter. The store of the live
+system is always added as a trusted substituter, so paths the installer
+image shares with the new system are copied from it rather than fetched.
+
+Such a cache is built on a reference install with `build_cache`, which
+signs every path of the system closure while copying it.
+"""
+from pathlib import Path
+from typing import List, Optional
+
+from pybootstrap import trace
+from pybootstrap.prepare import CacheConfig
+
+UPSTREAM_URL = "https://cache.nixos.org"
+UPSTREAM_KEY = "cache.nixos.org-1:6NCHdD59X431o0gWypbMrAURkbJ16ZPMQFGspcDShjY="
+LIVE_STORE_URL = "auto?trusted=1"
+LOCAL_PRIORITY = 10
+CONNECT_TIMEOUT = 5
+
+
+def get_cache_url(location: str) -> str:
+    """Returns the store URL of a cache given as a directory or URL."""
+    if "://" in location:
+        return location
+    return f"file://{Path(location).resolve()}"
+
+
+def is_binary_cache(location: str) -> bool:
+    """Whether a local cache exists; remote caches are not checked."""
+    url = get_cache_url(location)
+    if not url.startswith("file://"):
+        return True
+    return (Path(url.removeprefix("file://")) / "nix-cache-info").is_file()
+
+
+def get_substituters(config: CacheConfig) -> List[str]:
+    """Returns the substituters in order of preference."""
+    substituters = [
+        f"{get_cache_url(location)}?priority={LOCAL_PRIORITY}"
+        for location in config.substituters
+    ]
+    if not config.offline:
+        substituters.append(UPSTREAM_URL)
+    return substituters
+
+
+def get_install_args(config: CacheConfig) -> List[str]:
+    """Returns the `nixos-install` options for the live store and the
+    planned caches.
+
+    The live store is added after `substituters`, which would otherwise
+    replace it.
+    """
+    live_store = ["--option", "extra-substituters", LIVE_STORE_URL]
+    if not config.substituters:
+        return live_store
+    keys = [UPSTREAM_KEY, *config.trusted_public_keys]
+    return [
+        *["--option", "substituters", " ".join(get_substituters(config))],
+        *live_store,
+        *["--option", "trusted-public-keys", " ".join(keys)],
+        *["--option", "require-sigs", "true"],
+        *["--option", "connect-timeout", str(CONNECT_TIMEOUT)],
+    ]
+
+
+def get_nix_config(config: CacheConfig) -> List[str]:
+    """Returns NixOS configuration lines trusting the cache keys.
+
+    The caches themselves are left out: Nix creates a missing `file://`
+    cache directory, which would write to the mount point of unplugged
+    media.
+    """
+    if not config.trusted_public_keys:
+        return []
+    keys = " ".join(f'"{key}"' for key in config.trusted_public_keys)
+    return [f"nix.settings.extra-trusted-public-keys = [ {keys} ];"]
+
+
+def generate_signing_key(secret_key: Path, name: str) -> str:
+    """Generates a cache signing key pair unless the secret key exists.
+
+    Args:
+        secret_key: The secret key file; the public key is written next
+            to it with a `.pub` suffix.
+        name: The key name, e.g. the host name of the cache.
+
+    Returns:
+        The public key.
+    """
+    public_key = secret_key.with_suffix(".pub")
+    if not secret_key.exists():
+        secret_key.parent.mkdir(parents=True, exist_ok=True)
+        trace.run(
+            [
+                "nix-store",
+                "--generate-binary-cache-key",
+                name,
+                str(secret_key),
+                str(public_key),
+            ],
+            check=True,
+        )
+        secret_key.chmod(0o600)
+    return public_key.read_text(encoding="UTF-8").strip()
+
+
+def build_cache(
+    cache_dir: Path,
+    secret_key: Path,
+    system: Path = Path("/run/current-system"),
+    key_name: Optional[str] = None,
+) -> str:
+    """Copies the closure of a system into a signed binary cache.
+
+    Args:
+        cache_dir: The cache directory, e.g. on removable media.
+        secret_key: The signing key, generated if missing.
+        system: The system whose closure to copy.
+        key_name: The name of a generated key, the host name if None.
+
+    Returns:
+        The public key to plan the cache with.
+    """
+    public_key = generate_signing_key(
+        secret_key=secret_key, name=key_name or f"{_hostname()}-1"
+    )
+    url = (
+        f"{get_cache_url(str(cache_dir))}?secret-key={secret_key.resolve()}"
+        "&compression=zstd&parallel-compression=true"
+    )
+    trace.run(
+        ["nix", "copy", "--extra-experimental-features", "nix-command"]
+        + ["--to", url, str(system.resolve())],
+        check=True,
+    )
+    print(f"Binary cache written to {cache_dir}, public key: {public_key}")
+    return public_key
+
+
+def _hostname() -> str:
+    return Path("/proc/sys/kernel/hostname").read_text(encoding="UTF-8").strip()
@@ -0,0 +1,136 @@
+"""A module for recording the timing of every command of a run.
+
+The stages run their commands through `run`, which appends each one to
+a JSON lines trace with its stage, start and end time while a `Recorder`
+is active. Commands started another way are recorded with `span`. The
+`zpool iostat` stream of `pybootstrap.sampler` only observes the other
+commands and is not recorded. The trace is the input of
+`pybootstrap.simulate`.
+"""
+import json
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+_recorder: Optional["Recorder"] = None
+
+
+class TraceStep(NamedTuple):
+    """A command run by a stage."""
+
+    step: int
+    stage: str
+    cmd: str
+    start: float
+    end: float
+    returncode: Optional[int]
+
+    @property
+    def duration(self) -> float:
+        """The wall time of the command in seconds."""
+        return self.end - self.start
+
+
+class Recorder:
+    """Records the commands run through `run` and `span`.
+
+    Use as a context manager around the stages to trace; `stage` names
+    the stage the following commands belong to. Recording into an
+    existing trace continues its timeline, so stages run one by one
+    from separate invocations form a single trace.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.stage = ""
+        self._lock = threading.Lock()
+        self._origin = 0.0
+        self._step = 0
+
+    def __enter__(self) -> "Recorder":
+        # pylint: disable=global-statement
+        global _recorder
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        steps = load_trace(self.path) if self.path.exists() else []
+        self._step = len(steps)
+        self._origin = time.time() - (steps[-1].end if steps else 0.0)
+        _recorder = self
+        return self
+
+    def __exit__(self, *exc_info):
+        # pylint: disable=global-statement
+        global _recorder
+        _recorder = None
+
+    @contextmanager
+    def span(self, cmd: str) -> Iterator[Dict[str, Optional[int]]]:
+        """Records a command run inside the context.
+
+        Yields:
+            A mapping in which the caller may set the `returncode`.
+        """
+        result: Dict[str, Optional[int]] = {"returncode": None}
+        start = time.time() - self._origin
+        try:
+            yield result
+        finally:
+            end = time.time() - self._origin
+            with self._lock:
+                step = TraceStep(
+                    step=self._step,
+                    stage=self.stage,
+                    cmd=cmd,
+                    start=start,
+                    end=end,
+                    returncode=result["returncode"],
+                )
+                self._step += 1
+                with open(self.path, "a", encoding="UTF-8") as file:
+                    file.write(json.dumps(step._asdict()) + "\n")
+
+
+def set_stage(stage: str) -> None:
+    """Names the stage of the following commands, if recording."""
+    if _recorder is not None:
+        _recorder.stage = stage
+
+
+@contextmanager
+def span(cmd: str) -> Iterator[Dict[str, Optional[int]]]:
+    """Records a command with the active recorder, if any."""
+    if _recorder is None:
+        yield {"returncode": None}
+        return
+    with _recorder.span(cmd) as result:
+        yield result
+
+
+def run(args, *popenargs, **kwargs) -> subprocess.CompletedProcess:
+    """Runs a command with `subprocess.run`, recording it if active.
+
+    Takes the same arguments as `subprocess.run`.
+    """
+    # pylint: disable=subprocess-run-check
+    cmd = args if isinstance(args, str) else " ".join(map(str, args))
+    with span(cmd) as result:
+        try:
+            completed = subprocess.run(args, *popenargs, **kwargs)
+        except subprocess.CalledProcessError as err:
+            result["returncode"] = err.returncode
+            raise
+        result["returncode"] = completed.returncode
+        return completed
+
+
+def load_trace(path: Path) -> List[TraceStep]:
+    """Reads a recorded trace."""
+    steps = []
+    with open(path, "r", encoding="UTF-8") as file:
+        for line in file:
+            if line.strip():
+                record: Dict[str, Any] = json.loads(line)
+                steps.append(TraceStep(**record))
+    return steps
@@ -0,0 +1,273 @@
+"""A module for verifying the installed pools before they are exported.
+
+All dataset properties of the pools are read with a single recursive
+`zfs get` and compared with the properties the installer applied, taking
+inheritance from parent datasets into account. A short parallel smoke
+test then writes, reads and fsyncs files on the key datasets and checks
+the throughput and fsync latency against the floors in the plan.
+"""
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, NamedTuple, Sequence
+
+from pybootstrap import trace
+from pybootstrap.partition import (
+    get_bpool_layout,
+    get_bpool_props,
+    get_dataset_root,
+    get_dpool_layout,
+    get_dpool_props,
+    get_encryption_roots,
+    get_keylocation,
+    get_local_layout,
+    get_rpool_layout,
+    get_rpool_props,
+    get_volume_layout,
+)
+from pybootstrap.prepare import ZfsSystemConfig, get_pools, has_bpool
+
+# properties that are not inherited, or whose inherited value is derived
+NOT_INHERITED = ("canmount", "keylocation", "mountpoint")
+# values ZFS reports under another name than the one that was set
+ALIASES = {"posixacl": "posix"}
+SMOKE_PATHS = ("nix", "var/log", "home")
+BLOCK_SIZE = 1024**2
+FSYNC_WRITES = 64
+FSYNC_SIZE = 4096
+
+
+class SmokeResult(NamedTuple):
+    """Throughput and fsync latency measured on a dataset."""
+
+    path: Path
+    write_mbps: float
+    read_mbps: float
+    fsync_p50_ms: float
+    fsync_p99_ms: float
+
+
+def verify(config: ZfsSystemConfig):
+    """Checks the dataset properties and runs the smoke test.
+
+    Raises:
+        ValueError: If a dataset is missing or a property drifted.
+        RuntimeError: If the smoke test is below the planned floor.
+    """
+    check_properties(config=config)
+    if config.verify.enable:
+        check_performance(config=config)
+
+
+def get_properties(pools: Sequence[str]) -> Dict[str, Dict[str, str]]:
+    """Reads every property of every dataset and volume of the pools at once.
+
+    Returns:
+        The property values by dataset name and property name.
+    """
+    process = trace.run(
+        ["zfs", "get", "-Hp", "-r", "-t", "filesystem,volume"]
+        + ["-o", "name,property,value", "all", *pools],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    properties: Dict[str, Dict[str, str]] = {}
+    for line in process.stdout.splitlines():
+        name, prop, value = line.split("\t", 2)
+        properties.setdefault(name, {})[prop] = value
+    return properties
+
+
+def get_expected_properties(config: ZfsSystemConfig) -> Dict[str, Dict[str, str]]:
+    """Returns the property values the installer applied to each dataset.
+
+    Values set on a dataset are inherited by its descendants, except for
+    the properties in `NOT_INHERITED`. Mount points are reported below
+    the altroot of the pool.
+    """
+    pools = {"rpool": (get_rpool_props(config), get_rpool_layout(config))}
+    if has_bpool(config=config):
+        pools["bpool"] = (get_bpool_props(config), get_bpool_layout(config))
+    if config.data.disks:
+        pools[config.data.name] = (get_dpool_props(config), get_dpool_layout(config))
+
+    expected = {}
+    for pool, ((zpoolprops, zfsprops), layout) in pools.items():
+        dataset_root = get_dataset_root(pool=pool, config=config)
+        local = {pool: zfsprops.properties()}
+        for spec in layout:
+            local[str(dataset_root / spec.path)] = spec.zfsprops.properties()
+        if pool == "rpool":
+            for spec in get_local_layout(config):
+                local[f"{pool}/{spec.path}"] = spec.zfsprops.properties()
+        keylocation = get_keylocation(pool=pool, config=config)
+        for root in get_encryption_roots(pool=pool, config=config):
+            local[str(dataset_root / root)]["keylocation"] = keylocation
+
+        for name in local:
+            parts = name.split("/")
+            props: Dict[str, str] = {}
+            for depth in range(1, len(parts) + 1):
+                ancestor = "/".join(parts[:depth])
+                for prop, value in local.get(ancestor, {}).items():
+                    if ancestor == name or prop not in NOT_INHERITED:
+                        props[prop] = ALIASES.get(value, value)
+            mountpoint = props.get("mountpoint", "none")
+            if mountpoint not in ("none", "legacy"):
+                props["mountpoint"] = str(
+                    zpoolprops.altroot / Path(mountpoint).relative_to("/")
+                )
+            expected[name] = props
+
+        # volumes take only their local values, e.g. no mount point
+        for spec in get_volume_layout(pool=pool, config=config):
+            name = str(dataset_root / spec.path)
+            expected[name] = {
+                prop: ALIASES.get(value, value)
+                for prop, value in spec.zvolume.zvolprops.properties().items()
+            }
+    return expected
+
+
+def diff_properties(
+    expected: Dict[str, Dict[str, str]], actual: Dict[str, Dict[str, str]]
+) -> List[str]:
+    """Describes every expected property that is missing or different."""
+    drift = []
+    for name, props in expected.items():
+        if name not in actual:
+            drift.append(f"{name}: missing")
+            continue
+        for prop, value in props.items():
+            actual_value = actual[name].get(prop, "-")
+            if actual_value != value:
+                drift.append(f"{name}: {prop} is {actual_value}, expected {value}")
+    return drift
+
+
+def check_properties(config: ZfsSystemConfig):
+    """Compares the dataset properties with the installer's.
+
+    Raises:
+        ValueError: If a dataset is missing or a property drifted.
+    """
+    expected = get_expected_properties(config=config)
+    if config.zfs.scratch == "install":
+        # destroyed once the install is built
+        expected.pop(f"rpool/{config.zfs.os_id}/scratch", None)
+
+    actual = get_properties(pools=get_pools(config=config))
+    drift = diff_properties(expected=expected, actual=actual)
+    if drift:
+        raise ValueError("Dataset properties drifted:\n  " + "\n  ".join(drift))
+    checked = sum(len(props) for props in expected.values())
+    print(f"Verified {checked} properties of {len(expected)} datasets")
+
+
+def check_performance(config: ZfsSystemConfig) -> List[SmokeResult]:
+    """Runs the smoke test on the key datasets and checks the floors.
+
+    Raises:
+        RuntimeError: If a result is below the planned floor.
+    """
+    floor = config.verify
+    results = []
+    failures = []
+    for path in SMOKE_PATHS:
+        result = smoke_test(
+            path=Path("/mnt") / path, size=floor.size_mib * 1024**2, jobs=floor.jobs
+        )
+        results.append(result)
+        print(
+            f"{result.path}: write {result.write_mbps:.0f} MB/s, "
+            f"read {result.read_mbps:.0f} MB/s, fsync p50 "
+            f"{result.fsync_p50_ms:.1f} ms, p99 {result.fsync_p99_ms:.1f} ms"
+        )
+        if result.write_mbps < floor.min_write_mbps:
+            failures.append(f"{result.path}: write below {floor.min_write_mbps} MB/s")
+        if result.read_mbps < floor.min_read_mbps:
+            failures.append(f"{result.path}: read below {floor.min_read_mbps} MB/s")
+        if result.fsync_p99_ms > floor.max_fsync_p99_ms:
+            failures.append(
+                f"{result.path}: fsync p99 above {floor.max_fsync_p99_ms} ms"
+            )
+
+    if failures:
+        raise RuntimeError("Smoke test failed:\n  " + "\n  ".join(failures))
+    return results
+
+
+def smoke_test(path: Path, size: int, jobs: int) -> SmokeResult:
+    """Writes, reads and fsyncs a file per job in parallel.
+
+    The written data is random, so compression does not inflate the
+    throughput. Reads are likely served from the ARC and only catch
+    gross problems.
+
+    Args:
+        path: The directory to test in.
+        size: The bytes written per job.
+        jobs: The number of parallel jobs.
+
+    Returns:
+        The throughput and fsync latency.
+    """
+    block = os.urandom(BLOCK_SIZE)
+    with tempfile.TemporaryDirectory(dir=path, prefix=".pybootstrap-") as tmp_dir:
+        files = [Path(tmp_dir) / f"job{num}" for num in range(jobs)]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            start = perf_counter()
+            list(executor.map(lambda file: _write(file, size, block), files))
+            write_seconds = perf_counter() - start
+
+            start = perf_counter()
+            list(executor.map(_read, files))
+            read_seconds = perf_counter() - start
+
+            latencies = sorted(chain.from_iterable(executor.map(_fsync, files)))
+
+    total_mb = size * jobs / 1e6
+    return SmokeResult(
+        path=path,
+        write_mbps=total_mb / write_seconds,
+        read_mbps=total_mb / read_seconds,
+        fsync_p50_ms=percentile(latencies, 50),
+        fsync_p99_ms=percentile(latencies, 99),
+    )
+
+
+def percentile(values: Sequence[float], percent: float) -> float:
+    """Returns the nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, round(percent / 100 * (len(values) - 1)))]
+
+
+def _write(file: Path, size: int, block: bytes):
+    with open(file, "wb") as out:
+        for _ in range(0, size, len(block)):
+            out.write(block)
+        out.flush()
+        os.fsync(out.fileno())
+
+
+def _read(file: Path):
+    buffer = bytearray(BLOCK_SIZE)
+    with open(file, "rb", buffering=0) as src:
+        while src.readinto(buffer):
+            pass
+
+
+def _fsync(file: Path) -> List[float]:
+    latencies = []
+    with open(file, "ab", buffering=0) as out:
+        for _ in range(FSYNC_WRITES):
+            out.write(os.urandom(FSYNC_SIZE))
+            start = perf_counter()
+            os.fsync(out.fileno())
+            latencies.append((perf_counter() - start) * 1000)
+    return latencies
@@ -0,0 +1,243 @@
+"""A module for planning and wiping disks before partitioning.
+
+Devices that support discard are trimmed in parallel ranges. Everything
+else only gets the on-disk metadata wiped: the primary and backup GPT
+and any ZFS labels found on the old partitions (or the whole disk), so
+even large spinning disks are wiped in seconds.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, NamedTuple, Tuple
+
+from pybootstrap import trace
+
+SECTOR_SIZE = 512
+GPT_WIPE_SIZE = 1024**2
+ZFS_LABEL_SIZE = 256 * 1024
+ZFS_UBERBLOCK_RING_OFFSET = 128 * 1024
+ZFS_UBERBLOCK_MAGICS = (
+    (0x00BAB10C).to_bytes(8, "little"),
+    (0x00BAB10C).to_bytes(8, "big"),
+)
+MAX_DISCARD_RANGES = 8
+
+
+class DiscardInfo(NamedTuple):
+    """Discard capabilities of a block device as reported by sysfs."""
+
+    max_bytes: int
+    granularity: int
+    logical_block_size: int
+    rotational: bool
+
+    @property
+    def supported(self) -> bool:
+        """Whether discards should be used to wipe the device."""
+        return self.max_bytes > 0 and not self.rotational
+
+
+class WipeRange(NamedTuple):
+    """A byte range of a device to wipe."""
+
+    offset: int
+    length: int
+
+
+class WipePlan(NamedTuple):
+    """How a single disk is going to be wiped."""
+
+    disk: str
+    size: int
+    method: str
+    ranges: List[WipeRange]
+
+
+def wipe_disks(disks: List[str]) -> List[WipePlan]:
+    """Plans and wipes all disks in parallel.
+
+    Args:
+        disks: A list of disks by id.
+
+    Returns:
+        The executed wipe plans.
+    """
+    with ThreadPoolExecutor(max_workers=max(len(disks), 1)) as executor:
+        plans = list(executor.map(plan_wipe, disks))
+        list(executor.map(wipe, plans))
+
+    for plan in plans:
+        wiped = sum(rng.length for rng in plan.ranges)
+        print(f"Wiped {plan.disk} ({plan.method}, {wiped / 1024**2:.1f} MiB)")
+
+    return plans
+
+
+def plan_wipe(disk: str) -> WipePlan:
+    """Decides how to wipe a disk based on its discard capabilities.
+
+    Args:
+        disk: The disk by id.
+
+    Returns:
+        The wipe plan for the disk.
+    """
+    sysfs = get_sysfs_dir(disk)
+    size = int(read_sysfs(sysfs / "size")) * SECTOR_SIZE
+    discard = get_discard_info(disk)
+
+    if discard.supported:
+        ranges = get_discard_ranges(size=size, discard=discard)
+        return WipePlan(disk=disk, size=size, method="discard", ranges=ranges)
+
+    gpt_size = min(GPT_WIPE_SIZE, size)
+    ranges = [
+        WipeRange(offset=0, length=gpt_size),
+        WipeRange(offset=size - gpt_size, length=gpt_size),
+    ]
+    with open(disk, "rb") as file:
+        for part_offset, part_size in [(0, size)] + get_partitions(disk):
+            ranges.extend(
+                probe_zfs_labels(
+                    fd=file.fileno(), part_offset=part_offset, part_size=part_size
+                )
+            )
+    return WipePlan(disk=disk, size=size, method="labels", ranges=ranges)
+
+
+def wipe(plan: WipePlan) -> None:
+    """Executes a wipe plan.
+
+    Args:
+        plan: The wipe plan to execute.
+    """
+    match plan.method:
+        case "discard":
+            cmds = [
+                f"blkdiscard -f -o {rng.offset} -l {rng.length} {plan.disk}"
+                for rng in plan.ranges
+            ]
+            with ThreadPoolExecutor(max_workers=len(cmds)) as executor:
+                list(executor.map(lambda cmd: trace.run(cmd.split(), check=True), cmds))
+        case "labels":
+            fd = os.open(plan.disk, os.O_WRONLY)
+            try:
+                for rng in plan.ranges:
+                    os.pwrite(fd, bytes(rng.length), rng.offset)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        case _:
+            raise ValueError(f"Unknown wipe method: {plan.method}")
+
+
+def get_sysfs_dir(disk: str) -> Path:
+    """Returns the sysfs directory of a disk or partition."""
+    return Path("/sys/class/block") / Path(os.path.realpath(disk)).name
+
+
+def read_sysfs(path: Path) -> str:
+    """Reads a single sysfs attribute."""
+    with open(path, "r", encoding="UTF-8") as file:
+        return file.read().strip()
+
+
+def get_discard_info(disk: str) -> DiscardInfo:
+    """Reads the discard capabilities of a disk from sysfs.
+
+    Args:
+        disk: The disk by id.
+
+    Returns:
+        The discard information of the disk.
+    """
+    queue = get_sysfs_dir(disk) / "queue"
+    return DiscardInfo(
+        max_bytes=int(read_sysfs(queue / "discard_max_bytes")),
+        granularity=int(read_sysfs(queue / "discard_granularity")),
+        logical_block_size=int(read_sysfs(queue / "logical_block_size")),
+        rotational=read_sysfs(queue / "rotational") == "1",
+    )
+
+
+def get_discard_ranges(size: int, discard: DiscardInfo) -> List[WipeRange]:
+    """Splits a device into aligned ranges that can be discarded in
+    parallel.
+
+    Args:
+        size: The size of the device in bytes.
+        discard: The discard capabilities of the device.
+
+    Returns:
+        A list of ranges covering the whole device.
+    """
+    align = max(discard.granularity, discard.logical_block_size, SECTOR_SIZE)
+    count = min(MAX_DISCARD_RANGES, os.cpu_count() or 1)
+    step = max(size // count // align * align, align)
+
+    ranges = []
+    for offset in range(0, size, step):
+        ranges.append(WipeRange(offset=offset, length=min(step, size - offset)))
+    return ranges
+
+
+def get_partitions(disk: str) -> List[Tuple[int, int]]:
+    """Returns the byte offset and size of every partition on a disk.
+
+    Args:
+        disk: The disk by id.
+
+    Returns:
+        A list of (offset, size) tuples.
+    """
+    partitions = []
+    for child in get_sysfs_dir(disk).iterdir():
+        if not (child / "partition").exists():
+            continue
+        start = int(read_sysfs(child / "start")) * SECTOR_SIZE
+        size = int(read_sysfs(child / "size")) * SECTOR_SIZE
+        partitions.append((start, size))
+    return partitions
+
+
+def get_zfs_label_offsets(part_size: int) -> List[int]:
+    """Returns the offsets of the four ZFS labels within a vdev.
+
+    Two labels sit at the start of the vdev and two at the end, the end
+    being rounded down to the label size.
+    """
+    aligned_size = part_size - part_size % ZFS_LABEL_SIZE
+    return [
+        0,
+        ZFS_LABEL_SIZE,
+        aligned_size - 2 * ZFS_LABEL_SIZE,
+        aligned_size - ZFS_LABEL_SIZE,
+    ]
+
+
+def probe_zfs_labels(fd: int, part_offset: int, part_size: int) -> List[WipeRange]:
+    """Finds the ZFS labels of a vdev by looking for uberblock magic.
+
+    Args:
+        fd: A readable file descriptor of the whole disk.
+        part_offset: The byte offset of the vdev on the disk.
+        part_size: The size of the vdev in bytes.
+
+    Returns:
+        The byte ranges of the labels found.
+    """
+    if part_size < 4 * ZFS_LABEL_SIZE:
+        return []
+
+    ring_size = ZFS_LABEL_SIZE - ZFS_UBERBLOCK_RING_OFFSET
+    found = []
+    for label_offset in get_zfs_label_offsets(part_size):
+        offset = part_offset + label_offset
+        ring = os.pread(fd, ring_size, offset + ZFS_UBERBLOCK_RING_OFFSET)
+        if any(magic in ring for magic in ZFS_UBERBLOCK_MAGICS):
+            found.append(WipeRange(offset=offset, length=ZFS_LABEL_SIZE))
+    return found
+
+
+if __name__ == "__main__":
+    pass
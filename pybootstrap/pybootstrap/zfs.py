@@ -1,8 +1,9 @@
 """Modules for building OpenZFS commands."""
+import re
 from abc import ABC
 from dataclasses import dataclass, field, fields
 from pathlib import Path
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional
 
 
 @dataclass(frozen=True)
@@ -15,8 +16,42 @@ class ZfsOptionBase(ABC):
         field_names = [f.name for f in fields(self) if f.name != "prefix"]
         return list(filter(lambda f: getattr(self, f) is not None, field_names))
 
+    def _prop_name(self, attr: str) -> str:
+        # user properties (e.g. `com.sun:auto-snapshot`) are not valid
+        # identifiers, so their fields name them in the metadata
+        metadata = {f.name: f.metadata for f in fields(self)}[attr]
+        return metadata.get("property", attr)
+
     def _prop(self, attr: str) -> str:
-        return f"-{self.prefix} {attr}={getattr(self, attr)}"
+        return f"-{self.prefix} {self._prop_name(attr)}={getattr(self, attr)}"
+
+    def properties(self) -> Dict[str, str]:
+        """The properties that are set, by their ZFS name.
+
+        Returns
+        -------
+        dict
+            The property values by name, e.g. `{'atime': 'on'}`.
+        """
+        return {
+            self._prop_name(attr): str(getattr(self, attr))
+            for attr in self._attr_filter()
+        }
+
+    def _valid_compression(self):
+        gzip_levels = [f"gzip-{level}" for level in range(1, 10)]
+        zstd_levels = [f"zstd-{level}" for level in range(1, 20)]
+        zstd_fast_levels = [
+            f"zstd-fast-{level}"
+            for level in [*range(1, 11), *range(20, 101, 10), 500, 1000]
+        ]
+        self._valid_attr(
+            "compression",
+            ["on", "off", "gzip", "lz4", "lzjb", "zle", "zstd", "zstd-fast"]
+            + gzip_levels
+            + zstd_levels
+            + zstd_fast_levels,
+        )
 
     def _valid_attr(self, attr: str, allowed: list[Any]):
         attr_val = getattr(self, attr)
@@ -134,6 +169,10 @@ class ZfsProps(ZfsOptionBase):
             all new extended attributes will only be accessible from
             OpenZFS implementations which support the `xattr`='sa'
             property. See the `xattr` property for more details.
+        auto_snapshot : {'true', 'false'}, optional
+            The `com.sun:auto-snapshot` user property, which tells
+            snapshot tools such as zfs-auto-snapshot whether to snapshot
+            this dataset and its descendants.
         canmount: {'on', 'off', 'noauto'}, optional
             If this property is set to off, the file system cannot be
             mounted, and is ignored by zfs mount -a. Setting this
@@ -150,9 +189,12 @@ class ZfsProps(ZfsOptionBase):
             automatically when the dataset is created or imported, nor
             is it mounted by the zfs mount -a command or unmounted by
             the zfs unmount -a command. This property is not inherited.
-        compression : {'on', 'off', 'gzip', 'lz4', 'lzjb', 'zle',
-        'zstd', 'zstd-fast'}, optional
+        compression : {'on', 'off', 'gzip', 'gzip-N', 'lz4', 'lzjb',
+        'zle', 'zstd', 'zstd-N', 'zstd-fast', 'zstd-fast-N'}, optional
             Controls the compression algorithm used for this dataset.
+            The gzip levels range from 1 to 9, the zstd levels from 1 to
+            19 and the zstd-fast levels are 1-10, 20-100 (in steps of
+            10), 500 and 1000.
         devices : {'on', 'off'}, optional
             Controls whether device nodes can be opened on this file
             system. The default value is on. The values on and off are
@@ -181,14 +223,17 @@ class ZfsProps(ZfsOptionBase):
             currently aes-256-gcm. In order to provide consistent data
             protection, encryption must be specified at dataset creation
             time and it cannot be changed afterwards.
-        keyformat : {'passphrase'}, optional
+        keyformat : {'passphrase', 'raw', 'hex'}, optional
             Controls what format the user's encryption key will be
             provided as. This property is only set when the dataset is
-            encrypted. `raw` and `hex` currently not supported.
-        keylocation : {'prompt'}, optional
+            encrypted. Raw keys and hex keys must be 32 bytes long
+            (regardless of the chosen encryption suite) and must be
+            randomly generated. A passphrase must be between 8 and 512
+            bytes long.
+        keylocation : {'prompt', 'file://<absolute file path>'}, optional
             Controls where the user's encryption key will be loaded from
-            by default for commands such as zfs. `file://`, `https://`
-            and `http://` currently not supported.
+            by default for commands such as zfs. `https://` and
+            `http://` currently not supported.
         mountpoint : Path | {'none', 'legacy'}, optional
             Controls the mount point used for this file system. When the
             mountpoint property is changed for a file system, the file
@@ -211,6 +256,11 @@ class ZfsProps(ZfsOptionBase):
             property is automatically set to on. The default value of
             the normalization property is none. This property cannot be
             changed after the file system is created.
+        recordsize : int, optional
+            Specifies a suggested block size in bytes for files in the
+            file system. The size must be a power of two from 512 to
+            16 MiB. Large records suit large, sequentially accessed
+            files; the default is 128 KiB.
         relatime : {'on', 'off'}, optional
             Controls the manner in which the access time is updated when
             atime=on is set. Turning this property on causes the access
@@ -220,6 +270,14 @@ class ZfsProps(ZfsOptionBase):
             existing access time hasn't been updated within the past 24
             hours. The default value is off. The values on and off are
             equivalent to the relatime and norelatime mount options.
+        sync : {'standard', 'always', 'disabled'}, optional
+            Controls the behavior of synchronous requests (e.g. fsync,
+            O_DSYNC). standard is the POSIX-specified behavior of
+            ensuring all synchronous requests are written to stable
+            storage. always causes every file system transaction to be
+            written and flushed before its system call returns.
+            disabled ignores synchronous requests, which is only safe
+            for data that may be lost on a crash.
         xattr : {'on', 'off', 'sa'}, optional
             Controls whether extended attributes are enabled for this
             file system. Two styles of extended attributes are
@@ -240,6 +298,9 @@ class ZfsProps(ZfsOptionBase):
     prefix: str
     atime: Optional[str] = None
     acltype: Optional[str] = None
+    auto_snapshot: Optional[str] = field(
+        default=None, metadata={"property": "com.sun:auto-snapshot"}
+    )
     canmount: Optional[str] = None
     compression: Optional[str] = None
     devices: Optional[str] = None
@@ -249,17 +310,17 @@ class ZfsProps(ZfsOptionBase):
     keylocation: Optional[str] = None
     mountpoint: Optional[Path | str] = None
     normalization: Optional[str] = None
+    recordsize: Optional[int] = None
     relatime: Optional[str] = None
+    sync: Optional[str] = None
     xattr: Optional[str] = None
 
     def __post_init__(self):
         self._valid_attr("atime", ("on", "off"))
         self._valid_attr("acltype", ("off", "noacl", "nfsv4", "posix", "posixacl"))
+        self._valid_attr("auto_snapshot", ("true", "false"))
         self._valid_attr("canmount", ("on", "off", "noauto"))
-        self._valid_attr(
-            "compression",
-            ("on", "off", "gzip", "lz4", "lzjb", "zle", "zstd", "zstd-fast"),
-        )
+        self._valid_compression()
         self._valid_attr("devices", ("on", "off"))
         self._valid_attr("dnodesize", ("legacy", "auto", "1k", "2k", "4k", "8k", "16k"))
         self._valid_attr(
@@ -275,14 +336,16 @@ class ZfsProps(ZfsOptionBase):
                 "aes-256-gcm",
             ),
         )
-        self._valid_attr("keyformat", ("passphrase",))
-        self._valid_attr("keylocation", ("prompt",))
+        self._valid_attr("keyformat", ("passphrase", "raw", "hex"))
+        self._valid_keylocation()
         self._valid_encryption()
         self._valid_mountpoint()
         self._valid_attr(
             "normalization", ("none", "formC", "formD", "formKC", "formKD")
         )
+        self._valid_attr("recordsize", [2**exp for exp in range(9, 25)])
         self._valid_relatime()
+        self._valid_attr("sync", ("standard", "always", "disabled"))
         self._valid_attr("xattr", ("on", "off", "sa"))
 
     def _valid_encryption(self):
@@ -311,6 +374,15 @@ class ZfsProps(ZfsOptionBase):
                 " valid values (with encryption not being 'off')."
             )
 
+    def _valid_keylocation(self):
+        if self.keylocation is None or self.keylocation == "prompt":
+            return
+        if not self.keylocation.startswith("file:///"):
+            raise ValueError(
+                f"Attribute keylocation ({self.keylocation}) is neither 'prompt'"
+                " nor a file:// URI with an absolute path."
+            )
+
     def _xor_three(self, a, b, c):
         return (a ^ b) or (a ^ c)
 
@@ -337,6 +409,85 @@ class ZfsProps(ZfsOptionBase):
         return " ".join(map(self._prop, self._attr_filter()))
 
 
+@dataclass(frozen=True)
+class ZVolProps(ZfsOptionBase):
+    """Native properties of ZFS volumes.
+
+    Attributes
+    ----------
+        prefix : str
+            The prefix to use for the options in this class, 'o' for
+            `zfs create`.
+        compression : str, optional
+            Controls the compression algorithm used for this volume.
+            Takes the same values as `ZfsProps.compression`.
+        logbias : {'latency', 'throughput'}, optional
+            Provides a hint about handling synchronous requests. latency
+            uses the log devices to return quickly; throughput writes
+            straight to the pool, which avoids writing the data twice
+            for workloads that issue large synchronous writes. The
+            default value is latency.
+        primarycache : {'all', 'none', 'metadata'}, optional
+            Controls what is cached in the ARC. Guests and databases
+            with caches of their own are best served with metadata,
+            which avoids caching their data twice. The default value is
+            all.
+        sync : {'standard', 'always', 'disabled'}, optional
+            Controls the behavior of synchronous requests, see
+            `ZfsProps.sync`.
+        volblocksize : int, optional
+            The block size of the volume in bytes, a power of two from
+            512 to 128 KiB. It should match the I/O size of the
+            consumer, e.g. the cluster size of a VM image or the page
+            size of a database. This property cannot be changed after
+            the volume is created. The default value is 16 KiB.
+
+    Raises
+    ------
+        ValueError
+            If an attribute is not one of its allowed values.
+    """
+
+    prefix: str
+    compression: Optional[str] = None
+    logbias: Optional[str] = None
+    primarycache: Optional[str] = None
+    sync: Optional[str] = None
+    volblocksize: Optional[int] = None
+
+    def __post_init__(self):
+        self._valid_compression()
+        self._valid_attr("logbias", ("latency", "throughput"))
+        self._valid_attr("primarycache", ("all", "none", "metadata"))
+        self._valid_attr("sync", ("standard", "always", "disabled"))
+        self._valid_attr("volblocksize", [2**exp for exp in range(9, 18)])
+
+    def __str__(self):
+        return " ".join(map(self._prop, self._attr_filter()))
+
+
+VOLUME_PROFILES = {
+    # qcow2-style images use 64 KiB clusters and the guest caches its data
+    "vm": ZVolProps(
+        prefix="o",
+        compression="lz4",
+        logbias="latency",
+        primarycache="metadata",
+        sync="standard",
+        volblocksize=64 * 1024,
+    ),
+    # 16 KiB pages, e.g. InnoDB, with a buffer pool and a log of their own
+    "db16k": ZVolProps(
+        prefix="o",
+        compression="lz4",
+        logbias="throughput",
+        primarycache="metadata",
+        sync="standard",
+        volblocksize=16 * 1024,
+    ),
+}
+
+
 @dataclass
 class ZPool:
     """Class for creating ZFS storage pools."""
@@ -353,7 +504,9 @@ class ZPool:
         if vdev_type not in allowed:
             raise ValueError(f"vdev_type ({vdev_type}) not in {allowed}.")
 
-    def create(self, name: str, disks: List[Path], vdev_type: str = ""):
+    def create(
+        self, name: str, disks: List[Path], vdev_type: str = "", vdev_width: int = 0
+    ):
         """Creates a ZFS storage pool.
 
         Creates a new storage pool containing the virtual devices
@@ -375,11 +528,27 @@ class ZPool:
             empty string, will create a non-redundant pool using all the
             disks. Valid values are an empty string, 'mirror', 'raidz1',
             'raidz2', and 'raidz3'.
+        vdev_width : int
+            The number of disks per virtual device. If 0, all the disks
+            form a single virtual device, otherwise the disks are split
+            in order into virtual devices of `vdev_type`, which must not
+            be an empty string.
         """
         self._valid_vdev_type(vdev_type=vdev_type)
 
         disks_str = [str(disk) for disk in disks]
-        return " ".join((str(self), name, vdev_type, *disks_str))
+        if vdev_width <= 0 or not vdev_type:
+            return " ".join((str(self), name, vdev_type, *disks_str))
+
+        if len(disks_str) % vdev_width != 0:
+            raise ValueError(
+                f"{len(disks_str)} disks cannot be split into vdevs of {vdev_width}."
+            )
+        vdevs = [
+            " ".join((vdev_type, *disks_str[start : start + vdev_width]))
+            for start in range(0, len(disks_str), vdev_width)
+        ]
+        return " ".join((str(self), name, *vdevs))
 
 
 @dataclass
@@ -405,6 +574,52 @@ class ZDataset:
         return " ".join((str(self), str(filesystem)))
 
 
+@dataclass
+class ZVolume:
+    """Create ZFS volumes.
+
+    Attributes
+    ----------
+        zvolprops : ZVolProps
+            The properties of the volume.
+        volsize : str
+            The logical size of the volume, in bytes or with a K, M, G,
+            T or P suffix.
+        sparse : bool
+            Whether to create the volume without a reservation, so space
+            is only allocated as it is written.
+
+    Raises
+    ------
+        ValueError
+            If `volsize` is not a size.
+    """
+
+    zvolprops: ZVolProps
+    volsize: str
+    sparse: bool = False
+
+    def __post_init__(self):
+        if not re.fullmatch(r"\d+(\.\d+)?[KMGTP]?", str(self.volsize)):
+            raise ValueError(f"Attribute volsize ({self.volsize}) is not a size.")
+
+    def __str__(self):
+        sparse = ("-s",) if self.sparse else ()
+        return " ".join(
+            ("zfs create", *sparse, f"-V {self.volsize}", str(self.zvolprops))
+        )
+
+    def create(self, volume: Path):
+        """Creates a new ZFS volume.
+
+        Parameters
+        ----------
+        volume : Path
+            The volume path to create.
+        """
+        return " ".join((str(self), str(volume)))
+
+
 def demo():
     """Demonstrate classes and functions in this module."""
     zpoolprops = ZPoolProps(